@@ -1,19 +1,51 @@
 #!/usr/bin/env python3
+import base64
+import http.client
 import json
-import random
-import requests
+import operator
+import sqlite3
 import argparse
 import os
+import queue
 from datetime import datetime, timezone
 import sys
-from collections import OrderedDict
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.addresslist import AddressList, EXTENSION, export_text, write_address_list
+from common.amounts import format_amount
+from common.base58 import b58encode
+from common.curve_cache import CurveCache
+from common.exclusions import Exclusions
+from common.filters import select, top, bottom, sample, by_balance, parse_filter, in_base_units
+from common.holder_index import HolderIndex
+from common.ratelimit import RateController
+from common.raw_accounts import RAW_FORMATS, read_raw, write_raw, zstd_available
+from common.rpc import RpcPool, RpcError, HttpError, parse_urls
+from common.snapshots import SnapshotStore, SNAPSHOT_DB, diff_holdings
+from common.token_list import TokenList
+from common.websocket import WebSocket, ws_url
+
+# getProgramAccounts of a large token can take minutes
+GET_ACCOUNTS_TIMEOUT = 300
+SHARD_ATTEMPTS = 5
+# getTokenLargestAccounts returns at most this many token accounts
+LARGEST_ACCOUNTS = 20
+# Watch mode: seconds between websocket pings and before reconnecting
+PING_INTERVAL = 30
+RECONNECT_DELAY = 5
 
 def get_current_utc_time_str():
     now_utc = datetime.now(timezone.utc)
     return now_utc.strftime("%Y-%m-%d-%H%M%S")
 
-def write_files(data, raw_data):
-    global OUTPUT_FILE, TOKEN, TOKEN_MINT
+def output_folder():
+    global TOKEN, TOKEN_MINT
     # If token name is not resolved, use first 5 chars of address
     if TOKEN != TOKEN_MINT:
         token_name = TOKEN
@@ -21,13 +53,16 @@ def write_files(data, raw_data):
         token_name = TOKEN_MINT[:5]
 
     current_time = get_current_utc_time_str()
-    raw_filename = "./" + token_name + "-" + current_time + "/" + 'raw.json'
-    filename = "./" + token_name + "-" + current_time + "/" + OUTPUT_FILE + ".txt"
-    balance_filename = "./" + token_name + "-" + current_time + "/" + OUTPUT_FILE + "-balance.txt"
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return "./" + token_name + "-" + current_time + "/"
+
+def write_files(data, folder, decimals, slot, mint=None):
+    global OUTPUT_FILE, TOKEN_MINT
+    filename = folder + OUTPUT_FILE + ".txt"
+    balance_filename = folder + OUTPUT_FILE + "-balance.txt"
 
-    with open(raw_filename, 'w') as f:
-        json.dump(raw_data, f, ensure_ascii=False, indent=4)
+    # The same list in the binary format, for the distributors
+    write_address_list(folder + OUTPUT_FILE + EXTENSION, [acc[0] for acc in data],
+                       [acc[1] for acc in data], mint or TOKEN_MINT, decimals, slot)
 
     with open(filename, 'w') as f:
         for acc in data:
@@ -35,12 +70,25 @@ def write_files(data, raw_data):
 
     with open(balance_filename, 'w') as f:
         for acc in data:
-            f.write(f'{acc[0].strip()},{str(acc[1])}\n')
+            f.write(f'{acc[0].strip()},{format_amount(acc[1], decimals)}\n')
+
+def export_list(path):
+    # Text files of a binary address list, next to it
+    try:
+        address_list = AddressList(path)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Failed to read {path}: {e}')
+    base = path[:-len(EXTENSION)] if path.endswith(EXTENSION) else path
+    export_text(address_list, base + '.txt', base + '-balance.txt')
+    print(f'{len(address_list)} addresses of {address_list.mint} at slot {address_list.slot} '
+          f'written to {base}.txt and {base}-balance.txt')
+    address_list.close()
 
 
 def extract_balance(json):
+    # Raw amount in base units
     try:
-        return float(json['account']['data']['parsed']['info']['tokenAmount']['uiAmountString'])
+        return int(json['account']['data']['parsed']['info']['tokenAmount']['amount'])
     except KeyError:
         return 0
 
@@ -51,13 +99,155 @@ def extract_owner(json):
     elif ADDRESS_TYPE == 'token':
         return json['pubkey']
 
-def get_accounts(endpoint, mint):
-    headers = {
-        'Content-Type': 'application/json',
-    }   
-    data = ' { "jsonrpc": "2.0", "id": 1, "method": "getProgramAccounts", "params": [ "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA", { "encoding": "jsonParsed", "filters": [ { "dataSize": 165 }, { "memcmp": { "offset": 0, "bytes": "' + f"{mint}" + '" } } ] } ] } '
-    response = requests.post(endpoint, headers=headers, data=data)
-    return response.json()
+def account_data(json):
+    # base64 encoded dataSlice of the token account: owner (32 bytes), amount (u64 LE)
+    data = base64.b64decode(json['account']['data'][0])
+    # A notification can carry the whole account instead of the slice
+    if len(data) == 165:
+        data = data[32:72]
+    return data
+
+def decode_account(json):
+    global ADDRESS_TYPE
+    data = account_data(json)
+    if ADDRESS_TYPE == 'owner':
+        address = b58encode(data[:32])
+    else:
+        address = json['pubkey']
+    return address, int.from_bytes(data[32:40], 'little')
+
+def is_base64(json):
+    # base64 data is [data, 'base64'], jsonParsed data an object. Checked on every
+    # account, so a raw file can be read back whatever encoding it was fetched with.
+    return isinstance(json['account']['data'], list)
+
+def account_fields(json):
+    # (token account, owner, raw amount) of an account, for the snapshot store
+    if is_base64(json):
+        data = account_data(json)
+        return json['pubkey'], b58encode(data[:32]), int.from_bytes(data[32:40], 'little')
+    info = json['account']['data']['parsed']['info']
+    return json['pubkey'], info['owner'], int(info['tokenAmount']['amount'])
+
+def is_closed(json):
+    # A closed account has 0 lamports or no data left, an emptied one is still open
+    account = json['account']
+    if account.get('lamports') == 0:
+        return True
+    data = account['data']
+    return not data[0] if isinstance(data, list) else not data
+
+def parse_account(json):
+    # (address, raw amount) of an account, for the selected address type
+    if is_base64(json):
+        return decode_account(json)
+    return extract_owner(json), extract_balance(json)
+
+def program_accounts_params(mint, owner_prefix=b''):
+    global ENCODING
+    filters = [
+        {"dataSize": 165},
+        {"memcmp": {"offset": 0, "bytes": mint}}
+    ]
+    if owner_prefix:
+        # Only accounts whose owner starts with these bytes
+        filters.append({"memcmp": {"offset": 32, "bytes": b58encode(owner_prefix)}})
+    # withContext, so the response tells the slot the accounts were read at
+    config = {"encoding": ENCODING, "filters": filters, "withContext": True}
+    if ENCODING == 'base64':
+        # Only the owner (offset 32) and amount (offset 64) fields of each account
+        config["dataSlice"] = {"offset": 32, "length": 40}
+    return ["TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA", config]
+
+def get_accounts(pool, mint, context):
+    # Yields the token accounts one at a time, as they are parsed from the response.
+    # context receives the slot of the response.
+    global SHARD_BYTES
+    if SHARD_BYTES > 0:
+        return get_accounts_sharded(pool, mint, SHARD_BYTES, context)
+    return pool.get_program_accounts(*program_accounts_params(mint), context)
+
+def get_shard(pool, mint, prefix, context):
+    for attempt in range(SHARD_ATTEMPTS):
+        try:
+            return list(pool.get_program_accounts(*program_accounts_params(mint, prefix), context))
+        except (RpcError, HttpError, OSError, ValueError, http.client.HTTPException):
+            if attempt == SHARD_ATTEMPTS - 1:
+                raise
+            time.sleep(pool.rate.backoff(attempt))
+
+def get_accounts_sharded(pool, mint, shard_bytes, context):
+    # Split the accounts by the first shard_bytes bytes of their owner, so every
+    # request only scans 1/256 (or 1/65536) of the holders. Shards are fetched
+    # concurrently and merged in prefix order. Shards are read at different slots,
+    # context gets the latest one.
+    global SHARD_CONCURRENCY
+    prefixes = [n.to_bytes(shard_bytes, 'big') for n in range(256 ** shard_bytes)]
+    done = [0]
+    lock = threading.Lock()
+
+    def fetch(prefix):
+        shard_context = {}
+        accounts = get_shard(pool, mint, prefix, shard_context)
+        with lock:
+            if shard_context.get('slot', 0) > context.get('slot', 0):
+                context['slot'] = shard_context['slot']
+            done[0] += 1
+            print(f'\rFetched {done[0]}/{len(prefixes)} shards', end='', flush=True)
+        return accounts
+
+    # At most two shards per worker are fetched ahead of the one being yielded, so a
+    # slow shard doesn't make all the later ones pile up in memory
+    window = deque()
+    pending = iter(prefixes)
+    executor = ThreadPoolExecutor(max_workers=SHARD_CONCURRENCY)
+    try:
+        for prefix in islice(pending, 2 * SHARD_CONCURRENCY):
+            window.append(executor.submit(fetch, prefix))
+        while window:
+            shard = window.popleft().result()
+            prefix = next(pending, None)
+            if prefix is not None:
+                window.append(executor.submit(fetch, prefix))
+            yield from shard
+    except BaseException:
+        for future in window:
+            future.cancel()
+        executor.shutdown(wait=False)
+        print()
+        raise
+    executor.shutdown(wait=True)
+    print()
+
+def get_largest_holders(pool, mint, excluded):
+    # The holders of the mint's largest token accounts: getTokenLargestAccounts, and one
+    # getMultipleAccounts for the owners of those accounts. Returns the holders, the
+    # slot, and whether they are all of the mint's token accounts.
+    global ADDRESS_TYPE
+    result = pool.call('getTokenLargestAccounts', [mint])
+    accounts = result['value']
+    complete = len(accounts) < LARGEST_ACCOUNTS
+    addresses = [acc['address'] for acc in accounts]
+    if ADDRESS_TYPE == 'owner' and addresses:
+        # Only the owner field (offset 32) of each token account
+        owners = pool.get_multiple_accounts(addresses, data_slice=(32, 32))
+        addresses = [b58encode(base64.b64decode(owner['data'][0])) if owner else None
+                     for owner in owners]
+
+    data_dictionary = {}
+    for address, acc in zip(addresses, accounts):
+        if address is None:
+            # Closed since getTokenLargestAccounts
+            complete = False
+        elif address not in excluded:
+            data_dictionary[address] = data_dictionary.get(address, 0) + int(acc['amount'])
+    return data_dictionary, result['context']['slot'], complete
+
+def get_mint_decimals(pool, mint):
+    try:
+        return pool.call('getTokenSupply', [mint])['value']['decimals']
+    except (RpcError, HttpError, OSError, ValueError) as e:
+        sys.exit(f'Failed to fetch the token mint: {e}')
 
 def input_number(prompt):
     while True:
@@ -78,32 +268,505 @@ def display_menu(options):
         choice = input_number("Select an option:\n> ")
     return choice
 
+def read_excluded():
+    # Off-curve owners are not part of it, they are found in bulk by off_curve_owners
+    global EXCLUDED_PATHS
+    try:
+        return Exclusions(EXCLUDED_PATHS)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Failed to read the exclusions: {e}')
+
+def off_curve_owners(addresses):
+    # The off-curve (program derived) addresses among the owners. Every address is
+    # checked once, the results are cached across runs in CurveCache.
+    addresses = list(addresses)
+    return {address for address, off_curve in zip(addresses, CurveCache().classify(addresses))
+            if off_curve}
+
+def open_snapshot_store():
+    global SNAPSHOT_PATH
+    try:
+        return SnapshotStore(SNAPSHOT_PATH)
+    except (OSError, sqlite3.Error) as e:
+        sys.exit(f'Failed to open the snapshot store {SNAPSHOT_PATH}: {e}')
+
+def find_snapshot(store, slot):
+    global TOKEN_MINT
+    try:
+        return store.find(TOKEN_MINT, slot)
+    except ValueError as e:
+        sys.exit(str(e))
+
+def list_snapshots():
+    global TOKEN_MINT
+    store = open_snapshot_store()
+    snapshots = store.list_snapshots(TOKEN_MINT)
+    if not snapshots:
+        print(f'No snapshots of {TOKEN_MINT} in {store.path}')
+    for snapshot in snapshots:
+        print(f'slot {snapshot.slot}  {snapshot.created} UTC  {snapshot.count} token accounts')
+
+def diff_snapshots(old_slot, new_slot):
+    # Write the holders that appeared, left and changed balance between two snapshots
+    global ADDRESS_TYPE, TOKEN, TOKEN_MINT, EXCLUDE_OFF_CURVE
+    store = open_snapshot_store()
+    old = find_snapshot(store, old_slot)
+    new = find_snapshot(store, new_slot)
+    excluded = read_excluded()
+    old_holdings = {address: amount for address, amount in store.holdings(old, ADDRESS_TYPE).items()
+                    if address not in excluded}
+    new_holdings = {address: amount for address, amount in store.holdings(new, ADDRESS_TYPE).items()
+                    if address not in excluded}
+    if EXCLUDE_OFF_CURVE:
+        off_curve = off_curve_owners(old_holdings.keys() | new_holdings.keys())
+        old_holdings = {address: amount for address, amount in old_holdings.items()
+                        if address not in off_curve}
+        new_holdings = {address: amount for address, amount in new_holdings.items()
+                        if address not in off_curve}
+    new_holders, exited, changed = diff_holdings(old_holdings, new_holdings)
+
+    token_name = TOKEN if TOKEN != TOKEN_MINT else TOKEN_MINT[:5]
+    folder = f'./{token_name}-diff-{old.slot}-{new.slot}/'
+    os.makedirs(folder, exist_ok=True)
+    with open(folder + 'new-holders.txt', 'w') as f:
+        for address, _, amount in new_holders:
+            f.write(f'{address},{format_amount(amount, new.decimals)}\n')
+    with open(folder + 'exited-holders.txt', 'w') as f:
+        for address, amount, _ in exited:
+            f.write(f'{address},{format_amount(amount, old.decimals)}\n')
+    with open(folder + 'balance-changes.txt', 'w') as f:
+        for address, before, after in changed:
+            f.write(f'{address},{format_amount(before, old.decimals)},{format_amount(after, new.decimals)}\n')
+    print(f'Slot {old.slot} -> {new.slot}: {len(new_holders)} new holders, '
+          f'{len(exited)} exited, {len(changed)} balance changes, written to {folder}')
+
+def subscribe(url, events):
+    # Subscribe to changes of the mint's token accounts. A reader thread puts every
+    # notification in events, and ('closed', error) when the connection is lost.
+    global TOKEN_MINT
+    ws = WebSocket(url)
+    program, config = program_accounts_params(TOKEN_MINT)
+    config = dict(config, commitment='confirmed')
+    ws.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'programSubscribe',
+                        'params': [program, config]}))
+    reply = json.loads(ws.recv())
+    if 'error' in reply:
+        ws.close()
+        err = reply['error']
+        raise RpcError(err.get('code'), err.get('message'), err.get('data'))
+
+    def read():
+        try:
+            while True:
+                message = json.loads(ws.recv())
+                if message.get('method') == 'programNotification':
+                    events.put(('account', message['params']['result']))
+        except (OSError, ValueError) as e:
+            events.put(('closed', (ws, e)))
+
+    threading.Thread(target=read, daemon=True).start()
+    return ws
+
+def bootstrap(pool, store, decimals):
+    # Fetch all accounts once, into a new index and snapshot
+    global TOKEN_MINT
+    index = HolderIndex()
+    writer = store.writer(TOKEN_MINT, decimals)
+    context = {}
+    try:
+        for acc in get_accounts(pool, TOKEN_MINT, context):
+            fields = account_fields(acc)
+            writer.add(*fields)
+            index.add(*fields)
+        slot = context['slot'] if 'slot' in context else pool.call('getSlot')
+        snapshot = writer.close(slot)
+    except BaseException:
+        writer.abort()
+        raise
+    index.set_base(slot)
+    return index, snapshot
+
+def checkpoint(store, index, snapshot):
+    rows, removed = index.changes()
+    if rows or removed or index.slot != snapshot.slot:
+        store.update(snapshot, rows, index.slot, removed)
+
+def watch_stdin(events, menu_done):
+    # Every line on stdin asks for address lists from the live index
+    while sys.stdin.readline():
+        menu_done.clear()
+        events.put(('menu', None))
+        menu_done.wait()
+
+def live_menu(index, decimals):
+    global ADDRESS_TYPE
+    excluded = read_excluded()
+    data_dictionary = {address: amount
+                       for address, amount in index.holdings(ADDRESS_TYPE).items()
+                       if address not in excluded}
+    folder = output_folder()
+    os.makedirs(folder, exist_ok=True)
+    filter_menu(data_dictionary, folder, decimals, index.slot)
+    print(f'Address lists of slot {index.slot} written to {folder}')
+
+def follow(ws, events, menu_done, index, snapshot, store, decimals):
+    # Apply notifications to the index until the connection is lost
+    global CHECKPOINT_INTERVAL
+    updates = 0
+    next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+    next_ping = time.monotonic() + PING_INTERVAL
+    while True:
+        timeout = max(0, min(next_checkpoint, next_ping) - time.monotonic())
+        try:
+            kind, value = events.get(timeout=timeout)
+        except queue.Empty:
+            kind, value = None, None
+        if kind == 'account':
+            account, slot = value['value'], value['context']['slot']
+            if is_closed(account):
+                applied = index.close(account['pubkey'], slot)
+            else:
+                applied = index.apply(*account_fields(account), slot)
+            if applied:
+                updates += 1
+        elif kind == 'closed' and value[0] is ws:
+            checkpoint(store, index, snapshot)
+            print(f'\nLost the websocket connection: {value[1]}')
+            return
+        elif kind == 'menu':
+            checkpoint(store, index, snapshot)
+            print()
+            live_menu(index, decimals)
+            menu_done.set()
+        now = time.monotonic()
+        if now >= next_ping:
+            ws.ping()
+            next_ping = now + PING_INTERVAL
+        if now >= next_checkpoint:
+            checkpoint(store, index, snapshot)
+            next_checkpoint = now + CHECKPOINT_INTERVAL
+            print(f'\rSlot {snapshot.slot}: {len(index)} token accounts, {updates} updates',
+                  end='', flush=True)
+
+def watch_menu():
+    # Keep a holder index of the mint current from programSubscribe notifications,
+    # saved to the snapshot store every CHECKPOINT_INTERVAL seconds
+    global ENDPOINT, TOKEN_MINT, WS_URL
+    pool = RpcPool(ENDPOINT, timeout=GET_ACCOUNTS_TIMEOUT, rate=RateController())
+    decimals = get_mint_decimals(pool, TOKEN_MINT)
+    store = open_snapshot_store()
+    url = WS_URL or ws_url(parse_urls(ENDPOINT)[0])
+    events = queue.Queue()
+    menu_done = threading.Event()
+    threading.Thread(target=watch_stdin, args=(events, menu_done), daemon=True).start()
+
+    index = snapshot = None
+    while True:
+        ws = None
+        try:
+            # Subscribe first, so nothing that changes during the bootstrap is missed
+            ws = subscribe(url, events)
+            print(f'Subscribed to {url}, fetching all token accounts')
+            index, snapshot = bootstrap(pool, store, decimals)
+            print(f'Watching {len(index)} token accounts from slot {snapshot.slot}. Press '
+                  'Enter to write address lists, Ctrl+C to stop.')
+            follow(ws, events, menu_done, index, snapshot, store, decimals)
+        except KeyboardInterrupt:
+            if index is not None:
+                checkpoint(store, index, snapshot)
+                print(f'\nStopped, the snapshot of slot {snapshot.slot} is in {store.path}')
+            return
+        except (RpcError, HttpError, OSError, ValueError, KeyError,
+                http.client.HTTPException) as e:
+            print(f'\nWatch failed: {e}')
+        finally:
+            if ws is not None:
+                ws.close()
+        time.sleep(RECONNECT_DELAY)
+
 #region Menus
 def top_menu():
-    global ENDPOINT, TOKEN_MINT, TOKEN, EXCLUDED_PATH
-    raw_data = get_accounts(ENDPOINT, TOKEN_MINT)['result']
-
-    # Remove excluded
-    if EXCLUDED_PATH != '':
-        with open(EXCLUDED_PATH, 'r') as f:
-            excluded = f.read().splitlines()
-        data = [acc for acc in raw_data if extract_owner(acc) not in excluded]
-    else:
-        data = raw_data
+    global ENDPOINT, TOKEN_MINT, TOKEN, SAVE_SNAPSHOT, RAW_FORMAT, FULL_SCAN
+    pool = RpcPool(ENDPOINT, timeout=GET_ACCOUNTS_TIMEOUT, rate=RateController())
+    decimals = get_mint_decimals(pool, TOKEN_MINT)
+    excluded = read_excluded()
+    # Asked for before the accounts are fetched, a small top N doesn't need all of them
+    selection = choose_selection(decimals)
+    if (not FULL_SCAN and is_largest_selection(selection)
+            and largest_menu(pool, decimals, excluded, selection)):
+        return
+
+    folder = output_folder()
+    os.makedirs(folder, exist_ok=True)
+    raw_filename = folder + RAW_FORMATS[RAW_FORMAT] if RAW_FORMAT != 'none' else None
+    snapshot = None
+    if SAVE_SNAPSHOT:
+        store = open_snapshot_store()
+        snapshot = store.writer(TOKEN_MINT, decimals)
+
+    # Simplify the data with respect to the selected address-type, remove excluded
+    # and eliminate duplicates while the accounts are streamed from the RPC
+    data_dictionary = {}
+    context = {}
+    try:
+        accounts = get_accounts(pool, TOKEN_MINT, context)
+        if raw_filename is not None:
+            accounts = write_raw(accounts, raw_filename)
+        for acc in accounts:
+            if snapshot is not None:
+                snapshot.add(*account_fields(acc))
+            address, balance = parse_account(acc)
+            if address in excluded:
+                continue
+            if address not in data_dictionary:
+                data_dictionary[address] = balance
+            else:
+                data_dictionary[address] += balance
+        # Fall back to the current slot if the RPC ignored withContext
+        slot = context['slot'] if 'slot' in context else pool.call('getSlot')
+        if snapshot is not None:
+            snapshot.close(slot)
+            print(f'Saved a snapshot of slot {slot} to {store.path}')
+    except (RpcError, HttpError, OSError, ValueError, KeyError, sqlite3.Error,
+            http.client.HTTPException) as e:
+        if snapshot is not None:
+            snapshot.abort()
+        if raw_filename is not None and os.path.exists(raw_filename):
+            os.remove(raw_filename)
+        os.rmdir(folder)
+        sys.exit(f'Failed to fetch the token accounts: {e}')
+
+    filter_menu(data_dictionary, folder, decimals, slot, selection)
+
+def is_largest_selection(selection):
+    # A top N that the largest token accounts can answer: N is at most LARGEST_ACCOUNTS,
+    # and the filters are lower bounds, which keep the largest balances
+    filters, top_n, _, sample_n = selection
+    return (top_n is not None and top_n <= LARGEST_ACCOUNTS and sample_n is None
+            and all(op in (operator.gt, operator.ge) for op, _ in filters))
+
+def largest_menu(pool, decimals, excluded, selection):
+    # Same as top_menu for a small top N, from the largest token accounts only. Returns
+    # False if they are not enough to be sure of the top N (too many are excluded or
+    # filtered out), then every account has to be fetched.
+    global TOKEN_MINT, ADDRESS_TYPE, EXCLUDE_OFF_CURVE
+    try:
+        data_dictionary, slot, complete = get_largest_holders(pool, TOKEN_MINT, excluded)
+    except (RpcError, HttpError, OSError, ValueError, KeyError, TypeError,
+            http.client.HTTPException) as e:
+        print(f'Failed to fetch the largest token accounts ({e}), fetching all of them')
+        return False
+
+    filters, top_n, _, _ = selection
+    candidates = data_dictionary
+    if ADDRESS_TYPE == 'owner' and EXCLUDE_OFF_CURVE:
+        off_curve = off_curve_owners(data_dictionary)
+        candidates = {address: amount for address, amount in data_dictionary.items()
+                      if address not in off_curve}
+    indices, _ = select(array('Q', candidates.values()), filters)
+    if len(indices) < top_n and not complete:
+        print(f'Fewer than {top_n} of the {LARGEST_ACCOUNTS} largest token accounts are left, '
+              'fetching all of them')
+        return False
 
-    # Simplify the data with respect to the selected address-type
-    data_list = map(lambda acc: [extract_owner(acc), extract_balance(acc)], data)
+    folder = output_folder()
+    os.makedirs(folder, exist_ok=True)
+    filter_menu(data_dictionary, folder, decimals, slot, selection)
+    print(f'Top {top_n} from the largest token accounts at slot {slot} written to {folder} '
+          '(no snapshot or raw file)')
+    return True
 
-    # Eliminate duplicates
+def fetch_holders(pool, mint, excluded, raw_filename):
+    # Holders of one mint for multi_menu, in a worker thread: (holders, decimals, slot)
+    decimals = pool.call('getTokenSupply', [mint])['value']['decimals']
     data_dictionary = {}
-    for address, balance in data_list:
+    context = {}
+    accounts = get_accounts(pool, mint, context)
+    if raw_filename is not None:
+        accounts = write_raw(accounts, raw_filename)
+    for acc in accounts:
+        address, balance = parse_account(acc)
+        if address in excluded:
+            continue
         if address not in data_dictionary:
-            data_dictionary[address] = float(balance)
+            data_dictionary[address] = balance
         else:
-            data_dictionary[address] += float(balance)
+            data_dictionary[address] += balance
+    slot = context['slot'] if 'slot' in context else pool.call('getSlot')
+    return data_dictionary, decimals, slot
+
+def multi_menu(mints):
+    # Holders of several mints, fetched at the same time over one pool of keep-alive
+    # connections. Every mint gets its own address lists in a subfolder (the same
+    # filters apply to all of them), and the owners of all the lists are merged into
+    # union and intersection lists, with their balance of every mint.
+    global ENDPOINT, RAW_FORMAT, MINT_CONCURRENCY
+    pool = RpcPool(ENDPOINT, timeout=GET_ACCOUNTS_TIMEOUT, rate=RateController())
+    excluded = read_excluded()
+    folder = f'./multi-{get_current_utc_time_str()}/'
+    for mint in mints:
+        os.makedirs(folder + mint, exist_ok=True)
+
+    def fetch(mint):
+        raw_filename = folder + mint + '/' + RAW_FORMATS[RAW_FORMAT] if RAW_FORMAT != 'none' else None
+        result = fetch_holders(pool, mint, excluded, raw_filename)
+        print(f'Fetched {len(result[0])} holders of {mint}')
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(mints), MINT_CONCURRENCY)) as executor:
+            results = list(executor.map(fetch, mints))
+    except (RpcError, HttpError, OSError, ValueError, KeyError,
+            http.client.HTTPException) as e:
+        sys.exit(f'Failed to fetch the token accounts: {e}')
+
+    lists = []
+    for mint, (data_dictionary, decimals, slot) in zip(mints, results):
+        data, off_curve = select_holders(data_dictionary, mint_selection(decimals))
+        write_files(data, f'{folder}{mint}/', decimals, slot, mint)
+        if off_curve:
+            write_off_curve(data, off_curve, f'{folder}{mint}/', decimals)
+        lists.append(data)
+
+    combined = merge_holders(lists)
+    in_all = set.intersection(*({owner for owner, _ in data} for data in lists))
+    decimals = [result[1] for result in results]
+    write_combined(folder + 'union', mints, decimals, combined, combined)
+    write_combined(folder + 'intersection', mints, decimals, combined, in_all)
+    for mint, data in zip(mints, lists):
+        print(f'{mint}: {len(data)} holders')
+    print(f'{len(combined)} owners hold at least one of the tokens, {len(in_all)} hold all of them. '
+          f'Address lists written to {folder}')
 
-    # We need to convert this back to a list so we can sort it :(
-    data_list = list(data_dictionary.items())
+def mint_selection(decimals):
+    # The scripted filters in the base units of one mint, or every positive balance:
+    # there is no menu for several mints
+    if scripted_filters():
+        return choose_selection(decimals)
+    return [(operator.gt, 0)], None, None, None
+
+def merge_holders(lists):
+    # owner -> balance (base units) of every mint, 0 for the mints it's not listed in.
+    # One pass over all the lists.
+    combined = {}
+    zeros = bytes(8 * len(lists))
+    for i, data in enumerate(lists):
+        for owner, amount in data:
+            balances = combined.get(owner)
+            if balances is None:
+                balances = combined[owner] = array('Q', zeros)
+            balances[i] += amount
+    return combined
+
+def write_combined(base, mints, decimals, combined, owners):
+    # base.txt with one owner per line, for the distributors, and base.csv with the
+    # owner's balance of every mint
+    with open(base + '.txt', 'w') as f, open(base + '.csv', 'w') as fb:
+        fb.write('owner,' + ','.join(mints) + '\n')
+        for owner in owners:
+            balances = combined[owner]
+            f.write(owner + '\n')
+            fb.write(owner + ',' + ','.join(format_amount(balance, d)
+                                            for balance, d in zip(balances, decimals)) + '\n')
+
+def snapshot_menu(slot):
+    # Same as top_menu, with the accounts of a stored snapshot instead of the RPC
+    global ADDRESS_TYPE
+    store = open_snapshot_store()
+    snapshot = find_snapshot(store, slot)
+    print(f'Using the snapshot of slot {snapshot.slot} ({snapshot.created} UTC)')
+    excluded = read_excluded()
+
+    data_dictionary = {}
+    for token_account, owner, amount in store.accounts(snapshot):
+        address = owner if ADDRESS_TYPE == 'owner' else token_account
+        if address in excluded:
+            continue
+        if address not in data_dictionary:
+            data_dictionary[address] = amount
+        else:
+            data_dictionary[address] += amount
+
+    folder = output_folder()
+    os.makedirs(folder, exist_ok=True)
+    filter_menu(data_dictionary, folder, snapshot.decimals, snapshot.slot)
+
+def raw_menu(path):
+    # Same as top_menu, with the accounts of the raw file of an earlier fetch instead of
+    # getProgramAccounts. The RPC is only asked for the mint's decimals.
+    global ENDPOINT, TOKEN_MINT
+    pool = RpcPool(ENDPOINT, rate=RateController())
+    decimals = get_mint_decimals(pool, TOKEN_MINT)
+    excluded = read_excluded()
+
+    data_dictionary = {}
+    try:
+        for acc in read_raw(path):
+            address, balance = parse_account(acc)
+            if address in excluded:
+                continue
+            if address not in data_dictionary:
+                data_dictionary[address] = balance
+            else:
+                data_dictionary[address] += balance
+    except (OSError, ValueError, KeyError, EOFError) as e:
+        sys.exit(f'Failed to read the raw accounts in {path}: {e}')
+
+    folder = output_folder()
+    os.makedirs(folder, exist_ok=True)
+    # The slot of the raw file is not known
+    filter_menu(data_dictionary, folder, decimals, 0)
+
+def filter_menu(data_dictionary, folder, decimals, slot, selection=None):
+    # selection is asked for (or read from the arguments) if it's not given
+    if selection is None:
+        selection = choose_selection(decimals)
+    data, off_curve = select_holders(data_dictionary, selection)
+    write_files(data, folder, decimals, slot)
+    if off_curve:
+        write_off_curve(data, off_curve, folder, decimals)
+
+def select_holders(data_dictionary, selection):
+    # Columns of the holders, filtered by index. Balances are raw amounts (base units).
+    # Returns the selected (address, balance) pairs, and the off-curve owners to tag.
+    global ADDRESS_TYPE, EXCLUDE_OFF_CURVE, CURVE_CHECK
+    off_curve = set()
+    if ADDRESS_TYPE == 'owner' and (CURVE_CHECK or EXCLUDE_OFF_CURVE):
+        off_curve = off_curve_owners(data_dictionary)
+        if EXCLUDE_OFF_CURVE:
+            data_dictionary = {address: amount for address, amount in data_dictionary.items()
+                               if address not in off_curve}
+            print(f'Removed {len(off_curve)} off-curve owners')
+            off_curve = set()
+    addresses = list(data_dictionary)
+    balances = array('Q', data_dictionary.values())
+    indices = apply_selection(balances, selection)
+    return [(addresses[i], balances[i]) for i in indices], off_curve
+
+def write_off_curve(data, off_curve, folder, decimals):
+    # Tag the off-curve owners of the list: no one holds their private key, tokens sent
+    # to them go to the program (pool, vault, escrow...) that owns the address
+    global OUTPUT_FILE
+    filename = folder + OUTPUT_FILE + "-off-curve.txt"
+    tagged = [acc for acc in data if acc[0] in off_curve]
+    with open(filename, 'w') as f:
+        for acc in tagged:
+            f.write(f'{acc[0]},{format_amount(acc[1], decimals)}\n')
+    if tagged:
+        print(f'{len(tagged)} of the {len(data)} owners are off-curve (program derived) '
+              f'addresses, listed in {filename}. Use --exclude-off-curve to remove them.')
+
+def scripted_filters():
+    global FILTERS, TOP, BOTTOM, SAMPLE
+    return bool(FILTERS) or TOP is not None or BOTTOM is not None or SAMPLE is not None
+
+def choose_selection(decimals):
+    # The holders to keep, as (filters, top N, bottom N, sample N): from the arguments,
+    # or from the menus. Filter values are in base units.
+    global FILTERS, TOP, BOTTOM, SAMPLE, TOKEN
+    if scripted_filters():
+        filters = [(op, in_base_units(value, decimals)) for op, value in FILTERS]
+        return filters, TOP, BOTTOM, SAMPLE
 
     print("\nSelect a filtering option for users:")
     menu_items = [
@@ -114,15 +777,32 @@ def top_menu():
     choice = display_menu(menu_items)
 
     if choice == 1:
-        filtered_list = all_submenu(data_list)
+        return all_submenu()
     elif choice == 2:
-        filtered_list = positive_balance_submenu(data_list)
+        return positive_balance_submenu(decimals)
     else:
-        filtered_list = no_tokens_submenu(data_list)
+        return no_tokens_submenu()
 
-    write_files(filtered_list, raw_data)
+def apply_selection(balances, selection):
+    # The filters, then top or bottom N, then a sample of N; sorted by balance
+    filters, top_n, bottom_n, sample_n = selection
+    indices, column = select(balances, filters)
+    if top_n is not None:
+        indices = top(indices, column, top_n)
+    elif bottom_n is not None:
+        indices = bottom(indices, column, bottom_n)
+    if sample_n is not None:
+        indices = random_users(indices, sample_n)
+    return by_balance(balances, indices)
 
-def positive_balance_submenu(data):
+def random_users(indices, n):
+    global SEED
+    try:
+        return sample(indices, int(n), SEED)
+    except ValueError:
+        sys.exit('Failed to get random users, try using a smaller N value.')
+
+def positive_balance_submenu(decimals):
     menu_items = [
         f'Get all users',
         f'Get top N users by balance',
@@ -134,85 +814,60 @@ def positive_balance_submenu(data):
         f'Get users with less than X and more than or equal to Y tokens'
     ]
     choice = display_menu(menu_items)
-    filtered = list(filter(lambda acc: acc[1] > 0, data))  
-    if choice == 1:
-        pass
+    positive = (operator.gt, 0)
+    filters = [positive]
+    top_n = bottom_n = sample_n = None
     if choice == 2:
-        n = input_number('> N=')
-        filtered.sort(key=lambda acc: acc[1], reverse=True)
-        filtered = filtered[:int(n)]
+        top_n = int(input_number('> N='))
     if choice == 3:
-        n = input_number('> N=')
-        filtered.sort(key=lambda acc: acc[1], reverse=False)
-        filtered = filtered[:int(n)]
+        bottom_n = int(input_number('> N='))
     if choice == 4:
-        n = input_number("> N=")
-        try:
-            filtered = random.sample(filtered, int(n))
-        except ValueError:
-            sys.exit('Failed to get random users, try using a smaller N value.')
+        sample_n = input_number("> N=")
     if choice == 5:
-        x = input_number("> X=")
-        filtered = list(filter(lambda acc: acc[1] > x, filtered)) 
+        x = in_base_units(input_number("> X="), decimals)
+        filters.append((operator.gt, x))
     if choice == 6:
-        x = input_number("> X=")
-        filtered = list(filter(lambda acc: acc[1] >= x, filtered))   
+        x = in_base_units(input_number("> X="), decimals)
+        filters.append((operator.ge, x))
     if choice == 7:
-        x = input_number("> X=")
-        filtered = list(filter(lambda acc: acc[1] < x
-            and acc[1] > 0, filtered))  
+        x = in_base_units(input_number("> X="), decimals)
+        filters.append((operator.lt, x))
     if choice == 8:
-        x = input_number("> X=")
-        y = input_number("> Y=")
-        filtered = list(filter(lambda acc: acc[1] < x 
-            and acc[1] >= y, filtered))
+        x = in_base_units(input_number("> X="), decimals)
+        y = in_base_units(input_number("> Y="), decimals)
+        filters += [(operator.lt, x), (operator.ge, y)]
 
-    filtered.sort(key=lambda acc: acc[1], reverse=True)
-    return filtered
+    return filters, top_n, bottom_n, sample_n
 
-def all_submenu(data):
+def all_submenu():
     menu_items = [
         f'Get all users that created a token address',
         f'Get N random users that created a token address'
     ]
     choice = display_menu(menu_items)
-    if choice == 1:
-        filtered = data
-    else:
-        n = input_number("N=")
-        try:
-            filtered = random.sample(data, int(n))
-        except ValueError:
-            sys.exit('Failed to get random users, try using a smaller N value.')
-    # Sort by balance before writing
-    filtered.sort(key=lambda acc: acc[1], reverse=True)
-    return filtered
+    sample_n = None
+    if choice == 2:
+        sample_n = input_number("N=")
+    return [], None, None, sample_n
 
-def no_tokens_submenu(data):
+def no_tokens_submenu():
     menu_items = [
         f'Get all users with 0 tokens',
         f'Get N random users with 0 tokens'
     ]
     choice = display_menu(menu_items)
-    if choice == 1:
-        filtered = [acc for acc in data if acc[1] == 0]
-    else:
-        n = input_number("N=")
-        filtered = [acc for acc in data if acc[1] == 0]
-        try:
-            filtered = random.sample(filtered, int(n))
-        except ValueError:
-            sys.exit('Failed to get random users, try using a smaller N value.')
-    return filtered
+    sample_n = None
+    if choice == 2:
+        sample_n = input_number("N=")
+    return [(operator.eq, 0)], None, None, sample_n
 #endregion
 
 def get_token_name(mint):
-    response = requests.get(token_repos['github_token_list'])
-    data = json.loads(response.text)
-    for token in data['tokens']:
-        if token['address'] == mint:
-            return True, token['symbol']
-    return False, None
+    # From the cached token list, see common/token_list.py
+    global OFFLINE_TOKEN_LIST
+    token_list = TokenList([token_repos['github_token_list'], token_repos['cdn_token_list']])
+    symbol = token_list.symbol(mint, offline=OFFLINE_TOKEN_LIST)
+    return symbol is not None, symbol
 
 #region Argument parsing
 parser = argparse.ArgumentParser(
@@ -224,7 +879,22 @@ parser.add_argument(
     '--mint',
     required=False,
     default = '',
-    help='Mint address of the SPL token'
+    help='Mint address of the SPL token. Several mints can be given, separated by \
+        commas, for the lists of each mint and of the owners of any or all of them.'
+)
+parser.add_argument(
+    '--mint-file',
+    dest='mint_file',
+    required=False,
+    help='Path to a file of mint addresses, one per line, used like several -m mints.'
+)
+parser.add_argument(
+    '--mint-concurrency',
+    dest='mint_concurrency',
+    type=int,
+    default=4,
+    required=False,
+    help='Number of mints fetched at the same time, with several mints (default: 4).'
 )
 parser.add_argument(
     '-t',
@@ -242,17 +912,215 @@ parser.add_argument(
     type=str,
     dest='url',
     default = '',
-    help='URL of the Solana RPC endpoint.'
+    help='URL of the Solana RPC endpoint. Several endpoints can be given, separated by \
+        commas, the request is sent to the healthiest one and fails over to the others.'
 )
 parser.add_argument(
     '-e',
     '--excluded',
     dest="excluded",
+    action='append',
     required=False,
-    default = '',
+    default=[],
     help='Path to the file that contains all addresses that will be removed from the \
-        final list. Each address should be in a seperate line, and the file must be \
-        UTF-8 encoded.'
+        final list. Each address should be in a seperate line (or first on a CSV line, \
+        e.g. a success log), and the file must be UTF-8 encoded. A binary address list \
+        works too. Can be repeated.'
+)
+parser.add_argument(
+    '--exclude-off-curve',
+    dest='exclude_off_curve',
+    action='store_true',
+    default=False,
+    required=False,
+    help='Remove owners that are off-curve addresses (program derived addresses, e.g. \
+        pools, vaults and other contract wallets). Only with the owner address type.'
+)
+parser.add_argument(
+    '--full-scan',
+    dest='full_scan',
+    action='store_true',
+    default=False,
+    required=False,
+    help='Fetch every token account for a top N of at most 20 as well, instead of \
+        only the largest token accounts. Also counts the other token accounts of the \
+        largest owners.'
+)
+parser.add_argument(
+    '--no-curve-check',
+    dest='curve_check',
+    action='store_false',
+    default=True,
+    required=False,
+    help='Do not check which owners are off-curve. By default they are listed in \
+        address-list-off-curve.txt.'
+)
+parser.add_argument(
+    '--encoding',
+    dest='encoding',
+    choices={'base64', 'jsonParsed'},
+    default='base64',
+    required=False,
+    help='Account encoding requested from the RPC. base64 (default) only fetches the owner \
+        and amount of each token account and decodes them locally, jsonParsed fetches the \
+        whole parsed account. Both produce the same address lists.'
+)
+parser.add_argument(
+    '--shard-bytes',
+    dest='shard_bytes',
+    type=int,
+    choices={0, 1, 2},
+    default=0,
+    required=False,
+    help='Split the request by the first bytes of the owner address, for tokens with too \
+        many holders to fetch at once: 1 makes 256 requests, 2 makes 65536. Each shard \
+        is retried on its own. Default: 0 (a single request).'
+)
+parser.add_argument(
+    '--shard-concurrency',
+    dest='shard_concurrency',
+    type=int,
+    default=8,
+    required=False,
+    help='Number of shards fetched at the same time (default: 8).'
+)
+parser.add_argument(
+    '--snapshot-db',
+    dest='snapshot_db',
+    default=SNAPSHOT_DB,
+    required=False,
+    help=f'Path to the snapshot store, a SQLite database (default: {SNAPSHOT_DB}).'
+)
+parser.add_argument(
+    '--no-snapshot',
+    dest='save_snapshot',
+    action='store_false',
+    help='Do not save the fetched token accounts to the snapshot store.'
+)
+parser.add_argument(
+    '--list-snapshots',
+    dest='list_snapshots',
+    action='store_true',
+    help='List the stored snapshots of the mint and exit.'
+)
+parser.add_argument(
+    '--from-snapshot',
+    dest='from_snapshot',
+    metavar='SLOT',
+    default=None,
+    required=False,
+    help='Create the address lists from the stored snapshot of this slot (or "latest") \
+        instead of fetching the token accounts from the RPC.'
+)
+parser.add_argument(
+    '--diff',
+    dest='diff',
+    nargs=2,
+    metavar=('OLD', 'NEW'),
+    default=None,
+    required=False,
+    help='Compare two stored snapshots, given by slot, "latest" or "previous", and write \
+        the new holders, exited holders and balance changes.'
+)
+parser.add_argument(
+    '--watch',
+    dest='watch',
+    action='store_true',
+    help='Fetch the token accounts once, then keep them current from programSubscribe \
+        notifications, saving the live index to the snapshot store. Press Enter to write \
+        address lists from it.'
+)
+parser.add_argument(
+    '--ws-url',
+    dest='ws_url',
+    default='',
+    required=False,
+    help='Websocket URL used by --watch (default: derived from the first RPC URL).'
+)
+parser.add_argument(
+    '--checkpoint-interval',
+    dest='checkpoint_interval',
+    type=float,
+    default=10,
+    required=False,
+    help='Seconds between saves of the live index to the snapshot store (default: 10).'
+)
+parser.add_argument(
+    '--filter',
+    dest='filters',
+    action='append',
+    type=str,
+    default=[],
+    metavar='EXPR',
+    help='Keep the holders whose balance passes EXPR, e.g. balance>100 (operators: > >= < \
+        <= == !=). Can be repeated, all filters must pass. Any of --filter, --top, --bottom \
+        and --sample replaces the interactive filtering menus.'
+)
+parser.add_argument(
+    '--top',
+    dest='top',
+    type=int,
+    default=None,
+    required=False,
+    help='Keep the N holders with the highest balances (after --filter).'
+)
+parser.add_argument(
+    '--bottom',
+    dest='bottom',
+    type=int,
+    default=None,
+    required=False,
+    help='Keep the N holders with the lowest balances (after --filter).'
+)
+parser.add_argument(
+    '--sample',
+    dest='sample',
+    type=int,
+    default=None,
+    required=False,
+    help='Keep N random holders (after --filter, --top and --bottom).'
+)
+parser.add_argument(
+    '--seed',
+    dest='seed',
+    type=int,
+    default=None,
+    required=False,
+    help='Seed of the random selection, for reproducible samples.'
+)
+parser.add_argument(
+    '--raw-format',
+    dest='raw_format',
+    choices=list(RAW_FORMATS) + ['none'],
+    default='json',
+    required=False,
+    help='Format of the raw accounts file: raw.json (json, default), newline-delimited JSON \
+        (ndjson), compressed with gzip (raw.ndjson.gz) or zstd (raw.ndjson.zst), or none.'
+)
+parser.add_argument(
+    '--from-raw',
+    dest='from_raw',
+    metavar='RAW_FILE',
+    default=None,
+    required=False,
+    help='Create the address lists from the raw accounts file of an earlier fetch, in any \
+        of the raw formats, instead of fetching the accounts.'
+)
+parser.add_argument(
+    '--offline-token-list',
+    dest='offline_token_list',
+    action='store_true',
+    default=False,
+    required=False,
+    help='Resolve the token name from the cached token list only, without downloading it.'
+)
+parser.add_argument(
+    '--export',
+    dest='export',
+    metavar='LIST',
+    default=None,
+    required=False,
+    help='Write the text files (addresses, and addresses with balances) of a binary address list and exit.'
 )
 #endregion
 
@@ -269,18 +1137,84 @@ token_repos = {
 ENDPOINT = ""
 TOKEN_MINT = TOKEN = ""
 ADDRESS_TYPE = ""
+EXCLUDED_PATHS = []
+EXCLUDE_OFF_CURVE = False
+CURVE_CHECK = True
+FULL_SCAN = False
+MINT_CONCURRENCY = 4
+ENCODING = 'base64'
+SHARD_BYTES = 0
+SHARD_CONCURRENCY = 8
+SAVE_SNAPSHOT = True
+SNAPSHOT_PATH = SNAPSHOT_DB
+WS_URL = ''
+CHECKPOINT_INTERVAL = 10
+FILTERS = []
+TOP = BOTTOM = SAMPLE = SEED = None
+OFFLINE_TOKEN_LIST = False
+RAW_FORMAT = 'json'
 OUTPUT_FILE = 'address-list'
 
 def main():
-    global ENDPOINT, TOKEN_MINT, TOKEN, ADDRESS_TYPE, EXCLUDED_PATH
+    global ENDPOINT, TOKEN_MINT, TOKEN, ADDRESS_TYPE, EXCLUDED_PATHS, EXCLUDE_OFF_CURVE, CURVE_CHECK, ENCODING, SHARD_BYTES, SHARD_CONCURRENCY
+    global SAVE_SNAPSHOT, SNAPSHOT_PATH, WS_URL, CHECKPOINT_INTERVAL
+    global FILTERS, TOP, BOTTOM, SAMPLE, SEED, OFFLINE_TOKEN_LIST, RAW_FORMAT, FULL_SCAN, MINT_CONCURRENCY
 
     args = parser.parse_args()
+    if args.export is not None:
+        export_list(args.export)
+        return
+    try:
+        FILTERS = [parse_filter(expr) for expr in args.filters]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.top is not None and args.bottom is not None:
+        parser.error('--top and --bottom can not be used together')
+    TOP, BOTTOM, SAMPLE, SEED = args.top, args.bottom, args.sample, args.seed
+    if args.raw_format == 'zstd' and not zstd_available():
+        parser.error('--raw-format zstd needs Python 3.14 or the zstandard package')
+    RAW_FORMAT = args.raw_format
+    WS_URL = args.ws_url
+    OFFLINE_TOKEN_LIST = args.offline_token_list
+    CHECKPOINT_INTERVAL = max(1, args.checkpoint_interval)
+    SAVE_SNAPSHOT = args.save_snapshot
+    SNAPSHOT_PATH = args.snapshot_db
+    ENCODING = args.encoding
+    SHARD_BYTES = args.shard_bytes
+    SHARD_CONCURRENCY = max(1, args.shard_concurrency)
     ENDPOINT = args.url
-    TOKEN_MINT = TOKEN = args.mint
     ADDRESS_TYPE = args.atype
-    EXCLUDED_PATH = args.excluded
+    MINT_CONCURRENCY = max(1, args.mint_concurrency)
+    EXCLUDED_PATHS = args.excluded
+    EXCLUDE_OFF_CURVE = args.exclude_off_curve
+    CURVE_CHECK = args.curve_check
+    FULL_SCAN = args.full_scan
+
+    # Snapshot commands don't use the RPC
+    offline = args.list_snapshots or args.from_snapshot is not None or args.diff is not None
 
-    if ENDPOINT == '':
+    mints = args.mint.replace(',', ' ').split()
+    if args.mint_file is not None:
+        try:
+            with open(args.mint_file) as f:
+                mints += [line.strip() for line in f if line.strip()]
+        except OSError as e:
+            parser.error(f'Failed to read {args.mint_file}: {e}')
+    # Each mint once, in the given order
+    mints = list(dict.fromkeys(mints))
+    if len(mints) > 1:
+        if offline or args.watch or args.from_raw is not None:
+            parser.error('Several mints can only be fetched from the RPC')
+        if ADDRESS_TYPE == 'token':
+            parser.error('Several mints are merged by owner, they need the owner address type')
+        ADDRESS_TYPE = 'owner'
+    TOKEN_MINT = TOKEN = mints[0] if mints else ''
+    # Scripted filtering runs without a TTY, nothing can be prompted for
+    if scripted_filters() and not args.watch:
+        if TOKEN_MINT == '' or ADDRESS_TYPE == '' or (ENDPOINT == '' and not offline):
+            parser.error('--filter, --top, --bottom and --sample need -m, -t and -u (or a snapshot command)')
+
+    if ENDPOINT == '' and not offline:
         print("Select an endpoint ")
         choice = display_menu(list(rpc_endpoints.values()))
         ENDPOINT = rpc_endpoints[list(rpc_endpoints.keys())[int(choice)-1]]
@@ -288,7 +1222,11 @@ def main():
     if TOKEN_MINT == '':
         TOKEN_MINT = input("\nEnter the token mint address:\n> ")
         TOKEN = TOKEN_MINT
-    
+
+    if args.list_snapshots:
+        list_snapshots()
+        return
+
     if ADDRESS_TYPE == '':
         print("\nSelect the address type.")
         choice = display_menu(['Owner account address', 'Token account address'])
@@ -297,10 +1235,16 @@ def main():
         else:
             ADDRESS_TYPE = 'token'
 
-    if EXCLUDED_PATH == '':
+    if EXCLUDE_OFF_CURVE and ADDRESS_TYPE != 'owner':
+        sys.exit('--exclude-off-curve can only be used with the owner address type.')
+    if not EXCLUDED_PATHS:
         print("\nNo exclusion file set, use option -e to set it.")
 
-    if ENDPOINT == rpc_endpoints['mainnet']:
+    if len(mints) > 1:
+        multi_menu(mints)
+        return
+
+    if rpc_endpoints['mainnet'] in parse_urls(ENDPOINT):
         print("\nMainnet endpoint, trying to fetch token name.")
         ok, name = get_token_name(TOKEN_MINT)
         if ok:
@@ -309,7 +1253,16 @@ def main():
         else:
             print('No token name found')
 
-    top_menu()
+    if args.watch:
+        watch_menu()
+    elif args.diff is not None:
+        diff_snapshots(*args.diff)
+    elif args.from_snapshot is not None:
+        snapshot_menu(args.from_snapshot)
+    elif args.from_raw is not None:
+        raw_menu(args.from_raw)
+    else:
+        top_menu()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,3 @@
+# Shared helpers used by the distribution tools (key handling, transaction
+# building and JSON-RPC access). The tools add the parent directory to
+# sys.path and import modules from here, e.g. `from common import rpc`.
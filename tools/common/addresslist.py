@@ -0,0 +1,126 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from common.amounts import format_amount, read_balances
+from common.base58 import b58encode
+from common.keys import pubkey_bytes
+
+# Binary address list, written by address-fetcher and read by the distributors without
+# parsing. A 64 byte header, then two columns:
+#   magic b'DTAL', version (u16), decimals (u8), 1 unused byte, count (u64), slot (u64),
+#   mint (32 bytes), 8 reserved bytes
+#   count 32 byte public keys
+#   count u64 amounts, in base units
+# All integers are little-endian. The amount column starts at a multiple of 8 bytes, so
+# it can be read in place as an array of u64.
+MAGIC = b'DTAL'
+VERSION = 1
+_HEADER = struct.Struct('<4sHBxQQ32s8x')
+HEADER_SIZE = _HEADER.size
+EXTENSION = '.bin'
+
+
+def is_address_list(path):
+    # True if path is a binary address list, rather than text
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_address_list(path, addresses, amounts, mint, decimals, slot=0):
+    # addresses are base58 strings (or 32 raw bytes), amounts are base units
+    amounts = array('Q', amounts)
+    if len(amounts) != len(addresses):
+        raise ValueError('Every address needs an amount')
+    if sys.byteorder != 'little':
+        amounts.byteswap()
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, int(decimals), len(amounts), slot or 0,
+                             pubkey_bytes(mint)))
+        for address in addresses:
+            f.write(pubkey_bytes(address))
+        f.write(amounts.tobytes())
+
+
+class AddressList:
+    # Memory-mapped reader of a binary address list. Opening it only reads the header;
+    # an address or amount is read when it's accessed, so any part of a list (e.g. the
+    # shard of one process) costs the same to get to.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'Not a binary address list: {path}')
+            _, version, self.decimals, self.count, self.slot, mint = _HEADER.unpack(header)
+            if version != VERSION:
+                raise ValueError(f'Unsupported address list version {version}: {path}')
+            size = HEADER_SIZE + self.count * 40
+            if os.fstat(f.fileno()).st_size != size:
+                raise ValueError(f'Truncated address list: {path}')
+            self.mint = b58encode(mint)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        amounts = memoryview(self._map)[HEADER_SIZE + self.count * 32:size]
+        if sys.byteorder == 'little':
+            self.amounts = amounts.cast('Q')
+        else:
+            self.amounts = array('Q', amounts)
+            self.amounts.byteswap()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # The base58 address at index i
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('address list index out of range')
+        return self._address(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._address(i)
+
+    def _address(self, i):
+        start = HEADER_SIZE + i * 32
+        return b58encode(self._map[start:start + 32])
+
+    def shard(self, index, count):
+        # Indices of shard index (0 based) out of count equal, contiguous shards
+        return range(self.count * index // count, self.count * (index + 1) // count)
+
+    def close(self):
+        if isinstance(self.amounts, memoryview):
+            self.amounts.release()
+        self._map.close()
+
+
+def read_addresses(path):
+    # Addresses of a binary address list, or of a text file with one per line
+    if is_address_list(path):
+        return AddressList(path)
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_balances(path, mint, decimals):
+    # Addresses and balances (base units) of a binary address list, or of an
+    # `address,balance` text file. A binary list must be of the same mint and decimals.
+    if not is_address_list(path):
+        return read_balances(path, decimals)
+    address_list = AddressList(path)
+    if address_list.mint != mint or address_list.decimals != int(decimals):
+        raise ValueError(f'{path} is a list of {address_list.mint} with {address_list.decimals} '
+                         f'decimals, not of {mint} with {decimals} decimals')
+    return address_list, address_list.amounts
+
+
+def export_text(address_list, filename, balance_filename):
+    # One address per line, and `address,balance` lines, like address-fetcher's text lists
+    with open(filename, 'w') as f, open(balance_filename, 'w') as fb:
+        for address, amount in zip(address_list, address_list.amounts):
+            f.write(address + '\n')
+            fb.write(f'{address},{format_amount(amount, address_list.decimals)}\n')
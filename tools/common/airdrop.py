@@ -0,0 +1,425 @@
+import functools
+import re
+import threading
+import time
+
+from common.amounts import format_amount, to_base_units
+from common.journal import load_journal, verify_signatures
+from common.pipeline import SendConfirmPipeline
+from common.pool import run_concurrently
+from common.rpc import RpcError, HttpError, is_throttle
+from common.transfer import UNKNOWN_OUTCOME_ERRORS
+
+# Errors in spl-token (and TransferEngine) output that decide how a transfer is logged
+TOO_MANY_REQUESTS = "429 Too Many Requests"
+UNCONFIRMED = "unable to confirm transaction"
+RPC_ERROR = "RPC response error -32005"
+LOG_SEPARATOR = "-" * 30 + "\n"
+# Attempts at an account lookup that failed for another reason than throttling
+LOOKUP_ATTEMPTS = 3
+
+# Serializes log file writes and progress output between transfer workers
+OUTPUT_LOCK = threading.Lock()
+
+OKGREEN = '\033[92m'
+DANGER = '\u001b[38;5;208m'
+FAIL = '\033[91m'
+ENDC = '\033[0m'
+
+
+def parse_sig(log):
+    # Find the last line that has some text in it.
+    # That line should have the signature.
+    outlines = re.split('\n', log)
+    idx = len(outlines) - 1
+    while outlines[idx] == '':
+        idx = idx - 1
+    out = outlines[idx]
+    sig = re.match(r"Signature: ([a-zA-Z0-9]+)", out)
+    if sig:
+        return sig.group(1)
+    else:
+        return 'Error parsing signature - check the detailed logs.'
+
+
+def batch_label(batch):
+    # Positions of the batch's recipients in the drop list, e.g. 7 or 3-7, or 1,3-5
+    # once recipients that failed before sending are left out
+    ranges = []
+    for p in batch:
+        if ranges and ranges[-1][1] + 1 == p.index:
+            ranges[-1][1] = p.index
+        else:
+            ranges.append([p.index, p.index])
+    return ','.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
+def report(prefix, msg, end='\n'):
+    # Sequential transfers finish the line started by the caller, concurrent
+    # workers print whole lines so their output doesn't interleave.
+    if prefix is None:
+        print(msg, end=end, flush=True)
+    else:
+        with OUTPUT_LOCK:
+            print(prefix + msg, flush=True)
+
+
+class NativeTransferCmd:
+    # Same interface as the distributors' TransferCmd, but the transfer is built,
+    # signed and sent in-process by the TransferEngine instead of spawning spl-token.
+    def __init__(self, engine, decimals, drop_amount, recipient, options=None, index=None):
+        self.engine = engine
+        self.index = index
+        self.decimals = decimals
+        self.drop_amount = drop_amount
+        self.recipient = recipient
+        if options is None:
+            self.options = []
+        else:
+            self.options = options
+
+    def to_str(self):
+        return f"native transfer {self.engine.mint} {format_amount(self.drop_amount, self.decimals)} {self.recipient} {' '.join(self.options)}"
+
+    def execute(self):
+        return self.engine.transfer(
+            self.recipient, format_amount(self.drop_amount, self.decimals),
+            fund_recipient='--fund-recipient' in self.options,
+            allow_unfunded_recipient='--allow-unfunded-recipient' in self.options,
+            index=self.index)
+
+
+class Airdrop:
+    # Sends a distribution and writes its outcome to the log files and the journal.
+    # Shared by the flat and proportional distributors: drops are (index, recipient,
+    # amount in base units) triples, however the amounts were computed. The index is
+    # the recipient's position in the input list, counted from 1.
+    def __init__(self, rpc, rate, decimals, journal, log_success, log_unconfirmed, log_failed,
+                 log_canceled, log_full, retry_on_429=False):
+        self.rpc = rpc
+        self.rate = rate
+        self.decimals = decimals
+        self.journal = journal
+        self.log_success = log_success
+        self.log_unconfirmed = log_unconfirmed
+        self.log_failed = log_failed
+        self.log_canceled = log_canceled
+        self.log_full = log_full
+        self.retry_on_429 = retry_on_429
+
+    def ui(self, amount):
+        # Amounts are carried in base units, and formatted for logs and commands
+        return format_amount(amount, self.decimals)
+
+    def record(self, state, transfers, signature='', last_valid_height=''):
+        # Append (index, recipient, amount in base units) triples to the crash-safe journal, if one is open
+        if self.journal is not None:
+            self.journal.write_many(state, [(index, recipient, self.ui(amount)) for index, recipient, amount in transfers],
+                                    signature, last_valid_height)
+
+    def rate_report(self):
+        # Current request rate and throttle events since the last entry, for the detailed log
+        return self.rate.report() if self.rate is not None else ''
+
+    def write_detail(self, log_detail_entry):
+        with OUTPUT_LOCK, open(self.log_full, "a") as lf:
+            lf.write(log_detail_entry + self.rate_report() + LOG_SEPARATOR)
+
+    def throttle_retry(self, prefix, reason, attempt):
+        # Back off before retrying a throttled transfer. Returns False once the retry budget is spent.
+        self.rate.on_throttle(reason)
+        if not self.rate.retry_allowed(attempt):
+            return False
+        delay = self.rate.backoff(attempt)
+        report(prefix, f'{reason}, waiting {delay:.1f}s... ', end='')
+        time.sleep(delay)
+        return True
+
+    def try_transfer(self, cmd, index, addr, drop, prefix=None):
+        # The native backend paces its own requests, a spl-token process takes one token
+        external = not isinstance(cmd, NativeTransferCmd)
+        log_detail_entry = ''
+        self.record('spawned' if external else 'intent', [(index, addr, drop)])
+        attempt = 0
+        while True:
+            if external:
+                self.rate.acquire()
+            code, out, err = cmd.execute()
+            if code == 0:
+                if external:
+                    self.rate.on_success()
+                output = out.decode('utf-8')
+                report(prefix, f'{OKGREEN}SUCCESS{ENDC}')
+                sig = parse_sig(output)
+                self.record('success', [(index, addr, drop)], sig)
+                with OUTPUT_LOCK, open(self.log_success, 'a') as ls:
+                    ls.write(f'{addr},{self.ui(drop)},{sig}\n')
+                log_detail_entry += output + '\n'
+                break
+            else:
+                err_msg = err.decode('utf-8')
+                throttled = RPC_ERROR in err_msg or (self.retry_on_429 and TOO_MANY_REQUESTS in err_msg)
+                if throttled:
+                    log_detail_entry += err_msg + '\n'
+                    if self.throttle_retry(prefix, '-32005 RPC Error' if RPC_ERROR in err_msg else '429', attempt):
+                        attempt += 1
+                        continue
+                # Out of retries, the outcome of a throttled transfer is treated as unknown
+                if throttled or UNCONFIRMED in err_msg or TOO_MANY_REQUESTS in err_msg:
+                    report(prefix, f'{DANGER}UNCONFIRMED{ENDC}')
+                    self.record('unconfirmed', [(index, addr, drop)])
+                    with OUTPUT_LOCK, open(self.log_unconfirmed, "a") as lu:
+                        lu.write(f'{addr},{self.ui(drop)},{err_msg}')
+                    if not throttled:
+                        log_detail_entry += err_msg + '\n'
+                    break
+
+                report(prefix, f'{FAIL}FAILED{ENDC}')
+                try:
+                    err_short = err_msg.split('\n', 1)[0] + '\n'
+                    err_short = re.sub(r"[,]", ' ', err_short)
+                except (IndexError, Exception):
+                    err_short = 'Error parsing error description - read the full logs.\n'
+                finally:
+                    self.record('failed', [(index, addr, drop)])
+                    with OUTPUT_LOCK, open(self.log_failed, 'a') as lfa:
+                        lfa.write(f'{addr},{self.ui(drop)},{err_short}')
+                log_detail_entry += err_msg + '\n'
+                break
+        return log_detail_entry
+
+    def try_transfer_batch(self, engine, batch):
+        if len(batch) == 1:
+            prefix = f"{batch_label(batch)}. Airdrop to {batch[0].recipient}: "
+        else:
+            prefix = f"{batch_label(batch)}. Airdrop to {len(batch)} recipients: "
+        log_detail_entry = ''
+        transfers = [(p.index, p.recipient, p.amount) for p in batch]
+        self.record('intent', transfers)
+        attempt = 0
+        while True:
+            code, out, err = engine.send_batch(batch)
+            if code == 0:
+                output = out.decode('utf-8')
+                report(prefix, f'{OKGREEN}SUCCESS{ENDC}')
+                # Every recipient in the batch shares the transaction signature
+                sig = parse_sig(output)
+                self.record('success', transfers, sig)
+                with OUTPUT_LOCK, open(self.log_success, 'a') as ls:
+                    for p in batch:
+                        ls.write(f'{p.recipient},{p.ui_amount},{sig}\n')
+                log_detail_entry += output + '\n'
+                break
+            else:
+                err_msg = err.decode('utf-8')
+                throttled = RPC_ERROR in err_msg or (self.retry_on_429 and TOO_MANY_REQUESTS in err_msg)
+                if throttled:
+                    log_detail_entry += err_msg + '\n'
+                    if self.throttle_retry(prefix, '-32005 RPC Error' if RPC_ERROR in err_msg else '429', attempt):
+                        attempt += 1
+                        continue
+                # Out of retries, the outcome of a throttled transfer is treated as unknown
+                if throttled or UNCONFIRMED in err_msg or TOO_MANY_REQUESTS in err_msg:
+                    # The transaction may still land, so the batch must not be retried
+                    report(prefix, f'{DANGER}UNCONFIRMED{ENDC}')
+                    self.record('unconfirmed', transfers)
+                    with OUTPUT_LOCK, open(self.log_unconfirmed, "a") as lu:
+                        for p in batch:
+                            lu.write(f'{p.recipient},{p.ui_amount},{err_msg}')
+                    if not throttled:
+                        log_detail_entry += err_msg + '\n'
+                    break
+
+                log_detail_entry += err_msg + '\n'
+                if len(batch) > 1:
+                    # Split the failed batch to isolate the recipients that make it fail
+                    half = len(batch) // 2
+                    report(prefix, f'{FAIL}FAILED{ENDC}, splitting into {half} + {len(batch) - half}')
+                    log_detail_entry += self.try_transfer_batch(engine, batch[:half])
+                    log_detail_entry += self.try_transfer_batch(engine, batch[half:])
+                    break
+
+                report(prefix, f'{FAIL}FAILED{ENDC}')
+                try:
+                    err_short = err_msg.split('\n', 1)[0] + '\n'
+                    err_short = re.sub(r"[,]", ' ', err_short)
+                except (IndexError, Exception):
+                    err_short = 'Error parsing error description - read the full logs.\n'
+                finally:
+                    self.record('failed', transfers)
+                    with OUTPUT_LOCK, open(self.log_failed, 'a') as lfa:
+                        for p in batch:
+                            lfa.write(f'{p.recipient},{p.ui_amount},{err_short}')
+                break
+        return log_detail_entry
+
+    def prepare(self, engine, chunk, fund_recipient, allow_unfunded_recipient):
+        # Nothing was sent yet, so lookups are always safe to retry. If the lookup of
+        # the whole chunk keeps failing, each recipient is looked up on its own, so one
+        # bad recipient or a flaky endpoint doesn't fail the others.
+        attempt = failures = 0
+        while True:
+            try:
+                return engine.prepare([(addr, drop) for _, addr, drop in chunk],
+                                      fund_recipient, allow_unfunded_recipient)
+            except (RpcError, HttpError) + UNKNOWN_OUTCOME_ERRORS as e:
+                if is_throttle(e):
+                    if self.throttle_retry(None, str(e), attempt):
+                        print()
+                        attempt += 1
+                        continue
+                else:
+                    failures += 1
+                    if failures < LOOKUP_ATTEMPTS:
+                        time.sleep(self.rate.backoff(failures) if self.rate is not None else failures)
+                        continue
+                if len(chunk) == 1:
+                    return [(False, f'Error: Account lookup failed: {e}')]
+                break
+        return [result for transfer in chunk
+                for result in self.prepare(engine, [transfer], fund_recipient, allow_unfunded_recipient)]
+
+    def prepared_batches(self, engine, drops, batch_size, fund_recipient, allow_unfunded_recipient):
+        # Resolve recipients a few batches at a time, so lookups and sends are interleaved.
+        # Recipients that can't be resolved are logged as failed, the rest are packed and
+        # yielded as batches that fit into one transaction.
+        chunk_size = batch_size * 20
+        for start in range(0, len(drops), chunk_size):
+            chunk = drops[start:start + chunk_size]
+            prepared = self.prepare(engine, chunk, fund_recipient, allow_unfunded_recipient)
+
+            ready = []
+            for (index, addr, drop), (ok, result) in zip(chunk, prepared):
+                if ok:
+                    result.index = index
+                    ready.append(result)
+                    continue
+                report(f"{index}. Airdrop to {addr}: ", f"{FAIL}FAILED{ENDC}")
+                err_short = re.sub(r"[,]", ' ', result.split('\n', 1)[0]) + '\n'
+                self.record('failed', [(index, addr, drop)])
+                with OUTPUT_LOCK, open(self.log_failed, 'a') as lfa:
+                    lfa.write(f'{addr},{self.ui(drop)},{err_short}')
+                self.write_detail(f"{index}. Recipient: {addr}\n{result}\n")
+
+            for batch in engine.pack(ready, batch_size):
+                yield batch
+
+    def batch_transfer(self, engine, drops, batch_size, concurrency, fund_recipient, allow_unfunded_recipient):
+        def send(batch):
+            log_detail_entry = f"{batch_label(batch)}. Batch: {' '.join(p.recipient for p in batch)}\n"
+            log_detail_entry += self.try_transfer_batch(engine, batch)
+            self.write_detail(log_detail_entry)
+
+        batches = self.prepared_batches(engine, drops, batch_size, fund_recipient, allow_unfunded_recipient)
+        run_concurrently((functools.partial(send, batch) for batch in batches), concurrency)
+
+    def pipelined_transfer(self, engine, drops, batch_size, max_pending, fund_recipient, allow_unfunded_recipient):
+        def on_result(batch, state, signature, detail):
+            label = batch_label(batch)
+            if len(batch) == 1:
+                prefix = f"{label}. Airdrop to {batch[0].recipient}: "
+            else:
+                prefix = f"{label}. Airdrop to {len(batch)} recipients: "
+            self.record(state, [(p.index, p.recipient, p.amount) for p in batch], signature)
+            if state == 'success':
+                report(prefix, f'{OKGREEN}SUCCESS{ENDC}')
+                with OUTPUT_LOCK, open(self.log_success, 'a') as ls:
+                    for p in batch:
+                        ls.write(f'{p.recipient},{p.ui_amount},{signature}\n')
+            elif state == 'unconfirmed':
+                report(prefix, f'{DANGER}UNCONFIRMED{ENDC}')
+                with OUTPUT_LOCK, open(self.log_unconfirmed, "a") as lu:
+                    for p in batch:
+                        lu.write(f'{p.recipient},{p.ui_amount},{detail}\n')
+            elif state == 'canceled':
+                report(prefix, f'{DANGER}CANCELED{ENDC}')
+                with OUTPUT_LOCK, open(self.log_canceled, "a") as lc:
+                    for p in batch:
+                        lc.write(f'{p.recipient},{p.ui_amount}\n')
+            else:
+                report(prefix, f'{FAIL}FAILED{ENDC}')
+                err_short = re.sub(r"[,]", ' ', detail.split('\n', 1)[0]) + '\n'
+                with OUTPUT_LOCK, open(self.log_failed, 'a') as lfa:
+                    for p in batch:
+                        lfa.write(f'{p.recipient},{p.ui_amount},{err_short}')
+            self.write_detail(f"{label}. Batch: {' '.join(p.recipient for p in batch)}\n{detail}\n")
+
+        pipeline = SendConfirmPipeline(engine, on_result, max_pending)
+        batches = self.prepared_batches(engine, drops, batch_size, fund_recipient, allow_unfunded_recipient)
+        try:
+            for batch in batches:
+                self.record('intent', [(p.index, p.recipient, p.amount) for p in batch])
+                pipeline.submit(batch)
+            print(f'All transactions sent, waiting for {pipeline.pending_count()} to be confirmed...', flush=True)
+            pipeline.close()
+        except KeyboardInterrupt:
+            print(f'\nInterrupted, no new transactions will be sent. Waiting for {pipeline.pending_count()} pending...',
+                  flush=True)
+            pipeline.close(resend=False)
+            raise
+
+    def concurrent_transfer(self, make_cmd, drops, concurrency):
+        # make_cmd(index, recipient, amount) builds the transfer command of one recipient
+        def send(index, addr, drop):
+            cmd = make_cmd(index, addr, drop)
+            log_detail_entry = f"{index}. Cmdline: {cmd.to_str()}\n"
+            log_detail_entry += self.try_transfer(cmd, index, addr, drop, prefix=f"{index}. Airdrop to {addr}: ")
+            self.write_detail(log_detail_entry)
+
+        run_concurrently(
+            (functools.partial(send, index, addr, drop) for index, addr, drop in drops),
+            concurrency)
+
+    def resume(self, journal_path, drops):
+        # Decide what to do with each recipient of an interrupted run, using its journal.
+        # Returns the (index, address) keys of the recipients that must not be sent to
+        # again, and the outcomes found on-chain. Nothing is written until log_resumed()
+        # is called with them, so a run that is canceled at the prompt changes nothing.
+        entries = load_journal(journal_path)
+        skip = set()
+        finished = 0
+        to_verify = []
+        resumed = []
+        for index, addr, _ in drops:
+            entry = entries.get((index, addr))
+            if entry is None:
+                continue
+            if entry.state == 'success':
+                skip.add((index, addr))
+                finished += 1
+            elif entry.state in ('sent', 'unconfirmed') and entry.signature:
+                to_verify.append(entry)
+            elif entry.state in ('spawned', 'unconfirmed'):
+                # Sent through spl-token without a known signature, re-sending could pay twice
+                skip.add((index, addr))
+                if entry.state == 'spawned':
+                    resumed.append(('unconfirmed', entry))
+
+        confirmed = 0
+        if to_verify:
+            print(f'Checking {len(to_verify)} transactions of the interrupted run on-chain...', flush=True)
+            results = verify_signatures(self.rpc, to_verify)
+            for entry in to_verify:
+                if results[entry.signature] == 'success':
+                    skip.add((entry.index, entry.recipient))
+                    confirmed += 1
+                    resumed.append(('success', entry))
+
+        print(f"Resuming: {OKGREEN}{finished}{ENDC} already finished, "
+              f"{OKGREEN}{confirmed}{ENDC} confirmed on-chain, "
+              f"{OKGREEN}{len(to_verify) - confirmed}{ENDC} will be sent again, "
+              f"{DANGER}{len(skip) - finished - confirmed}{ENDC} skipped as unverifiable.\n")
+        return skip, resumed
+
+    def log_resumed(self, resumed):
+        # Record the outcomes resume() found for the transfers of the interrupted run
+        for state, entry in resumed:
+            transfers = [(entry.index, entry.recipient, to_base_units(entry.amount, self.decimals))]
+            if state == 'success':
+                self.record('success', transfers, entry.signature)
+                with OUTPUT_LOCK, open(self.log_success, 'a') as ls:
+                    ls.write(f'{entry.recipient},{entry.amount},{entry.signature}\n')
+            else:
+                self.record('unconfirmed', transfers)
+                with OUTPUT_LOCK, open(self.log_unconfirmed, "a") as lu:
+                    lu.write(f'{entry.recipient},{entry.amount},No signature was recorded - check the balance manually.\n')
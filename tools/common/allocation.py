@@ -0,0 +1,82 @@
+import operator
+from array import array
+from itertools import compress, repeat
+
+from common.amounts import format_amount, to_base_units
+from common.filters import top
+
+# Proportional allocation of a total amount over a list of balances, in base units. Every
+# step runs over whole columns (map/compress over array('Q')), and the result adds up
+# to the total exactly.
+
+
+def largest_remainder(balances, total):
+    # Shares of total proportional to balances: every share is rounded down, then the
+    # units that are left go one each to the largest remainders (earlier recipients
+    # first on ties)
+    balance_sum = sum(balances)
+    if balance_sum == 0:
+        raise ValueError('The balances add up to 0')
+    quotients = list(map(divmod, map(operator.mul, balances, repeat(total)), repeat(balance_sum)))
+    shares = array('Q', map(operator.itemgetter(0), quotients))
+    remainders = list(map(operator.itemgetter(1), quotients))
+    for i in top(range(len(remainders)), remainders, total - sum(shares)):
+        shares[i] += 1
+    return shares
+
+
+def allocate(balances, total, min_share=0, cap=None):
+    # Shares of total proportional to balances, that add up to total. A recipient whose
+    # share would be above cap gets cap, and one whose share would be below min_share
+    # gets nothing; what they don't get is spread over the others, until no share
+    # crosses a limit. Raises ValueError if total can't be allocated within the limits.
+    shares = array('Q', bytes(8 * len(balances)))
+    active = list(compress(range(len(balances)), balances))
+    remaining = total
+    while remaining > 0:
+        if not active:
+            if cap is not None:
+                raise ValueError('The cap is too low to allocate the total to these recipients')
+            raise ValueError('No recipient gets the minimum share')
+        part = largest_remainder(array('Q', map(balances.__getitem__, active)), remaining)
+        if cap is not None:
+            over = list(map(operator.gt, part, repeat(cap)))
+            if any(over):
+                capped = list(compress(active, over))
+                for i in capped:
+                    shares[i] = cap
+                remaining -= cap * len(capped)
+                active = list(compress(active, map(operator.not_, over)))
+                continue
+        under = list(map(operator.lt, part, repeat(min_share)))
+        if any(under):
+            # All of them at once, the next round gives their shares to the others
+            active = list(compress(active, map(operator.not_, under)))
+            continue
+        for i, share in zip(active, part):
+            shares[i] = share
+        break
+    return shares
+
+
+def write_allocation(path, addresses, balances, shares, decimals):
+    # `address,balance,share` lines, for the recipients with a share
+    with open(path, 'w') as f:
+        for address, balance, share in zip(addresses, balances, shares):
+            if share:
+                f.write(f'{address},{format_amount(balance, decimals)},'
+                        f'{format_amount(share, decimals)}\n')
+
+
+def read_allocation(path, decimals):
+    # Addresses, balances and shares (array('Q') in base units) of an allocation file
+    addresses = []
+    balances = array('Q')
+    shares = array('Q')
+    with open(path) as f:
+        for line in f:
+            address, balance, share = line.split(',')
+            addresses.append(address.strip())
+            balances.append(to_base_units(balance, decimals))
+            shares.append(to_base_units(share, decimals))
+    return addresses, balances, shares
@@ -0,0 +1,60 @@
+from array import array
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+
+# Token amounts are carried as integer base units (the u64 amount of a token account),
+# and only converted from and to decimal strings at the edges: input files, prompts,
+# logs and spl-token commands. Columns of many amounts are array('Q').
+U64_MAX = (1 << 64) - 1
+
+
+def to_base_units(value, decimals, rounding=None):
+    # Exact base units of a decimal amount, e.g. ('1.5', 6) -> 1500000. An amount with
+    # more decimals than the mint is rejected, like `spl-token transfer` does, unless a
+    # rounding mode is given (balances with float noise in an older address list).
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount: {value}')
+    if not amount.is_finite() or amount < 0:
+        raise ValueError(f'Invalid amount: {value}')
+    units = amount.scaleb(int(decimals))
+    if units != units.to_integral_value():
+        if rounding is None:
+            raise ValueError(f'Too many decimals for the amount: {value}')
+        units = units.to_integral_value(rounding)
+    units = int(units)
+    if units > U64_MAX:
+        raise ValueError(f'Amount does not fit in a token account: {value}')
+    return units
+
+
+def format_amount(units, decimals, grouping=False):
+    # Base units as a decimal string with all of the mint's decimals, like f'{x:.{decimals}f}'
+    decimals = int(decimals)
+    sign = '-' if units < 0 else ''
+    whole, fraction = divmod(abs(units), 10 ** decimals)
+    whole = f'{whole:,}' if grouping else str(whole)
+    if decimals == 0:
+        return sign + whole
+    return f'{sign}{whole}.{fraction:0{decimals}d}'
+
+
+def read_balances(path, decimals):
+    # Read an `address,balance` list into an address list and an array('Q') of base
+    # units. A repeated address keeps its first position and its last balance.
+    addresses = []
+    balances = array('Q')
+    positions = {}
+    with open(path) as f:
+        for line in f:
+            address, balance = line.split(',')
+            address = address.strip()
+            units = to_base_units(balance, decimals, ROUND_HALF_EVEN)
+            if address in positions:
+                balances[positions[address]] = units
+            else:
+                positions[address] = len(addresses)
+                addresses.append(address)
+                balances.append(units)
+    return addresses, balances
+
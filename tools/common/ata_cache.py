@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+
+from common.keys import get_associated_token_address, pubkey_bytes
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache')),
+                         'distribution-tools')
+
+
+def _checksum(mint, owner, ata):
+    return hashlib.sha256(f'{mint},{owner},{ata}'.encode('utf-8')).hexdigest()[:8]
+
+
+class AtaCache:
+    # Persistent owner -> associated token address map for one mint, so repeated
+    # distributions to the same holders don't derive the addresses again. Entries are
+    # appended to CACHE_DIR/ata-<mint>.csv as `owner,ata,checksum` lines. A line with
+    # a bad checksum (torn write, corruption) is ignored and derived again.
+    def __init__(self, mint, cache_dir=CACHE_DIR):
+        self.mint = mint
+        self.path = None
+        self._atas = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        try:
+            # The mint is part of the file name, make sure it's a real address
+            pubkey_bytes(mint)
+            cache_dir = os.path.expanduser(cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, f'ata-{mint}.csv')
+            self._load()
+        except (OSError, ValueError):
+            # No usable cache file, the cache only lives in memory
+            self.path = None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, errors='replace') as f:
+            for line in f:
+                parts = line.rstrip('\n').split(',')
+                if len(parts) == 3 and parts[2] == _checksum(self.mint, parts[0], parts[1]):
+                    self._atas[parts[0]] = parts[1]
+
+    def get(self, owner):
+        with self._lock:
+            ata = self._atas.get(owner)
+        if ata is None:
+            ata = get_associated_token_address(owner, self.mint)
+            with self._lock:
+                self._atas[owner] = ata
+                self._pending.append(f'{owner},{ata},{_checksum(self.mint, owner, ata)}\n')
+        return ata
+
+    def get_many(self, owners):
+        atas = [self.get(owner) for owner in owners]
+        self.flush()
+        return atas
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending or self.path is None:
+                return
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(''.join(pending))
+            except OSError:
+                self.path = None
@@ -0,0 +1,48 @@
+import base64
+
+from common.base58 import b58encode
+from common.keys import get_associated_token_address, pubkey_bytes, TOKEN_PROGRAM_ID
+from common.transfer import TOKEN_ACCOUNT_SIZE
+
+NOT_FOUND = 'Could not find token account'
+
+
+def decode_token_amount(data):
+    # SPL Token account layout: mint (32), owner (32), amount (u64 LE), ...
+    return int.from_bytes(data[64:72], 'little')
+
+
+def get_token_balances(client, addresses, addr_type, mint, commitment='confirmed',
+                       ata_cache=None):
+    # Balances of many owner or token addresses, looked up with batched getMultipleAccounts
+    # requests. Returns a list of (ok, balance in base units or error message), in input order.
+    token_accounts = []
+    for addr in addresses:
+        try:
+            if addr_type == 'token':
+                pubkey_bytes(addr)
+                token_accounts.append(addr)
+            elif ata_cache is not None:
+                token_accounts.append(ata_cache.get(addr))
+            else:
+                token_accounts.append(get_associated_token_address(addr, mint))
+        except ValueError:
+            token_accounts.append(None)
+    if ata_cache is not None:
+        ata_cache.flush()
+
+    # Invalid addresses are not sent, they are reported as missing accounts. The
+    # requests of a long list are batched, see RpcClient.get_multiple_accounts.
+    keys = [a for a in token_accounts if a is not None]
+    infos = iter(client.get_multiple_accounts(keys, commitment))
+    return [_balance(next(infos) if account is not None else None, mint)
+            for account in token_accounts]
+
+
+def _balance(info, mint):
+    if info is None or info['owner'] != TOKEN_PROGRAM_ID:
+        return False, NOT_FOUND
+    data = base64.b64decode(info['data'][0])
+    if len(data) != TOKEN_ACCOUNT_SIZE or b58encode(data[:32]) != mint:
+        return False, NOT_FOUND
+    return True, decode_token_amount(data)
@@ -0,0 +1,25 @@
+ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_INDEX = {c: i for i, c in enumerate(ALPHABET)}
+
+
+def b58encode(data):
+    n = int.from_bytes(data, 'big')
+    out = []
+    while n > 0:
+        n, rem = divmod(n, 58)
+        out.append(ALPHABET[rem])
+    # Leading zero bytes are encoded as leading '1' characters
+    pad = len(data) - len(data.lstrip(b'\0'))
+    return '1' * pad + ''.join(reversed(out))
+
+
+def b58decode(text):
+    n = 0
+    for c in text:
+        try:
+            n = n * 58 + _INDEX[c]
+        except KeyError:
+            raise ValueError(f'Invalid base58 character: {c!r}')
+    pad = len(text) - len(text.lstrip('1'))
+    body = n.to_bytes((n.bit_length() + 7) // 8, 'big') if n else b''
+    return b'\0' * pad + body
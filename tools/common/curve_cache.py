@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from common.ata_cache import CACHE_DIR
+from common.ed25519 import is_on_curve
+from common.keys import pubkey_bytes
+
+# Below this many unknown addresses, they are checked in this process
+PARALLEL_THRESHOLD = 20000
+CHUNK_SIZE = 5000
+
+
+def is_off_curve(address):
+    # Program derived addresses (vaults, pools, multisigs...) are off the ed25519 curve,
+    # no private key can sign for them. Invalid addresses are not off-curve.
+    try:
+        return not is_on_curve(pubkey_bytes(address))
+    except ValueError:
+        return False
+
+
+def _classify(addresses):
+    return [is_off_curve(address) for address in addresses]
+
+
+class CurveCache:
+    # Persistent address -> off-curve map. Whether an address is on the curve never
+    # changes and doesn't depend on the mint, so every address is only checked once,
+    # whatever list or snapshot it's in. Entries are appended to CACHE_DIR/curve.csv as
+    # `address,0` (on the curve) or `address,1` (off-curve) lines; a torn line is ignored.
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.path = None
+        self._off_curve = {}
+        self._pending = []
+        try:
+            cache_dir = os.path.expanduser(cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, 'curve.csv')
+            self._load()
+        except OSError:
+            # No usable cache file, the cache only lives in memory
+            self.path = None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, errors='replace') as f:
+            for line in f:
+                parts = line.rstrip('\n').split(',')
+                if len(parts) == 2 and parts[1] in ('0', '1') and 32 <= len(parts[0]) <= 44:
+                    self._off_curve[parts[0]] = parts[1] == '1'
+
+    def is_off_curve(self, address):
+        off_curve = self._off_curve.get(address)
+        if off_curve is None:
+            off_curve = self._add([address], _classify([address]))[0]
+        return off_curve
+
+    def classify(self, addresses):
+        # Off-curve flags of the addresses. The ones that are not in the cache are
+        # checked in bulk, spread over all CPUs when there are many of them.
+        known = self._off_curve
+        unknown = list({address for address in addresses if address not in known})
+        if unknown:
+            if len(unknown) < PARALLEL_THRESHOLD or (os.cpu_count() or 1) == 1:
+                flags = _classify(unknown)
+            else:
+                chunks = [unknown[i:i + CHUNK_SIZE] for i in range(0, len(unknown), CHUNK_SIZE)]
+                with ProcessPoolExecutor() as executor:
+                    flags = [flag for chunk in executor.map(_classify, chunks) for flag in chunk]
+            self._add(unknown, flags)
+            self.flush()
+        return [known[address] for address in addresses]
+
+    def _add(self, addresses, flags):
+        for address, flag in zip(addresses, flags):
+            self._off_curve[address] = flag
+            self._pending.append(f'{address},{int(flag)}\n')
+        return flags
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending or self.path is None:
+            return
+        try:
+            with open(self.path, 'a') as f:
+                f.write(''.join(pending))
+        except OSError:
+            self.path = None
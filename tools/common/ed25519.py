@@ -0,0 +1,124 @@
+import hashlib
+
+try:
+    from nacl.signing import SigningKey
+except ImportError:
+    # PyNaCl is optional, the pure python implementation below is used without it
+    SigningKey = None
+
+# Curve constants (RFC 8032)
+P = 2 ** 255 - 19
+L = 2 ** 252 + 27742317777372353535851937790883648493
+D = -121665 * pow(121666, P - 2, P) % P
+SQRT_M1 = pow(2, (P - 1) // 4, P)
+_LEGENDRE = (P - 1) // 2
+
+
+def _inv(x):
+    return pow(x, P - 2, P)
+
+
+def _recover_x(y, sign):
+    if y >= P:
+        return None
+    x2 = (y * y - 1) * _inv(D * y * y + 1) % P
+    if x2 == 0:
+        return None if sign else 0
+    x = pow(x2, (P + 3) // 8, P)
+    if (x * x - x2) % P != 0:
+        x = x * SQRT_M1 % P
+    if (x * x - x2) % P != 0:
+        return None
+    if (x & 1) != sign:
+        x = P - x
+    return x
+
+
+_GY = 4 * _inv(5) % P
+_GX = _recover_x(_GY, 0)
+# Base point in extended coordinates (X, Y, Z, T)
+G = (_GX, _GY, 1, _GX * _GY % P)
+_IDENTITY = (0, 1, 1, 0)
+
+
+def _add(p1, p2):
+    x1, y1, z1, t1 = p1
+    x2, y2, z2, t2 = p2
+    a = (y1 - x1) * (y2 - x2) % P
+    b = (y1 + x1) * (y2 + x2) % P
+    c = 2 * t1 * t2 * D % P
+    d = 2 * z1 * z2 % P
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+
+def _double(p1):
+    x1, y1, z1, _ = p1
+    a = x1 * x1 % P
+    b = y1 * y1 % P
+    c = 2 * z1 * z1 % P
+    h = a + b
+    e = h - (x1 + y1) * (x1 + y1)
+    g = a - b
+    f = c + g
+    return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+
+def _scalar_mult(s, point):
+    q = _IDENTITY
+    while s > 0:
+        if s & 1:
+            q = _add(q, point)
+        point = _double(point)
+        s >>= 1
+    return q
+
+
+def _compress(point):
+    x, y, z, _ = point
+    zinv = _inv(z)
+    x = x * zinv % P
+    y = y * zinv % P
+    return int.to_bytes(y | ((x & 1) << 255), 32, 'little')
+
+
+def _sha512_int(data):
+    return int.from_bytes(hashlib.sha512(data).digest(), 'little')
+
+
+def _expand_seed(seed):
+    h = hashlib.sha512(seed).digest()
+    a = int.from_bytes(h[:32], 'little')
+    a &= (1 << 254) - 8
+    a |= 1 << 254
+    return a, h[32:]
+
+
+def public_key(seed):
+    a, _ = _expand_seed(seed)
+    return _compress(_scalar_mult(a, G))
+
+
+def sign(seed, message):
+    if SigningKey is not None:
+        return SigningKey(seed).sign(message).signature
+    a, prefix = _expand_seed(seed)
+    pub = _compress(_scalar_mult(a, G))
+    r = _sha512_int(prefix + message) % L
+    r_enc = _compress(_scalar_mult(r, G))
+    k = _sha512_int(r_enc + pub + message) % L
+    s = (r + k * a) % L
+    return r_enc + int.to_bytes(s, 32, 'little')
+
+
+def is_on_curve(key):
+    # Same rules as curve25519-dalek's CompressedEdwardsY::decompress, which is what
+    # the runtime uses to reject program derived addresses: the sign bit is ignored
+    # and the y coordinate is taken modulo p.
+    # x^2 = u / v is a square exactly when u * v is (v is never 0, d is not a square),
+    # so one exponentiation is enough, without inverting v first.
+    y = int.from_bytes(key, 'little') & ((1 << 255) - 1)
+    y %= P
+    yy = y * y
+    u = (yy - 1) % P
+    return u == 0 or pow(u * (D * yy + 1), _LEGENDRE, P) == 1
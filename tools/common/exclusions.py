@@ -0,0 +1,60 @@
+from array import array
+
+from common.addresslist import AddressList, is_address_list
+from common.curve_cache import CurveCache
+
+
+class Exclusions:
+    # Addresses left out of address lists and distributions, looked up in a set. They
+    # come from files: one address per line, or CSV lines that start with the address
+    # (address lists with balances, success logs of an earlier distribution), or binary
+    # address lists. With off_curve, every off-curve address is excluded as well, see
+    # CurveCache.
+    def __init__(self, paths=(), off_curve=False):
+        self.addresses = set()
+        self.off_curve = off_curve
+        self.curve = CurveCache() if off_curve else None
+        for path in paths:
+            self.add_file(path)
+
+    def add_file(self, path):
+        if is_address_list(path):
+            address_list = AddressList(path)
+            self.addresses.update(address_list)
+            address_list.close()
+            return
+        with open(path, encoding='utf-8') as f:
+            self.addresses.update(line.split(',', 1)[0].strip() for line in f)
+        # Blank lines, and the header of a log
+        self.addresses.discard('')
+        self.addresses.discard('recipient')
+
+    def __bool__(self):
+        return bool(self.addresses) or self.off_curve
+
+    def __contains__(self, address):
+        return address in self.addresses or (self.off_curve and self.curve.is_off_curve(address))
+
+    def keep(self, addresses):
+        # Indices of the addresses that are not excluded
+        excluded = self.addresses
+        if not self.off_curve:
+            return [i for i, address in enumerate(addresses) if address not in excluded]
+        off_curve = self.curve.classify(addresses)
+        return [i for i, address in enumerate(addresses)
+                if not off_curve[i] and address not in excluded]
+
+    def filter(self, addresses):
+        # The addresses that are not excluded, as a list (addresses itself if nothing is)
+        if not self:
+            return addresses
+        return [addresses[i] for i in self.keep(addresses)]
+
+    def remove(self, addresses, *columns):
+        # addresses, and columns of amounts in the same order (balances, shares), without
+        # the excluded addresses. For addresses alone, use filter().
+        if not self:
+            return (addresses, *columns)
+        kept = self.keep(addresses)
+        return ([addresses[i] for i in kept],
+                *(array('Q', map(column.__getitem__, kept)) for column in columns))
@@ -0,0 +1,88 @@
+import heapq
+import operator
+import random
+import re
+from decimal import Decimal, InvalidOperation
+from itertools import compress, islice, repeat
+
+# Filtering and ranking of holders, on a column of balances in base units (array('Q'))
+# addressed by index. Comparisons run through map()/compress() and ranking through a
+# heap (or a sort of the column), so there is no Python-level loop per holder.
+FILTER_OPS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+_FILTER = re.compile(r'^\s*balance\s*(>=|<=|==|!=|>|<)\s*([0-9.eE+-]+)\s*$')
+
+
+def parse_filter(expr):
+    # 'balance>100' -> (operator.gt, Decimal('100')), in tokens, see in_base_units()
+    match = _FILTER.match(expr)
+    try:
+        if match is None:
+            raise InvalidOperation
+        return FILTER_OPS[match.group(1)], Decimal(match.group(2))
+    except InvalidOperation:
+        raise ValueError(f'Invalid filter {expr!r}, expected e.g. balance>100')
+
+
+def in_base_units(value, decimals):
+    # A threshold in tokens as base units, for comparisons with the balance column. Not
+    # rounded: an int when it is whole, otherwise an exact Decimal (1.0000005 with 6
+    # decimals stays between 1000000 and 1000001).
+    units = Decimal(str(value)).scaleb(int(decimals))
+    if units == units.to_integral_value():
+        return int(units)
+    return units
+
+
+def select(balances, filters):
+    # Indices of the balances that pass all (op, value) filters, and their balances
+    indices = range(len(balances))
+    column = balances
+    for op, value in filters:
+        mask = list(map(op, column, repeat(value)))
+        indices = list(compress(indices, mask))
+        column = list(compress(column, mask))
+    return list(indices), list(column)
+
+
+def _ranked(indices, column, n, reverse):
+    # The n indices with the best balances: find the n-th best balance, then take the
+    # indices strictly better than it, and fill up with the ones equal to it
+    if n <= 0 or not indices:
+        return []
+    if n >= len(indices):
+        return list(indices)
+    if n < len(column) // 16:
+        threshold = (heapq.nlargest if reverse else heapq.nsmallest)(n, column)[-1]
+    else:
+        # A heap of more than a few percent of the column is slower than a sort
+        threshold = sorted(column, reverse=reverse)[n - 1]
+    cmp = operator.gt if reverse else operator.lt
+    ranked = list(compress(indices, map(cmp, column, repeat(threshold))))
+    ties = compress(indices, map(operator.eq, column, repeat(threshold)))
+    ranked.extend(islice(ties, n - len(ranked)))
+    return ranked
+
+
+def top(indices, column, n):
+    return _ranked(indices, column, n, True)
+
+
+def bottom(indices, column, n):
+    return _ranked(indices, column, n, False)
+
+
+def sample(indices, n, seed=None):
+    # Raises ValueError if n is larger than the number of indices
+    return random.Random(seed).sample(indices, n)
+
+
+def by_balance(balances, indices):
+    # Highest balance first, holders with the same balance keep their order
+    return sorted(indices, key=balances.__getitem__, reverse=True)
@@ -0,0 +1,70 @@
+class HolderIndex:
+    # In-memory map of the token accounts of a mint, kept current from account
+    # notifications. It is bootstrapped from a full fetch at base_slot, and every
+    # account remembers the slot of its last update, so a notification older than the
+    # data it would replace (e.g. one received while the bootstrap was running) is
+    # ignored. Emptied accounts stay in the index with a zero balance; closed accounts
+    # leave it, and the slot they were closed at is kept, so an older notification
+    # doesn't bring them back.
+    def __init__(self):
+        self.base_slot = 0
+        self.slot = 0
+        self._accounts = {}
+        self._removed = {}
+        self._changed = set()
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def add(self, token_account, owner, amount):
+        # An account of the bootstrap fetch, call set_base() once it's done
+        self._accounts[token_account] = (owner, amount, 0)
+
+    def set_base(self, slot):
+        self.base_slot = slot
+        self.slot = max(self.slot, slot)
+
+    def apply(self, token_account, owner, amount, slot):
+        # Returns True if the update was applied
+        if not self._is_newer(token_account, slot):
+            return False
+        self._accounts[token_account] = (owner, amount, slot)
+        self._removed.pop(token_account, None)
+        self._changed.add(token_account)
+        self.slot = max(self.slot, slot)
+        return True
+
+    def close(self, token_account, slot):
+        # The account was closed, returns True if it was removed
+        if not self._is_newer(token_account, slot):
+            return False
+        self._accounts.pop(token_account, None)
+        self._removed[token_account] = slot
+        self._changed.add(token_account)
+        self.slot = max(self.slot, slot)
+        return True
+
+    def _is_newer(self, token_account, slot):
+        if slot < self.base_slot:
+            return False
+        current = self._accounts.get(token_account)
+        if current is not None and current[2] > slot:
+            return False
+        return self._removed.get(token_account, 0) <= slot
+
+    def changes(self):
+        # Accounts changed since the last call: (token account, owner, raw amount) of
+        # the updated ones, and the token accounts that were closed
+        changed, self._changed = self._changed, set()
+        updated = [(token_account, *self._accounts[token_account][:2])
+                   for token_account in changed if token_account in self._accounts]
+        removed = [token_account for token_account in changed if token_account not in self._accounts]
+        return updated, removed
+
+    def holdings(self, address_type):
+        # Raw amount held by every owner or token account address
+        holdings = {}
+        for token_account, (owner, amount, _) in self._accounts.items():
+            address = owner if address_type == 'owner' else token_account
+            holdings[address] = holdings.get(address, 0) + amount
+        return holdings
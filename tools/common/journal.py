@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Journal states, in the order a recipient normally goes through them:
+#   intent      - about to be signed by the native backend, nothing was sent yet
+#   spawned     - a spl-token process was started, its outcome is unknown
+#   sent        - signed and (possibly) sent, the signature is known
+#   success, failed, unconfirmed, canceled - final states, same as the log files
+# Recipients are identified by their position in the input list and their address,
+# so an address that is listed twice is journaled (and resumed) as two recipients.
+FINAL_STATES = ('success', 'failed', 'unconfirmed', 'canceled')
+
+
+class JournalEntry:
+    def __init__(self, state, index, recipient, amount, signature, last_valid_height):
+        self.state = state
+        self.index = int(index) if index else None
+        self.recipient = recipient
+        self.amount = amount
+        self.signature = signature
+        self.last_valid_height = int(last_valid_height) if last_valid_height else None
+
+
+class Journal:
+    # Append-only record of every recipient's progress. Each write is flushed and
+    # fsync'd before returning, so the journal survives a crash of the process or host.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def write_many(self, state, transfers, signature='', last_valid_height=''):
+        # transfers are (index, recipient, amount) triples
+        lines = []
+        for index, recipient, amount in transfers:
+            if isinstance(amount, float):
+                amount = f'{amount:f}'
+            lines.append(f'{state},{index if index is not None else ""},{recipient},{amount},'
+                         f'{signature or ""},{last_valid_height or ""}\n')
+        with self._lock:
+            self._file.write(''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_journal(path):
+    # Returns the latest entry of every recipient, keyed by (index, address)
+    entries = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip('\n').split(',')
+            # A torn last line (crash during a write) is ignored
+            if not line.endswith('\n') or len(parts) != 6:
+                continue
+            entry = JournalEntry(*parts)
+            key = (entry.index, entry.recipient)
+            previous = entries.get(key)
+            # 'sent' carries the signature, keep it for a later 'unconfirmed'
+            if previous is not None and not entry.signature and entry.state == 'unconfirmed':
+                entry.signature = previous.signature
+                entry.last_valid_height = previous.last_valid_height
+            entries[key] = entry
+    return entries
+
+
+def verify_signatures(client, entries, poll_interval=2.0, commitment='confirmed'):
+    # Look up each entry's signature on-chain. Returns {signature: 'success' | 'failed' |
+    # 'expired'}. Signatures whose blockhash is still valid are polled until they land or expire.
+    results = {}
+    waiting = {e.signature: e for e in entries}
+    while waiting:
+        signatures = list(waiting)
+        statuses = dict(zip(signatures, client.get_signature_statuses(signatures, True)))
+        height = client.get_block_height(commitment)
+        for sig in signatures:
+            status = statuses[sig]
+            entry = waiting[sig]
+            if status is not None:
+                if status.get('err') is not None:
+                    results[sig] = 'failed'
+                elif status.get('confirmationStatus') in ('confirmed', 'finalized'):
+                    results[sig] = 'success'
+                else:
+                    continue
+            elif entry.last_valid_height is None or height > entry.last_valid_height:
+                results[sig] = 'expired'
+            else:
+                continue
+            del waiting[sig]
+        if waiting:
+            time.sleep(poll_interval)
+    return results
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import re
+
+from common import ed25519
+from common.base58 import b58decode, b58encode
+
+TOKEN_PROGRAM_ID = 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA'
+ASSOCIATED_TOKEN_PROGRAM_ID = 'ATokenGPvbdGVxr1b2hvZbsiqW5xWH25efTNsLJA8knL'
+SYSTEM_PROGRAM_ID = '11111111111111111111111111111111'
+
+CLI_CONFIG_PATH = os.path.join('~', '.config', 'solana', 'cli', 'config.yml')
+DEFAULT_KEYPAIR_PATH = os.path.join('~', '.config', 'solana', 'id.json')
+
+
+def pubkey_bytes(addr):
+    if isinstance(addr, bytes):
+        return addr
+    raw = b58decode(addr)
+    if len(raw) != 32:
+        raise ValueError(f'Invalid public key: {addr}')
+    return raw
+
+
+def create_program_address(seeds, program_id):
+    h = hashlib.sha256()
+    for seed in seeds:
+        if len(seed) > 32:
+            raise ValueError('Max seed length exceeded')
+        h.update(seed)
+    h.update(pubkey_bytes(program_id))
+    h.update(b'ProgramDerivedAddress')
+    digest = h.digest()
+    if ed25519.is_on_curve(digest):
+        return None
+    return digest
+
+
+def find_program_address(seeds, program_id):
+    for bump in range(255, -1, -1):
+        addr = create_program_address(seeds + [bytes([bump])], program_id)
+        if addr is not None:
+            return addr, bump
+    raise ValueError('Unable to find a viable program address bump seed')
+
+
+def get_associated_token_address(owner, mint):
+    addr, _ = find_program_address(
+        [pubkey_bytes(owner), pubkey_bytes(TOKEN_PROGRAM_ID), pubkey_bytes(mint)],
+        ASSOCIATED_TOKEN_PROGRAM_ID)
+    return b58encode(addr)
+
+
+class Keypair:
+    def __init__(self, secret):
+        if len(secret) != 64:
+            raise ValueError('Keypair must be 64 bytes long')
+        self.seed = bytes(secret[:32])
+        self.public = bytes(secret[32:])
+        self.pubkey = b58encode(self.public)
+
+    def sign(self, message):
+        return ed25519.sign(self.seed, message)
+
+
+def get_cli_keypair_path():
+    # Mirror `solana config get keypair`, falling back to the CLI default
+    path = os.path.expanduser(CLI_CONFIG_PATH)
+    try:
+        with open(path) as f:
+            for line in f:
+                match = re.match(r'''^keypair_path:\s*['"]?(.+?)['"]?\s*$''', line)
+                if match:
+                    return os.path.expanduser(match.group(1))
+    except (OSError, IOError):
+        pass
+    return os.path.expanduser(DEFAULT_KEYPAIR_PATH)
+
+
+def load_keypair(path):
+    try:
+        with open(path) as f:
+            secret = bytes(json.load(f))
+        return True, Keypair(secret)
+    except (OSError, IOError, ValueError, TypeError) as e:
+        return False, str(e)
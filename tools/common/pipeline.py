@@ -0,0 +1,192 @@
+import threading
+import time
+
+from common.rpc import RpcError, HttpError, NODE_BEHIND
+from common.transfer import TransferError, UNCONFIRMED_MSG, UNKNOWN_OUTCOME_ERRORS
+
+POLL_INTERVAL = 1.0
+SEND_ATTEMPTS = 4
+SEND_RETRY_DELAY = 1.0
+
+
+class PendingTransaction:
+    def __init__(self, batch, signature, last_valid_height, resends):
+        self.batch = batch
+        self.signature = signature
+        self.last_valid_height = last_valid_height
+        self.resends = resends
+
+
+class SendConfirmPipeline:
+    # Sends transactions without waiting for their confirmation. A confirmer thread
+    # polls the signatures of all pending transactions with batched getSignatureStatuses
+    # requests and reports every batch through on_result(batch, state, signature, detail),
+    # where state is one of 'success', 'failed', 'unconfirmed' or 'canceled'.
+    #
+    # Failed multi-recipient batches are split in half and re-sent. Transactions whose
+    # blockhash expired without landing are rebuilt with a new blockhash and re-sent,
+    # at most max_resends times. Both kinds of re-sends are done by the thread that
+    # calls submit()/close(), so sending stays on a single thread.
+    def __init__(self, engine, on_result, max_pending=256, max_resends=2):
+        self.engine = engine
+        self.on_result = on_result
+        self.max_pending = max_pending
+        self.max_resends = max_resends
+        self._pending = {}
+        self._retry = []
+        self._resend = True
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._confirmer = threading.Thread(target=self._confirm_loop, daemon=True)
+        self._confirmer.start()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, batch):
+        self._drain_retries()
+        with self._cond:
+            while len(self._pending) >= self.max_pending:
+                self._cond.wait()
+        self._send(batch, 0)
+
+    def close(self, resend=True):
+        # Wait until every submitted batch has a final state. With resend=False, no more
+        # transactions are sent: batches waiting to be split are canceled and expired
+        # transactions are reported as unconfirmed.
+        with self._cond:
+            self._resend = resend
+        while True:
+            self._drain_retries()
+            with self._cond:
+                if not self._pending and not self._retry:
+                    self._stopped = True
+                    self._cond.notify_all()
+                    break
+                self._cond.wait(POLL_INTERVAL)
+        self._confirmer.join()
+
+    def _drain_retries(self):
+        with self._cond:
+            retries, self._retry = self._retry, []
+            resend = self._resend
+        for batch, resends in retries:
+            if resend:
+                self._send(batch, resends)
+            else:
+                self.on_result(batch, 'canceled', None, 'Interrupted before the batch was re-sent')
+
+    def _fail(self, batch, signature, message):
+        if len(batch) > 1:
+            half = len(batch) // 2
+            with self._cond:
+                self._retry.extend([(batch[:half], 0), (batch[half:], 0)])
+        else:
+            self.on_result(batch, 'failed', signature, message)
+
+    def _send(self, batch, resends):
+        instructions = [ix for p in batch for ix in p.instructions]
+        tx = signature = err = None
+        sent = False
+        for attempt in range(SEND_ATTEMPTS):
+            try:
+                if tx is None:
+                    tx, signature, last_valid_height = self.engine.build(
+                        instructions, refresh_blockhash=resends > 0)
+                    self.engine.record_sent(
+                        [(p.index, p.recipient, p.ui_amount) for p in batch], signature, last_valid_height)
+                sent = True
+                self.engine.send_raw(tx)
+                break
+            except TransferError as e:
+                self._fail(batch, signature, str(e))
+                return
+            except RpcError as e:
+                # Anything but an unhealthy node means preflight rejected the transaction
+                if e.code != NODE_BEHIND:
+                    self._fail(batch, signature, str(e))
+                    return
+                err = e
+            except (HttpError, OSError) as e:
+                err = e
+            except UNKNOWN_OUTCOME_ERRORS as e:
+                if not sent:
+                    # Nothing was sent yet, e.g. an unreadable blockhash response
+                    err = e
+                else:
+                    # The response to sendTransaction was cut off or unreadable, the
+                    # node may have got the transaction
+                    self.on_result(batch, 'unconfirmed', signature,
+                                   f'Error: {UNCONFIRMED_MSG} ({type(e).__name__}: {e})')
+                    return
+            rate = self.engine.client.rate
+            time.sleep(rate.backoff(attempt) if rate is not None else SEND_RETRY_DELAY * (attempt + 1))
+        else:
+            if tx is None:
+                self._fail(batch, None, str(err))
+                return
+            # The transaction may still have reached a leader, so it is tracked
+            # like any other and the confirmer decides what happened to it.
+
+        with self._cond:
+            self._pending[signature] = PendingTransaction(
+                batch, signature, last_valid_height, resends)
+
+    def _statuses(self, signatures, search_history=False):
+        # Batched when there are more than one request can take
+        return dict(zip(signatures,
+                        self.engine.client.get_signature_statuses(signatures, search_history)))
+
+    def _confirm_loop(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                pending = list(self._pending.values())
+            if not pending:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            try:
+                statuses = self._statuses([p.signature for p in pending])
+                height = self.engine.client.get_block_height(self.engine.commitment)
+                expired = [p for p in pending
+                           if statuses[p.signature] is None and height > p.last_valid_height]
+                # Make sure expired transactions really never landed before giving up on them
+                if expired:
+                    statuses.update(self._statuses([p.signature for p in expired], True))
+            except (RpcError, HttpError) + UNKNOWN_OUTCOME_ERRORS:
+                # Includes malformed responses: the thread must keep polling, or close()
+                # would wait forever for the pending transactions
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            # A transaction leaves the pending set only after its result (or re-send)
+            # is recorded, so close() can't return while one is still in progress.
+            for p in pending:
+                status = statuses[p.signature]
+                if status is None:
+                    if height <= p.last_valid_height:
+                        continue
+                    with self._cond:
+                        resend = self._resend and p.resends < self.max_resends
+                        if resend:
+                            self._retry.append((p.batch, p.resends + 1))
+                    if not resend:
+                        self.on_result(p.batch, 'unconfirmed', p.signature, f'Error: {UNCONFIRMED_MSG}')
+                elif status.get('err') is not None:
+                    self._fail(p.batch, p.signature,
+                               f'Error: Transaction {p.signature} failed: {status["err"]}')
+                elif status.get('confirmationStatus') in ('confirmed', 'finalized'):
+                    self.on_result(p.batch, 'success', p.signature,
+                                   self.engine.describe_batch(p.batch, p.signature))
+                else:
+                    continue
+                self._remove(p)
+            time.sleep(POLL_INTERVAL)
+
+    def _remove(self, p):
+        with self._cond:
+            del self._pending[p.signature]
+            self._cond.notify_all()
@@ -0,0 +1,29 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_concurrently(jobs, concurrency):
+    # Run callables from the (possibly lazy) jobs iterable on a pool of worker threads,
+    # with at most `concurrency` of them in flight. Jobs are only pulled from the
+    # iterable when a slot frees up. On SIGINT (KeyboardInterrupt in the main thread),
+    # stop dispatching and wait for the in-flight jobs, so their results are recorded.
+    slots = threading.BoundedSemaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def done(future):
+        slots.release()
+        err = future.exception()
+        if err is not None:
+            print(f'Worker error: {err!r}', file=sys.stderr, flush=True)
+
+    try:
+        for job in jobs:
+            slots.acquire()
+            executor.submit(job).add_done_callback(done)
+    except KeyboardInterrupt:
+        print('\nInterrupted, no new transfers will be started. Waiting for the ones in flight...',
+              flush=True)
+        executor.shutdown(wait=True)
+        raise
+    executor.shutdown(wait=True)
@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+
+
+class RateController:
+    # Token bucket shared by everything that talks to the RPC. The refill rate adapts
+    # with AIMD: every successful request adds `increase / rate` requests per second
+    # (about +increase per second of traffic), every throttle event (HTTP 429, RPC
+    # error -32005) multiplies it by `decrease`. Throttled requests are retried with
+    # exponential backoff and jitter, limited by a retry budget that is refilled by a
+    # fraction of a retry per successful request.
+    def __init__(self, initial_rate=10.0, max_rate=100.0, min_rate=0.2,
+                 increase=1.0, decrease=0.5, base_delay=0.5, max_delay=30.0,
+                 max_attempts=8, retry_budget=100, budget_refill=0.1):
+        self.rate = min(initial_rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_budget = retry_budget
+        self.budget = float(retry_budget)
+        self.budget_refill = budget_refill
+        self.throttle_events = 0
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        # A burst of 429s from concurrent requests only cuts the rate once
+        self._last_decrease = 0.0
+        self._events = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                capacity = max(1.0, self.rate)
+                self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+            self.budget = min(self.max_budget, self.budget + self.budget_refill)
+
+    def on_throttle(self, reason):
+        with self._lock:
+            self.throttle_events += 1
+            now = time.monotonic()
+            old_rate = self.rate
+            if now - self._last_decrease >= 1.0:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+            self._events.append(f'Throttled ({reason}): rate {old_rate:.2f} -> {self.rate:.2f} req/s')
+
+    def retry_allowed(self, attempt):
+        # Takes one retry from the budget when allowed
+        with self._lock:
+            if attempt + 1 >= self.max_attempts or self.budget < 1.0:
+                self._events.append(f'Retry budget exhausted (attempt {attempt + 1}, budget {self.budget:.1f})')
+                return False
+            self.budget -= 1.0
+            return True
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        # "Equal jitter": half of the delay is fixed, the other half random
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def report(self):
+        # Throttle events since the last report, followed by the current state
+        with self._lock:
+            events, self._events = self._events, []
+            lines = [f'Rate: {e}\n' for e in events]
+            lines.append(f'Rate: {self.rate:.2f} req/s, {self.throttle_events} throttle events, '
+                         f'retry budget {self.budget:.1f}\n')
+        return ''.join(lines)
@@ -0,0 +1,69 @@
+import gzip
+import json
+import textwrap
+
+# zstd is in the standard library from Python 3.14, and in the zstandard package before
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# Raw account files of address-fetcher: the getProgramAccounts result as one JSON array
+# (indent=4, as it always was), or as newline-delimited JSON, one compact account per
+# line, optionally compressed
+RAW_FORMATS = {
+    'json': 'raw.json',
+    'ndjson': 'raw.ndjson',
+    'gzip': 'raw.ndjson.gz',
+    'zstd': 'raw.ndjson.zst',
+}
+GZIP_LEVEL = 6
+
+
+def zstd_available():
+    return zstd is not None
+
+
+def _open(path, mode):
+    # Text file of path, compressed according to its extension
+    if path.endswith('.gz'):
+        # The default level 9 is several times slower, for a few percent
+        return gzip.open(path, mode + 't', compresslevel=GZIP_LEVEL, encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstd is None:
+            raise ValueError(f'Reading or writing {path} needs zstd support (Python 3.14 or the zstandard package)')
+        return zstd.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def write_raw(accounts, path):
+    # Write the accounts to path as they pass through, so the whole response is never
+    # held in memory. The format follows from the file name, see RAW_FORMATS.
+    with _open(path, 'w') as f:
+        if path.endswith('.json'):
+            separator = '[\n'
+            for acc in accounts:
+                f.write(separator)
+                f.write(textwrap.indent(json.dumps(acc, ensure_ascii=False, indent=4), '    '))
+                separator = ',\n'
+                yield acc
+            f.write('[]' if separator == '[\n' else '\n]')
+        else:
+            for acc in accounts:
+                f.write(json.dumps(acc, ensure_ascii=False, separators=(',', ':')))
+                f.write('\n')
+                yield acc
+
+
+def read_raw(path):
+    # The accounts of a raw file in any of the formats
+    with _open(path, 'r') as f:
+        if path.endswith('.json'):
+            yield from json.load(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,557 @@
+import codecs
+import http.client
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class RpcError(Exception):
+    # JSON-RPC level error, the message mirrors the Solana CLI client output
+    def __init__(self, code, message, data=None):
+        super().__init__(f'RPC response error {code}: {message}')
+        self.code = code
+        self.data = data
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason, url):
+        super().__init__(f'HTTP status client error ({status} {reason}) for url ({url})')
+        self.status = status
+
+
+# Responses that mean the request was rejected before it was processed
+TOO_MANY_REQUESTS = 429
+NODE_BEHIND = -32005
+
+
+# Endpoint health, see RpcPool
+EWMA_ALPHA = 0.2
+EJECT_FAILURES = 3       # consecutive failures
+EJECT_ERROR_RATE = 0.5
+EJECT_COOLDOWN = 5.0     # seconds before the first probe, doubled after every failed probe
+MAX_EJECT_COOLDOWN = 120.0
+PROBE_INTERVAL = 1.0
+READMIT_PROBES = 2
+# Request limits of the RPC methods, and JSON-RPC calls sent in one batch (one HTTP
+# request) when a read is larger than that
+MAX_MULTIPLE_ACCOUNTS = 100
+MAX_SIGNATURE_STATUSES = 256
+MAX_BATCH = 10
+# Bytes read at a time from a streamed response
+STREAM_CHUNK_SIZE = 1 << 16
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_END = object()
+
+
+def parse_urls(value):
+    # RPC_URL and --url accept one or more endpoints, separated by commas or whitespace
+    return [url for url in re.split(r'[,\s]+', value) if url]
+
+
+def is_throttle(err):
+    return ((isinstance(err, HttpError) and err.status == TOO_MANY_REQUESTS)
+            or (isinstance(err, RpcError) and err.code == NODE_BEHIND))
+
+
+class RpcClient:
+    # Minimal JSON-RPC client over a persistent HTTP connection.
+    # Each thread gets its own keep-alive connection. Reads larger than one request
+    # allows are split and sent as JSON-RPC batches, see call_batch().
+    #
+    # With a common.ratelimit.RateController, every request waits for a token and
+    # throttled requests are retried with backoff. This is safe for every method used
+    # here: reads are idempotent and sendTransaction re-sends the same signed bytes.
+    def __init__(self, url, timeout=30, rate=None):
+        self.url = url
+        self.timeout = timeout
+        self.rate = rate
+        parts = urlsplit(url)
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self._local = threading.local()
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._scheme == 'https':
+                conn = http.client.HTTPSConnection(self._host, self._port, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def _open(self, body):
+        # Send the request and return the response, with its body still unread
+        headers = {'Content-Type': 'application/json'}
+        # A kept-alive connection may have been closed by the server, retry once
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('POST', self._path, body=body, headers=headers)
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    BrokenPipeError, ConnectionResetError):
+                self._reset()
+                if attempt == 1:
+                    raise
+        if response.status != 200:
+            response.read()
+            raise HttpError(response.status, response.reason, self.url)
+        return response
+
+    def _post(self, body):
+        return json.loads(self._open(body).read())
+
+    def _request_ids(self, count):
+        with self._id_lock:
+            first = self._next_id + 1
+            self._next_id += count
+        return range(first, first + count)
+
+    def _request_body(self, method, params):
+        request_id, = self._request_ids(1)
+        return json.dumps({'jsonrpc': '2.0', 'id': request_id,
+                           'method': method, 'params': params or []}).encode('utf-8')
+
+    def _batch_body(self, calls):
+        ids = self._request_ids(len(calls))
+        body = json.dumps([{'jsonrpc': '2.0', 'id': request_id, 'method': method,
+                            'params': params or []}
+                           for request_id, (method, params) in zip(ids, calls)])
+        return ids, body.encode('utf-8')
+
+    def call(self, method, params=None):
+        return self._throttled(method, 1, lambda: self._call(method, params))
+
+    def call_batch(self, calls):
+        # Results of several (method, params) calls, sent as one JSON-RPC batch. Only
+        # for reads: a throttled batch is sent again as a whole.
+        return self._throttled(calls[0][0], len(calls), lambda: self._call_batch(calls))
+
+    def _throttled(self, method, count, request):
+        # Every call of a batch counts against the rate, most RPC providers count them
+        if self.rate is None:
+            return request()
+        attempt = 0
+        while True:
+            for _ in range(count):
+                self.rate.acquire()
+            try:
+                result = request()
+            except (HttpError, RpcError) as e:
+                if not is_throttle(e):
+                    raise
+                code = e.status if isinstance(e, HttpError) else e.code
+                self.rate.on_throttle(f'{method} returned {code}')
+                if not self.rate.retry_allowed(attempt):
+                    raise
+                time.sleep(self.rate.backoff(attempt))
+                attempt += 1
+                continue
+            self.rate.on_success()
+            return result
+
+    def stream(self, method, params=None, context=None):
+        # Like call(), for methods that return a large array: yields the items of the
+        # result as they are parsed from the response, without holding the whole body.
+        # Throttled requests are only retried before the first item is yielded. If
+        # context is a dict, it receives the context (slot) of a withContext response.
+        attempt = 0
+        while True:
+            if self.rate is not None:
+                self.rate.acquire()
+            items = self._stream(method, params, context)
+            try:
+                first = next(items, _END)
+            except (HttpError, RpcError) as e:
+                if self.rate is None or not is_throttle(e):
+                    raise
+                code = e.status if isinstance(e, HttpError) else e.code
+                self.rate.on_throttle(f'{method} returned {code}')
+                if not self.rate.retry_allowed(attempt):
+                    raise
+                time.sleep(self.rate.backoff(attempt))
+                attempt += 1
+                continue
+            if self.rate is not None:
+                self.rate.on_success()
+            if first is not _END:
+                yield first
+                yield from items
+            return
+
+    def _stream(self, method, params, context=None):
+        response = self._open(self._request_body(method, params))
+        complete = False
+        try:
+            yield from JsonRpcStream(response.read, context).results()
+            response.read()
+            complete = True
+        finally:
+            # A partly read response leaves the connection unusable
+            if not complete:
+                self._reset()
+
+    def _call(self, method, params):
+        response = self._post(self._request_body(method, params))
+        if 'error' in response:
+            err = response['error']
+            raise RpcError(err.get('code'), err.get('message'), err.get('data'))
+        return response['result']
+
+    def _call_batch(self, calls):
+        ids, body = self._batch_body(calls)
+        response = self._post(body)
+        if isinstance(response, dict):
+            # The batch was rejected as a whole
+            err = response.get('error') or {}
+            raise RpcError(err.get('code'), err.get('message'), err.get('data'))
+        # Responses can come in any order
+        by_id = {item.get('id'): item for item in response}
+        results = []
+        for request_id in ids:
+            item = by_id.get(request_id)
+            if item is None:
+                raise ValueError('Incomplete JSON-RPC batch response')
+            if 'error' in item:
+                err = item['error']
+                raise RpcError(err.get('code'), err.get('message'), err.get('data'))
+            results.append(item['result'])
+        return results
+
+    def _batched(self, calls):
+        # Results of any number of calls, MAX_BATCH per HTTP request
+        results = []
+        for start in range(0, len(calls), MAX_BATCH):
+            chunk = calls[start:start + MAX_BATCH]
+            if len(chunk) == 1:
+                results.append(self.call(*chunk[0]))
+            else:
+                results.extend(self.call_batch(chunk))
+        return results
+
+    def get_program_accounts(self, program_id, config, context=None):
+        # The accounts are yielded as they are parsed, see stream()
+        return self.stream('getProgramAccounts', [program_id, config], context)
+
+    def get_latest_blockhash(self, commitment='confirmed'):
+        value = self.call('getLatestBlockhash', [{'commitment': commitment}])['value']
+        return value['blockhash'], value['lastValidBlockHeight']
+
+    def get_block_height(self, commitment='confirmed'):
+        return self.call('getBlockHeight', [{'commitment': commitment}])
+
+    def get_multiple_accounts(self, addresses, commitment='confirmed', data_slice=None):
+        # Any number of accounts, in the order of addresses (None for missing ones)
+        config = {'encoding': 'base64', 'commitment': commitment}
+        if data_slice is not None:
+            offset, length = data_slice
+            config['dataSlice'] = {'offset': offset, 'length': length}
+        calls = [('getMultipleAccounts', [addresses[start:start + MAX_MULTIPLE_ACCOUNTS], config])
+                 for start in range(0, len(addresses), MAX_MULTIPLE_ACCOUNTS)]
+        return [info for result in self._batched(calls) for info in result['value']]
+
+    def get_signature_statuses(self, signatures, search_history=False):
+        # Any number of signatures, in order (None for unknown ones)
+        config = {'searchTransactionHistory': search_history}
+        calls = [('getSignatureStatuses', [signatures[start:start + MAX_SIGNATURE_STATUSES], config])
+                 for start in range(0, len(signatures), MAX_SIGNATURE_STATUSES)]
+        return [status for result in self._batched(calls) for status in result['value']]
+
+    def send_transaction(self, tx_base64, skip_preflight=False, commitment='confirmed'):
+        return self.call('sendTransaction', [tx_base64, {
+            'encoding': 'base64',
+            'skipPreflight': skip_preflight,
+            'preflightCommitment': commitment,
+        }])
+
+
+class JsonRpcStream:
+    # Incremental parser for a JSON-RPC response body whose result is an array, or a
+    # withContext object holding the array in 'value'. Only one array item (plus a read
+    # chunk) is held in memory at a time. read(n) returns the next bytes of the body,
+    # b'' at its end.
+    def __init__(self, read, context=None):
+        self.context = context if context is not None else {}
+        self._read = read
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError('Unexpected end of the JSON-RPC response')
+        chunk = self._read(STREAM_CHUNK_SIZE)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk, final=self._eof)
+        self._pos = 0
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f'Malformed JSON-RPC response, expected {char!r}')
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Most likely cut off at the end of the buffer
+                self._fill()
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buf) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def _members(self):
+        # Walks an object, yielding each key. The caller consumes the key's value.
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._next_separator('}'):
+                return
+
+    def _items(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._next_separator(']'):
+                return
+
+    def _next_separator(self, closing):
+        # True at the end of the object or array, False after a ','
+        char = self._peek()
+        self._pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            raise ValueError(f'Malformed JSON-RPC response, expected \',\' or {closing!r}')
+        return False
+
+    def results(self):
+        for key in self._members():
+            if key == 'result':
+                if self._peek() != '{':
+                    yield from self._items()
+                    continue
+                for inner in self._members():
+                    if inner == 'value':
+                        yield from self._items()
+                    elif inner == 'context':
+                        self.context.update(self._value())
+                    else:
+                        self._value()
+            elif key == 'error':
+                err = self._value()
+                raise RpcError(err.get('code'), err.get('message'), err.get('data'))
+            else:
+                self._value()
+
+
+class Endpoint:
+    def __init__(self, url, timeout):
+        self.url = url
+        self.client = RpcClient(url, timeout)
+        self.latency = None      # seconds, moving average
+        self.error_rate = 0.0    # moving average of failed requests
+        self.failures = 0
+        self.ejected = False
+        self.cooldown = EJECT_COOLDOWN
+        self.probe_at = 0.0
+        self.probes = 0
+
+    def weight(self, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        return max(0.05, 1.0 - self.error_rate) / max(latency, 0.001)
+
+
+class RpcPool(RpcClient):
+    # Same interface as RpcClient, spread over several endpoints. Each request goes to
+    # an endpoint picked at random, weighted by its observed latency and error rate, and
+    # fails over to another endpoint on connection errors, HTTP errors and throttling.
+    # An endpoint that keeps failing is ejected. A background thread probes it with
+    # getHealth, and it's re-admitted after READMIT_PROBES successful probes in a row.
+    def __init__(self, urls, timeout=30, rate=None):
+        if isinstance(urls, str):
+            urls = parse_urls(urls)
+        if not urls:
+            raise ValueError('No RPC endpoint given')
+        self.url = ', '.join(urls)
+        self.timeout = timeout
+        self.rate = rate
+        self.endpoints = [Endpoint(url, timeout) for url in urls]
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def pick(self, exclude=()):
+        with self._lock:
+            candidates = [e for e in self.endpoints if not e.ejected and e not in exclude]
+            if not candidates:
+                # Everything is ejected, the least bad endpoint is better than nothing
+                return min((e for e in self.endpoints if e not in exclude),
+                           key=lambda e: e.error_rate)
+            known = [e.latency for e in candidates if e.latency is not None]
+            default_latency = sum(known) / len(known) if known else 1.0
+            weights = [e.weight(default_latency) for e in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def record(self, endpoint, ok, latency=None):
+        with self._lock:
+            endpoint.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            if ok:
+                endpoint.failures = 0
+                if latency is not None:
+                    if endpoint.latency is None:
+                        endpoint.latency = latency
+                    else:
+                        endpoint.latency += EWMA_ALPHA * (latency - endpoint.latency)
+                if endpoint.error_rate < 0.1:
+                    endpoint.cooldown = EJECT_COOLDOWN
+                return
+            endpoint.failures += 1
+            # With a single endpoint there is nothing to fail over to
+            if endpoint.ejected or len(self.endpoints) == 1:
+                return
+            if endpoint.failures >= EJECT_FAILURES or endpoint.error_rate >= EJECT_ERROR_RATE:
+                endpoint.ejected = True
+                endpoint.probes = 0
+                endpoint.probe_at = time.monotonic() + endpoint.cooldown
+                if self._prober is None:
+                    self._prober = threading.Thread(target=self._probe_loop, daemon=True)
+                    self._prober.start()
+
+    def healthy_count(self):
+        with self._lock:
+            return sum(1 for e in self.endpoints if not e.ejected)
+
+    def _call(self, method, params):
+        return self._failover(lambda client: client._call(method, params))
+
+    def _call_batch(self, calls):
+        return self._failover(lambda client: client._call_batch(calls))
+
+    def _failover(self, request):
+        tried = []
+        while True:
+            endpoint = self.pick(tried)
+            start = time.monotonic()
+            try:
+                result = request(endpoint.client)
+            except RpcError as e:
+                if not is_throttle(e):
+                    # The endpoint is fine, the request itself was rejected
+                    self.record(endpoint, True, time.monotonic() - start)
+                    raise
+                err = e
+            except (HttpError, OSError, ValueError, http.client.HTTPException) as e:
+                err = e
+            else:
+                self.record(endpoint, True, time.monotonic() - start)
+                return result
+            self.record(endpoint, False)
+            tried.append(endpoint)
+            if len(tried) == len(self.endpoints):
+                raise err
+
+    def _stream(self, method, params, context=None):
+        # Fails over like _call(), but only until the first item arrives
+        tried = []
+        while True:
+            endpoint = self.pick(tried)
+            start = time.monotonic()
+            items = endpoint.client._stream(method, params, context)
+            try:
+                first = next(items, _END)
+            except RpcError as e:
+                if not is_throttle(e):
+                    self.record(endpoint, True, time.monotonic() - start)
+                    raise
+                err = e
+            except (HttpError, OSError, ValueError, http.client.HTTPException) as e:
+                err = e
+            else:
+                self.record(endpoint, True, time.monotonic() - start)
+                if first is not _END:
+                    yield first
+                    yield from items
+                return
+            self.record(endpoint, False)
+            tried.append(endpoint)
+            if len(tried) == len(self.endpoints):
+                raise err
+
+    def _probe_loop(self):
+        while True:
+            with self._lock:
+                ejected = [e for e in self.endpoints if e.ejected]
+                if not ejected:
+                    self._prober = None
+                    return
+                now = time.monotonic()
+                due = [e for e in ejected if e.probe_at <= now]
+                wait = min(e.probe_at for e in ejected) - now
+            if not due:
+                time.sleep(wait)
+            for endpoint in due:
+                self._probe(endpoint)
+
+    def _probe(self, endpoint):
+        start = time.monotonic()
+        try:
+            endpoint.client._call('getHealth', None)
+            ok = True
+        except (RpcError, HttpError, OSError, ValueError, http.client.HTTPException):
+            ok = False
+        now = time.monotonic()
+        with self._lock:
+            if not ok:
+                endpoint.probes = 0
+                endpoint.cooldown = min(MAX_EJECT_COOLDOWN, endpoint.cooldown * 2)
+                endpoint.probe_at = now + endpoint.cooldown
+                return
+            endpoint.probes += 1
+            if endpoint.probes < READMIT_PROBES:
+                endpoint.probe_at = now + PROBE_INTERVAL
+                return
+            # Re-admitted on probation: a couple more failures eject it again
+            endpoint.ejected = False
+            endpoint.failures = 0
+            endpoint.error_rate = EJECT_ERROR_RATE / 2
+            endpoint.latency = now - start
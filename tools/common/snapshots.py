@@ -0,0 +1,194 @@
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+from common.ata_cache import CACHE_DIR
+
+SNAPSHOT_DB = os.path.join(CACHE_DIR, 'snapshots.sqlite')
+INSERT_BATCH_SIZE = 10000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    mint TEXT NOT NULL,
+    slot INTEGER,
+    decimals INTEGER NOT NULL,
+    created TEXT NOT NULL,
+    UNIQUE (mint, slot)
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    snapshot INTEGER NOT NULL,
+    token_account TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    -- Raw u64 amounts don't always fit in a SQLite integer
+    amount TEXT NOT NULL,
+    PRIMARY KEY (snapshot, token_account)
+);
+'''
+
+
+class Snapshot:
+    def __init__(self, id, mint, slot, decimals, created, count=None):
+        self.id = id
+        self.mint = mint
+        self.slot = slot
+        self.decimals = decimals
+        self.created = created
+        self.count = count
+
+
+class SnapshotStore:
+    # Local store of fetched token accounts (token account, owner, raw amount), one
+    # snapshot per mint and slot, so address lists and deltas between two fetches can be
+    # produced without the RPC.
+    def __init__(self, path=SNAPSHOT_DB):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(self.path)
+        # Lets other processes read snapshots while the watch mode writes one
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        self._remove_unfinished()
+
+    def _remove_unfinished(self):
+        # Snapshots without a slot were left by a writer that never finished, e.g. the
+        # process was killed after part of the snapshot was committed
+        try:
+            ids = [row[0] for row in self._db.execute('SELECT id FROM snapshots WHERE slot IS NULL')]
+            delete_snapshots(self._db, ids)
+            self._db.commit()
+        except sqlite3.OperationalError:
+            # Another process is writing a snapshot, its rows are cleaned up another time
+            self._db.rollback()
+
+    def close(self):
+        self._db.close()
+
+    def writer(self, mint, decimals):
+        return SnapshotWriter(self._db, mint, decimals)
+
+    def list_snapshots(self, mint):
+        rows = self._db.execute(
+            'SELECT s.id, s.mint, s.slot, s.decimals, s.created, '
+            '(SELECT COUNT(*) FROM accounts WHERE snapshot = s.id) '
+            'FROM snapshots s WHERE mint = ? AND slot IS NOT NULL ORDER BY slot',
+            (mint,))
+        return [Snapshot(*row) for row in rows]
+
+    def find(self, mint, slot):
+        # slot is a slot number, 'latest' or 'previous' (the one before the latest)
+        if slot in ('latest', 'previous'):
+            snapshots = self.list_snapshots(mint)
+            index = -1 if slot == 'latest' else -2
+            if len(snapshots) < -index:
+                raise ValueError(f'No {slot} snapshot of {mint} in {self.path}')
+            return snapshots[index]
+        if not str(slot).isdigit():
+            raise ValueError(f'Invalid snapshot slot: {slot}')
+        row = self._db.execute(
+            'SELECT id, mint, slot, decimals, created FROM snapshots '
+            'WHERE mint = ? AND slot = ?', (mint, int(slot))).fetchone()
+        if row is None:
+            raise ValueError(f'No snapshot of {mint} at slot {slot} in {self.path}')
+        return Snapshot(*row)
+
+    def accounts(self, snapshot):
+        # (token account, owner, raw amount) of every account, in the order fetched
+        rows = self._db.execute(
+            'SELECT token_account, owner, amount FROM accounts '
+            'WHERE snapshot = ? ORDER BY rowid', (snapshot.id,))
+        for token_account, owner, amount in rows:
+            yield token_account, owner, int(amount)
+
+    def holdings(self, snapshot, address_type):
+        # Raw amount held by every owner or token account address
+        holdings = {}
+        for token_account, owner, amount in self.accounts(snapshot):
+            address = owner if address_type == 'owner' else token_account
+            holdings[address] = holdings.get(address, 0) + amount
+        return holdings
+
+    def update(self, snapshot, rows, slot, removed=()):
+        # Move a snapshot forward to slot, with the (token account, owner, raw amount)
+        # rows that changed since its last slot and the token accounts that were closed.
+        # Used by the watch mode.
+        self._db.executemany(
+            'INSERT OR REPLACE INTO accounts (snapshot, token_account, owner, amount) '
+            'VALUES (?, ?, ?, ?)',
+            [(snapshot.id, token_account, owner, str(amount))
+             for token_account, owner, amount in rows])
+        self._db.executemany(
+            'DELETE FROM accounts WHERE snapshot = ? AND token_account = ?',
+            [(snapshot.id, token_account) for token_account in removed])
+        replaced = self._db.execute('SELECT id FROM snapshots WHERE mint = ? AND slot = ? AND id != ?',
+                                    (snapshot.mint, slot, snapshot.id))
+        delete_snapshots(self._db, [row[0] for row in replaced])
+        self._db.execute('UPDATE snapshots SET slot = ? WHERE id = ?', (slot, snapshot.id))
+        self._db.commit()
+        snapshot.slot = slot
+
+
+class SnapshotWriter:
+    # Adds the accounts of one fetch to the store. Nothing is visible until close(),
+    # which replaces an earlier snapshot of the same mint and slot; abort() discards it.
+    def __init__(self, db, mint, decimals):
+        self._db = db
+        self._rows = []
+        self.mint = mint
+        self.decimals = int(decimals)
+        self.created = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.id = db.execute(
+            'INSERT INTO snapshots (mint, slot, decimals, created) VALUES (?, NULL, ?, ?)',
+            (mint, self.decimals, self.created)).lastrowid
+
+    def add(self, token_account, owner, amount):
+        self._rows.append((self.id, token_account, owner, str(amount)))
+        if len(self._rows) >= INSERT_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        # INSERT OR REPLACE, an account can show up twice in overlapping shards
+        self._db.executemany(
+            'INSERT OR REPLACE INTO accounts (snapshot, token_account, owner, amount) '
+            'VALUES (?, ?, ?, ?)', self._rows)
+        self._rows = []
+
+    def close(self, slot):
+        self._flush()
+        old = self._db.execute('SELECT id FROM snapshots WHERE mint = ? AND slot = ? AND id != ?',
+                               (self.mint, slot, self.id))
+        delete_snapshots(self._db, [row[0] for row in old])
+        self._db.execute('UPDATE snapshots SET slot = ? WHERE id = ?', (slot, self.id))
+        self._db.commit()
+        return Snapshot(self.id, self.mint, slot, self.decimals, self.created)
+
+    def abort(self):
+        self._rows = []
+        self._db.rollback()
+        # Rows that were already committed (by another commit on the same connection)
+        delete_snapshots(self._db, [self.id])
+        self._db.commit()
+
+
+def delete_snapshots(db, ids):
+    # Snapshots and their accounts, in the caller's transaction
+    for id in ids:
+        db.execute('DELETE FROM accounts WHERE snapshot = ?', (id,))
+        db.execute('DELETE FROM snapshots WHERE id = ?', (id,))
+
+
+def diff_holdings(old, new):
+    # Compares two {address: raw amount} maps. A holder is an address with a positive
+    # balance. Returns the new holders, the exited holders and the holders whose
+    # balance changed, as (address, old amount, new amount) lists.
+    new_holders, exited, changed = [], [], []
+    for address, amount in new.items():
+        before = old.get(address, 0)
+        if amount > 0 and before == 0:
+            new_holders.append((address, 0, amount))
+        elif amount > 0 and amount != before:
+            changed.append((address, before, amount))
+    for address, amount in old.items():
+        if amount > 0 and new.get(address, 0) == 0:
+            exited.append((address, amount, 0))
+    return new_holders, exited, changed
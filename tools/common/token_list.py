@@ -0,0 +1,88 @@
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+from common.ata_cache import CACHE_DIR
+
+TOKEN_LIST_CACHE = os.path.join(CACHE_DIR, 'token-list.json')
+# Seconds a cached token list is used without asking the server if it changed
+TOKEN_LIST_TTL = 24 * 60 * 60
+TOKEN_LIST_TIMEOUT = 10
+
+
+class TokenList:
+    # Mint -> symbol index of the token list, cached in CACHE_DIR/token-list.json. The
+    # list is only downloaded when the cache is older than ttl, and then with the ETag
+    # and Last-Modified of the cached copy, so an unchanged list is a 304 without a body.
+    # urls are tried in order (e.g. GitHub, then a CDN mirror). If none of them
+    # answers, the cached index is used however old it is.
+    def __init__(self, urls, path=TOKEN_LIST_CACHE, ttl=TOKEN_LIST_TTL, timeout=TOKEN_LIST_TIMEOUT):
+        self.urls = list(urls)
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.timeout = timeout
+        self._cache = None
+
+    def symbol(self, mint, offline=False):
+        # Symbol of the mint, or None. With offline, only the cache is used.
+        cache = self._load()
+        if not offline and time.time() - cache.get('checked', 0) >= self.ttl:
+            cache = self.refresh()
+        return cache['symbols'].get(mint)
+
+    def refresh(self):
+        # Revalidate or download the list. Returns the cache, updated if a server answered.
+        cache = self._load()
+        for url in self.urls:
+            headers = {}
+            # Validators are only meaningful to the server that sent them
+            if cache.get('url') == url:
+                if cache.get('etag'):
+                    headers['If-None-Match'] = cache['etag']
+                if cache.get('last_modified'):
+                    headers['If-Modified-Since'] = cache['last_modified']
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                            timeout=self.timeout) as response:
+                    data = json.load(response)
+                    cache = {
+                        'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'symbols': {token['address']: token['symbol'] for token in data['tokens']},
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    continue
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            cache['checked'] = time.time()
+            self._save(cache)
+            return cache
+        return cache
+
+    def _load(self):
+        if self._cache is None:
+            try:
+                with open(self.path) as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = None
+            if not isinstance(self._cache, dict) or not isinstance(self._cache.get('symbols'), dict):
+                self._cache = {'symbols': {}}
+        return self._cache
+
+    def _save(self, cache):
+        self._cache = cache
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Written next to the cache and renamed, so a reader never sees half a file
+            temp = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp, self.path)
+        except OSError:
+            # The index still works for this run
+            pass
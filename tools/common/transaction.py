@@ -0,0 +1,112 @@
+import struct
+
+from common.keys import (pubkey_bytes, TOKEN_PROGRAM_ID,
+                         ASSOCIATED_TOKEN_PROGRAM_ID, SYSTEM_PROGRAM_ID)
+
+# Maximum size of a serialized transaction (IPv6 MTU minus headers)
+PACKET_DATA_SIZE = 1232
+
+# SPL Token instruction tags
+TOKEN_TRANSFER_CHECKED = 12
+# Associated Token Account program instruction tags
+ATA_CREATE_IDEMPOTENT = 1
+
+
+class AccountMeta:
+    def __init__(self, pubkey, is_signer, is_writable):
+        self.pubkey = pubkey_bytes(pubkey)
+        self.is_signer = is_signer
+        self.is_writable = is_writable
+
+
+class Instruction:
+    def __init__(self, program_id, accounts, data):
+        self.program_id = pubkey_bytes(program_id)
+        self.accounts = accounts
+        self.data = data
+
+
+def encode_length(n):
+    # Solana's compact-u16 ("shortvec") length prefix
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def transfer_checked(source, mint, destination, owner, amount, decimals):
+    return Instruction(TOKEN_PROGRAM_ID, [
+        AccountMeta(source, False, True),
+        AccountMeta(mint, False, False),
+        AccountMeta(destination, False, True),
+        AccountMeta(owner, True, False),
+    ], struct.pack('<BQB', TOKEN_TRANSFER_CHECKED, amount, decimals))
+
+
+def create_associated_token_account_idempotent(payer, associated, owner, mint):
+    return Instruction(ASSOCIATED_TOKEN_PROGRAM_ID, [
+        AccountMeta(payer, True, True),
+        AccountMeta(associated, False, True),
+        AccountMeta(owner, False, False),
+        AccountMeta(mint, False, False),
+        AccountMeta(SYSTEM_PROGRAM_ID, False, False),
+        AccountMeta(TOKEN_PROGRAM_ID, False, False),
+    ], bytes([ATA_CREATE_IDEMPOTENT]))
+
+
+def compile_message(fee_payer, instructions, recent_blockhash):
+    # Collect unique account keys, merging signer/writable flags
+    metas = {}
+    order = []
+
+    def add(key, is_signer, is_writable):
+        if key not in metas:
+            metas[key] = [is_signer, is_writable]
+            order.append(key)
+        else:
+            metas[key][0] |= is_signer
+            metas[key][1] |= is_writable
+
+    add(pubkey_bytes(fee_payer), True, True)
+    for ix in instructions:
+        for meta in ix.accounts:
+            add(meta.pubkey, meta.is_signer, meta.is_writable)
+        add(ix.program_id, False, False)
+
+    # Fee payer first, then signers before non-signers, writable before readonly
+    payer = order[0]
+    rest = sorted(order[1:], key=lambda k: (not metas[k][0], not metas[k][1]))
+    keys = [payer] + rest
+    index = {k: i for i, k in enumerate(keys)}
+
+    num_signers = sum(1 for k in keys if metas[k][0])
+    readonly_signed = sum(1 for k in keys if metas[k][0] and not metas[k][1])
+    readonly_unsigned = sum(1 for k in keys if not metas[k][0] and not metas[k][1])
+
+    msg = bytearray([num_signers, readonly_signed, readonly_unsigned])
+    msg += encode_length(len(keys))
+    for k in keys:
+        msg += k
+    msg += pubkey_bytes(recent_blockhash)
+    msg += encode_length(len(instructions))
+    for ix in instructions:
+        msg.append(index[ix.program_id])
+        msg += encode_length(len(ix.accounts))
+        msg += bytes(index[meta.pubkey] for meta in ix.accounts)
+        msg += encode_length(len(ix.data))
+        msg += ix.data
+    return bytes(msg), num_signers
+
+
+def build_transaction(signers, instructions, recent_blockhash):
+    # The first signer pays the fees
+    message, num_signers = compile_message(signers[0].public, instructions, recent_blockhash)
+    if num_signers != len(signers):
+        raise ValueError('Number of signers does not match the message header')
+    signatures = [s.sign(message) for s in signers]
+    return encode_length(len(signatures)) + b''.join(signatures) + message, signatures[0]
@@ -0,0 +1,286 @@
+import base64
+import http.client
+import threading
+import time
+
+from common import transaction
+from common.amounts import format_amount, to_base_units
+from common.base58 import b58encode
+from common.keys import get_associated_token_address, TOKEN_PROGRAM_ID
+from common.rpc import RpcError, HttpError, MAX_BATCH, MAX_MULTIPLE_ACCOUNTS, is_throttle
+
+TOKEN_ACCOUNT_SIZE = 165
+BLOCKHASH_MAX_AGE = 20   # seconds a fetched blockhash is reused for
+CONFIRM_POLL_INTERVAL = 0.5
+UNCONFIRMED_MSG = 'unable to confirm transaction. This can happen in situations such as transaction expiration and insufficient fee-payer funds'
+# Errors of a request whose outcome is not known: the connection broke, or the response
+# was cut off or could not be read (e.g. an HTML error page)
+UNKNOWN_OUTCOME_ERRORS = (OSError, ValueError, KeyError, IndexError, TypeError,
+                          http.client.HTTPException)
+# Placeholder used when sizing a message, any 32 byte value gives the same size
+SIZING_BLOCKHASH = bytes(32)
+
+
+class TransferError(Exception):
+    pass
+
+
+class PreparedTransfer:
+    # A single recipient's instructions, ready to be packed into a transaction.
+    # `index` is the recipient's position in the input list, set by the caller.
+    def __init__(self, recipient, amount, ui_amount, destination, funding, instructions):
+        self.index = None
+        self.recipient = recipient
+        self.amount = amount
+        self.ui_amount = ui_amount
+        self.destination = destination
+        self.funding = funding
+        self.instructions = instructions
+
+
+class TransferEngine:
+    # Builds, signs and sends SPL Token TransferChecked transactions over JSON-RPC,
+    # using the same keypair as the `solana` CLI. `client` is a common.rpc.RpcClient
+    # or RpcPool, `ata_cache` an optional common.ata_cache.AtaCache for the mint.
+    def __init__(self, client, keypair, mint, decimals, commitment='confirmed', ata_cache=None):
+        self.client = client
+        self.ata_cache = ata_cache
+        self.keypair = keypair
+        self.mint = mint
+        self.decimals = int(decimals)
+        self.commitment = commitment
+        self.source = get_associated_token_address(keypair.public, mint)
+        self._blockhash = None
+        self._blockhash_time = 0
+        self._blockhash_lock = threading.Lock()
+        # Optional common.journal.Journal, signatures are recorded before sending
+        self.journal = None
+
+    def recent_blockhash(self):
+        # Shared by all worker threads, only one of them refreshes it
+        with self._blockhash_lock:
+            if self._blockhash is None or time.monotonic() - self._blockhash_time > BLOCKHASH_MAX_AGE:
+                self._blockhash = self.client.get_latest_blockhash(self.commitment)
+                self._blockhash_time = time.monotonic()
+            return self._blockhash
+
+    def associated_address(self, owner):
+        if self.ata_cache is not None:
+            return self.ata_cache.get(owner)
+        return get_associated_token_address(owner, self.mint)
+
+    def resolve_recipient(self, recipient, fund_recipient, allow_unfunded_recipient):
+        # Returns the destination token account and any instructions needed before the transfer
+        try:
+            ata = self.associated_address(recipient)
+        except ValueError:
+            raise TransferError(f'Error: Invalid recipient address: {recipient}')
+        if self.ata_cache is not None:
+            self.ata_cache.flush()
+        recipient_info, ata_info = self.client.get_multiple_accounts(
+            [recipient, ata], self.commitment)
+        return self._resolve(recipient, ata, recipient_info, ata_info,
+                             fund_recipient, allow_unfunded_recipient)
+
+    def _resolve(self, recipient, ata, recipient_info, ata_info,
+                 fund_recipient, allow_unfunded_recipient):
+        if recipient_info is not None and recipient_info['owner'] == TOKEN_PROGRAM_ID:
+            data = base64.b64decode(recipient_info['data'][0])
+            if len(data) == TOKEN_ACCOUNT_SIZE:
+                if b58encode(data[:32]) != self.mint:
+                    raise TransferError(
+                        f'Error: Recipient token account {recipient} is not a {self.mint} token account')
+                return recipient, False, []
+
+        if not allow_unfunded_recipient and (recipient_info is None or recipient_info['lamports'] == 0):
+            raise TransferError(
+                'Error: The recipient address is not funded. Add `--allow-unfunded-recipient` to complete the transfer')
+
+        if ata_info is None:
+            if not fund_recipient:
+                raise TransferError(
+                    'Error: Recipient\'s associated token account does not exist. Add `--fund-recipient` to fund their account')
+            return ata, True, [transaction.create_associated_token_account_idempotent(
+                self.keypair.public, ata, recipient, self.mint)]
+        return ata, False, []
+
+    def build(self, instructions, refresh_blockhash=False):
+        # Returns the signed transaction, its signature and the last block height it can land in
+        if refresh_blockhash:
+            with self._blockhash_lock:
+                self._blockhash = None
+        blockhash, last_valid_height = self.recent_blockhash()
+        tx, signature = transaction.build_transaction([self.keypair], instructions, blockhash)
+        if len(tx) > transaction.PACKET_DATA_SIZE:
+            raise TransferError(f'Error: Transaction too large: {len(tx)} bytes')
+        return tx, b58encode(signature), last_valid_height
+
+    def send_raw(self, tx, skip_preflight=False):
+        # Sending the same signed bytes again is always safe, the network deduplicates by signature
+        self.client.send_transaction(base64.b64encode(tx).decode('ascii'),
+                                     skip_preflight=skip_preflight, commitment=self.commitment)
+
+    def record_sent(self, transfers, signature, last_valid_height):
+        if self.journal is not None:
+            self.journal.write_many('sent', transfers, signature, last_valid_height)
+
+    def send(self, instructions, transfers=()):
+        tx, signature, last_valid_height = self.build(instructions)
+        self.record_sent(transfers, signature, last_valid_height)
+        try:
+            self.send_raw(tx)
+        except RpcError:
+            # The node answered: the transaction was rejected, e.g. by preflight
+            raise
+        except HttpError as e:
+            # A throttled request was rejected before it was processed, any other HTTP
+            # error may come from a proxy after the node got the transaction
+            if is_throttle(e):
+                raise
+            raise TransferError(f'Error: {UNCONFIRMED_MSG} ({e})')
+        except UNKNOWN_OUTCOME_ERRORS as e:
+            # A timeout, a dropped connection or an unreadable response doesn't tell
+            # whether the node got the transaction
+            raise TransferError(f'Error: {UNCONFIRMED_MSG} ({type(e).__name__}: {e})')
+        return signature, last_valid_height
+
+    def prepare(self, transfers, fund_recipient=False, allow_unfunded_recipient=False):
+        # Resolve the destinations of many (recipient, amount in base units) pairs with
+        # batched account lookups. Returns a list of (ok, PreparedTransfer or error message),
+        # in input order.
+        results = []
+        # Two accounts per recipient, as many as one batched HTTP request holds
+        per_request = MAX_MULTIPLE_ACCOUNTS * MAX_BATCH // 2
+        for start in range(0, len(transfers), per_request):
+            chunk = transfers[start:start + per_request]
+            atas = []
+            keys = []
+            for recipient, _ in chunk:
+                try:
+                    ata = self.associated_address(recipient)
+                except ValueError:
+                    atas.append(None)
+                    continue
+                atas.append(ata)
+                keys.extend([recipient, ata])
+            if self.ata_cache is not None:
+                self.ata_cache.flush()
+            infos = iter(self.client.get_multiple_accounts(keys, self.commitment) if keys else [])
+            for (recipient, amount), ata in zip(chunk, atas):
+                if ata is None:
+                    results.append((False, f'Error: Invalid recipient address: {recipient}'))
+                    continue
+                recipient_info, ata_info = next(infos), next(infos)
+                ui_amount = format_amount(amount, self.decimals)
+                try:
+                    destination, funding, instructions = self._resolve(
+                        recipient, ata, recipient_info, ata_info,
+                        fund_recipient, allow_unfunded_recipient)
+                except (TransferError, ValueError) as e:
+                    results.append((False, str(e)))
+                    continue
+                instructions.append(transaction.transfer_checked(
+                    self.source, self.mint, destination, self.keypair.public,
+                    amount, self.decimals))
+                results.append((True, PreparedTransfer(
+                    recipient, amount, ui_amount, destination, funding, instructions)))
+        return results
+
+    def fits(self, prepared):
+        instructions = [ix for p in prepared for ix in p.instructions]
+        message, num_signers = transaction.compile_message(
+            self.keypair.public, instructions, SIZING_BLOCKHASH)
+        size = len(transaction.encode_length(num_signers)) + 64 * num_signers + len(message)
+        return size <= transaction.PACKET_DATA_SIZE
+
+    def pack(self, prepared, max_per_tx):
+        # Greedily fill each transaction with as many transfers as fit in a packet
+        batches = []
+        current = []
+        for p in prepared:
+            if current and (len(current) >= max_per_tx or not self.fits(current + [p])):
+                batches.append(current)
+                current = []
+            current.append(p)
+        if current:
+            batches.append(current)
+        return batches
+
+    def send_batch(self, batch):
+        # Same contract as transfer(), for a batch of PreparedTransfers sharing one transaction
+        try:
+            instructions = [ix for p in batch for ix in p.instructions]
+            signature, last_valid_height = self.send(
+                instructions, [(p.index, p.recipient, p.ui_amount) for p in batch])
+            self.confirm(signature, last_valid_height)
+        except (TransferError, RpcError, HttpError) as e:
+            return 1, b'', (str(e) + '\n').encode('utf-8')
+        except UNKNOWN_OUTCOME_ERRORS as e:
+            # Only raised before the transaction is sent (lookups, blockhash, journal),
+            # send() and confirm() report everything after that as unconfirmed
+            return 1, b'', f'Error: {e}\n'.encode('utf-8')
+
+        return 0, self.describe_batch(batch, signature).encode('utf-8'), b''
+
+    def describe_batch(self, batch, signature):
+        out = f'Transfer to {len(batch)} recipients\n'
+        out += f'  Sender: {self.source}\n'
+        for p in batch:
+            out += f'  Recipient: {p.recipient} ({p.destination}) amount: {p.ui_amount}'
+            out += ' (funded)\n' if p.funding else '\n'
+        out += f'\nSignature: {signature}\n'
+        return out
+
+    def confirm(self, signature, last_valid_height):
+        # The transaction was sent, so a failing status request must not be reported as
+        # a retryable RPC error: sending the transfer again could pay the recipient twice.
+        try:
+            self._confirm(signature, last_valid_height)
+        except (RpcError, HttpError) + UNKNOWN_OUTCOME_ERRORS as e:
+            raise TransferError(f'Error: {UNCONFIRMED_MSG} (status request failed: {type(e).__name__})')
+
+    def _confirm(self, signature, last_valid_height):
+        polls = 0
+        while True:
+            status = self.client.get_signature_statuses([signature])[0]
+            if status is not None:
+                if status.get('err') is not None:
+                    raise TransferError(f'Error: Transaction {signature} failed: {status["err"]}')
+                if status.get('confirmationStatus') in ('confirmed', 'finalized'):
+                    return
+            polls += 1
+            # Checking the block height on every poll would double the request count
+            if polls % 4 == 0 and self.client.get_block_height(self.commitment) > last_valid_height:
+                raise TransferError(f'Error: {UNCONFIRMED_MSG}')
+            time.sleep(CONFIRM_POLL_INTERVAL)
+
+    def transfer(self, recipient, amount, fund_recipient=False, allow_unfunded_recipient=False, index=None):
+        # Same contract as running `spl-token transfer`: (returncode, stdout, stderr).
+        # `index` is the recipient's position in the input list, for the journal.
+        try:
+            try:
+                base_units = to_base_units(amount, self.decimals)
+            except ValueError as e:
+                raise TransferError(f'Error: {e}')
+            destination, funding, instructions = self.resolve_recipient(
+                recipient, fund_recipient, allow_unfunded_recipient)
+            instructions.append(transaction.transfer_checked(
+                self.source, self.mint, destination, self.keypair.public,
+                base_units, self.decimals))
+            signature, last_valid_height = self.send(instructions, [(index, recipient, amount)])
+            self.confirm(signature, last_valid_height)
+        except (TransferError, RpcError, HttpError) as e:
+            return 1, b'', (str(e) + '\n').encode('utf-8')
+        except UNKNOWN_OUTCOME_ERRORS as e:
+            # Only raised before the transaction is sent (lookups, blockhash, journal),
+            # send() and confirm() report everything after that as unconfirmed
+            return 1, b'', f'Error: {e}\n'.encode('utf-8')
+
+        out = f'Transfer {amount} tokens\n'
+        out += f'  Sender: {self.source}\n'
+        out += f'  Recipient: {recipient}\n'
+        out += f'  Recipient associated token account: {destination}\n'
+        if funding:
+            out += '  Funding recipient associated token account\n'
+        out += f'\nSignature: {signature}\n'
+        return 0, out.encode('utf-8'), b''
@@ -0,0 +1,147 @@
+import base64
+import hashlib
+import os
+import socket
+import ssl
+import struct
+import threading
+from urllib.parse import urlsplit
+
+# Minimal RFC 6455 client, enough for the JSON-RPC pubsub API: text frames, ping/pong
+# and close. No extensions, no subprotocols.
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+def ws_url(http_url):
+    # Pubsub URL of an RPC endpoint: ws(s) on the same host. A local validator
+    # listens on the RPC port + 1 (8899 -> 8900).
+    parts = urlsplit(http_url)
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    netloc = parts.netloc
+    if parts.port is not None and parts.scheme == 'http':
+        netloc = f'{parts.hostname}:{parts.port + 1}'
+    return f'{scheme}://{netloc}{parts.path}'
+
+
+class WebSocket:
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        if parts.scheme not in ('ws', 'wss'):
+            raise ValueError(f'Not a websocket URL: {url}')
+        port = parts.port or (443 if parts.scheme == 'wss' else 80)
+        sock = socket.create_connection((parts.hostname, port), timeout=timeout)
+        if parts.scheme == 'wss':
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+        self._sock = sock
+        self._file = sock.makefile('rb')
+        self._send_lock = threading.Lock()
+        self.closed = False
+        self._handshake(parts)
+
+    def _handshake(self, parts):
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request = (f'GET {path} HTTP/1.1\r\n'
+                   f'Host: {parts.netloc}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   f'Sec-WebSocket-Key: {key}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n\r\n')
+        self._sock.sendall(request.encode())
+        status = self._file.readline().decode('latin-1')
+        headers = {}
+        while True:
+            line = self._file.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if status.split(' ')[1:2] != ['101']:
+            raise ConnectionError(f'Websocket handshake failed: {status.strip()}')
+        accept = base64.b64encode(hashlib.sha1((key + _GUID).encode()).digest()).decode()
+        if headers.get('sec-websocket-accept') != accept:
+            raise ConnectionError('Websocket handshake failed: bad Sec-WebSocket-Accept')
+        # The handshake is done, frames are read without a deadline
+        self._sock.settimeout(None)
+
+    def _send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        # Client frames are always masked
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        with self._send_lock:
+            self._sock.sendall(header + mask + masked)
+
+    def _read_exact(self, n):
+        data = self._file.read(n)
+        if len(data) != n:
+            raise ConnectionError('Websocket connection closed')
+        return data
+
+    def _read_frame(self):
+        first, second = self._read_exact(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read_exact(8))[0]
+        mask = self._read_exact(4) if second & 0x80 else None
+        payload = self._read_exact(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return fin, opcode, payload
+
+    def send(self, text):
+        self._send_frame(OP_TEXT, text.encode('utf-8'))
+
+    def ping(self, payload=b''):
+        self._send_frame(OP_PING, payload)
+
+    def recv(self):
+        # Returns the next text (or binary) message. Control frames are handled here,
+        # a close frame raises ConnectionError.
+        message = b''
+        kind = OP_TEXT
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                self.close()
+                raise ConnectionError('Websocket closed by the server')
+            if opcode != OP_CONTINUATION:
+                kind = opcode
+            message += payload
+            if fin:
+                return message.decode('utf-8') if kind == OP_TEXT else message
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send_frame(OP_CLOSE, struct.pack('!H', 1000))
+            # Wakes up a thread blocked in recv()
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._file.close()
+        self._sock.close()
@@ -7,6 +7,20 @@ import signal
 import os
 import subprocess
 import re
+from decimal import Decimal, InvalidOperation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.addresslist import read_addresses
+from common.airdrop import Airdrop, NativeTransferCmd, OUTPUT_LOCK
+from common.amounts import format_amount, to_base_units
+from common.ata_cache import AtaCache
+from common.balances import get_token_balances
+from common.exclusions import Exclusions
+from common.journal import Journal
+from common.keys import get_cli_keypair_path, load_keypair
+from common.ratelimit import RateController
+from common.rpc import RpcPool, RpcError, HttpError
+from common.transfer import TransferEngine
 
 
 def get_env():
@@ -57,13 +71,13 @@ def amount_prompt(amount):
             try:
                 str = input(
                     "No airdrop amount was specified. Please enter the amount. \n> ")
-                value = float(str.strip())
-                if value > 0:
+                value = str.strip()
+                if Decimal(value) > 0:
                     break
                 else:
                     print("Airdrop amount must be greater than 0.")
-            except ValueError:
-                print("Not a float.")
+            except InvalidOperation:
+                print("Not a number.")
         return value
     else:
         return amount
@@ -82,7 +96,7 @@ def continue_airdrop_prompt(interactive, separator):
 
 
 def single_transaction_prompt(full_cmd, amount, recipient, decimals):
-    msg = f"Sending {bcolors.OKBLUE}{amount:,.{decimals}f}{bcolors.ENDC} tokens to recipient at: {bcolors.OKCYAN}{recipient}{bcolors.ENDC}.\n"
+    msg = f"Sending {bcolors.OKBLUE}{format_amount(amount, decimals, grouping=True)}{bcolors.ENDC} tokens to recipient at: {bcolors.OKCYAN}{recipient}{bcolors.ENDC}.\n"
     msg += "Cmd to be ran: \n"
     msg += f"    {bcolors.BOLD}" + full_cmd + f"{bcolors.ENDC}"
     print(msg, flush=True)
@@ -105,116 +119,42 @@ def gen_logfile(name, current_time, folder_prefix):
     return filename
 
 
-def parse_sig(log):
-    # Find the last line that has some text in it.
-    # That line should have the signature.
-    outlines = re.split('\n', log)
-    idx = len(outlines) - 1
-    while outlines[idx] == '':
-        idx = idx - 1
-    out = outlines[idx]
-    sig = re.match(r"Signature: ([a-zA-Z0-9]+)", out)
-    if sig:
-        return sig.group(1)
-    else:
-        return 'Error parsing signature - check the detailed logs.'
+# spl-token errors that are the endpoint's fault rather than the request's
+ENDPOINT_ERRORS = ('429 Too Many Requests', 'RPC response error -32005', 'error sending request')
 
 
-def run(cmd):
+def run(cmd, detached=False):
+    # Detached processes don't receive the terminal's SIGINT, so a transfer that
+    # is already running is allowed to finish and be logged.
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
+                            stderr=subprocess.PIPE,
+                            start_new_session=detached
                             )
     stdout, stderr = proc.communicate()
     return proc.returncode, stdout, stderr
 
 
-def try_transfer(cmd, addr, drop, log_success, log_unconfirmed, log_failed,
-                 TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED):
-    log_detail_entry = ''
-    while True:
-        code, out, err = run(cmd.to_list())
-        if code == 0:
-            output = out.decode('utf-8')
-            print(
-                f'{bcolors.OKGREEN}SUCCESS{bcolors.ENDC}', flush=True)
-            sig = parse_sig(output)
-            with open(log_success, 'a') as ls:
-                ls.write(f'{addr},{drop:f},{sig}\n')
-            log_detail_entry += output + '\n'
-            break
-        else:
-            err_msg = err.decode('utf-8')
-            if RPC_ERROR in err_msg:
-                print('-32005 RPC Error, waiting 5... ',
-                        end='', flush=True)
-                log_detail_entry += err_msg + '\n'
-                time.sleep(5)
-                continue
-            if RETRY_ON_429 and (TOO_MANY_REQUESTS in err_msg):
-                print('429, waiting 5... ', end='', flush=True)
-                time.sleep(5)
-                log_detail_entry += err_msg + '\n'
-                continue
-            if UNCONFIRMED in err_msg or TOO_MANY_REQUESTS in err_msg:
-                print(
-                    f'{bcolors.DANGER}UNCONFIRMED{bcolors.ENDC}', flush=True)
-                with open(log_unconfirmed, "a") as lu:
-                    lu.write(f'{addr},{drop:f},{err_msg}')
-                log_detail_entry += err_msg + '\n'
-                break
-
-            print(f'{bcolors.FAIL}FAILED{bcolors.ENDC}', flush=True)
-            try:
-                err_short = err_msg.split('\n', 1)[0] + '\n'
-                err_short = re.sub(r"[,]", ' ', err_short)
-            except (IndexError, Exception):
-                err_short = 'Error parsing error description - read the full logs.\n'
-            finally:
-                with open(log_failed, 'a') as lfa:
-                    lfa.write(f'{addr},{drop:f},{err_short}')
-            log_detail_entry += err_msg + '\n'
-            break
-    return log_detail_entry
-
-
-def get_assoc_addr(addr, mint, url):
-    cmd = ['spl-token', 'address', '--token', mint, '--owner', addr,
-           '--url', url, '--verbose']
-    code, output, _ = run(cmd)
-    if code == 0:
-        decoded = output.decode('utf-8')
-        out = (re.split('\n', decoded))[1]
-        assoc = re.match(r"Associated token address: ([a-zA-Z0-9]+)", out)
-        return True, assoc.group(1)
-    else:
-        return False, None
+def run_on_endpoint(build_cmd, detached=False):
+    # Run a Solana CLI command against one endpoint of the RPC pool, built with
+    # build_cmd(url), and record how the endpoint did
+    global RPC
+    endpoint = RPC.pick()
+    start = time.monotonic()
+    code, stdout, stderr = run(build_cmd(endpoint.url), detached)
+    failed = code != 0 and any(e in stderr.decode('utf-8', 'replace') for e in ENDPOINT_ERRORS)
+    RPC.record(endpoint, not failed, time.monotonic() - start)
+    return code, stdout, stderr
 
 
-def get_balance(addr, addr_type, mint, url):
-    if addr_type == 'token':
-        cmd = ['spl-token', 'balance', '--address', addr, '--url', url]
-        code, output, _ = run(cmd)
-        if code == 0 and output.decode('utf-8') != '':
-            return True, float(output.decode('utf-8'))
-        else:
-            return False, 'Could not find token account'
-    else:
-        ok, assoc_addr = get_assoc_addr(addr, mint, url)
-        if ok:
-            cmd = ['spl-token', 'balance',
-                   '--address', assoc_addr, '--url', url]
-            code, output, _ = run(cmd)
-            if code == 0 and output.decode('utf-8') != 0:
-                return True, float(output.decode('utf-8'))
-            else:
-                return False, 'Could not find token account'
-        else:
-            return False, 'Could not find token account'
+def ui(amount):
+    # Amounts are carried in base units, and formatted for logs and commands
+    global TOKEN_DECIMALS
+    return format_amount(amount, TOKEN_DECIMALS)
 
 
 class TransferCmd:
-    def __init__(self, cmd, instruction, mint_address, decimals, drop_amount, recipient, url, options=None):
+    def __init__(self, cmd, instruction, mint_address, decimals, drop_amount, recipient, url, options=None, detached=False):
         self.cmd = cmd
         self.instruction = instruction
         self.mint_address = mint_address
@@ -222,22 +162,35 @@ class TransferCmd:
         self.drop_amount = drop_amount
         self.recipient = recipient
         self.url = url
+        self.detached = detached
         if options is None:
             self.options = []
         else:
             self.options = options
 
     def to_str(self):
-        return f"{self.cmd} {self.instruction} {self.mint_address} {self.drop_amount:.{self.decimals}f} {self.recipient} {' '.join(self.options)}"
+        return f"{self.cmd} {self.instruction} {self.mint_address} {format_amount(self.drop_amount, self.decimals)} {self.recipient} {' '.join(self.options)}"
 
-    def to_list(self):
+    def to_list(self, url=None):
         #obj = [self.cmd, self.instruction, self.mint_address, str(self.drop_amount), self.recipient]
         obj = [self.cmd, self.instruction, self.mint_address,
-               f"{self.drop_amount:.{self.decimals}f}", self.recipient, '--url', self.url]
+               format_amount(self.drop_amount, self.decimals), self.recipient, '--url', url or self.url]
         if self.options:
             obj.extend(self.options)
         return obj
 
+    def execute(self):
+        return run_on_endpoint(self.to_list, self.detached)
+
+
+def transfer_cmd(engine, index, addr, drop, options, detached=False):
+    # The command that sends one recipient's drop with the selected backend
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL
+    if engine is not None:
+        return NativeTransferCmd(engine, TOKEN_DECIMALS, drop, addr, options, index=index)
+    return TransferCmd("spl-token", "transfer",
+        TOKEN_MINT, TOKEN_DECIMALS, drop, addr, RPC_URL, options, detached=detached)
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -253,7 +206,7 @@ class bcolors:
 
 
 def main():
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, RETRY_ON_429
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, JOURNAL_LOGS, RETRY_ON_429, RATE, RPC, ATA_CACHE
     args = parser.parse_args()
     mode = args.mode
     if not mode:
@@ -271,10 +224,11 @@ def main():
             FAILED_LOGS = env["FAILED_LOGS"]
             CANCELED_LOGS = env["CANCELED_LOGS"]
             UNCONFIRMED_LOGS = env["UNCONFIRMED_LOGS"]
+            JOURNAL_LOGS = env.get("JOURNAL_LOGS", JOURNAL_LOGS)
         except KeyError as e:
             sys.exit('Error reading config file: ' + str(e))
     else:
-        if RPC_URL == "":
+        if RPC_URL == "" and not args.url:
             rpc_endpoints = {
                 'mainnet': 'https://api.mainnet-beta.solana.com',
                 'testnet': 'https://api.testnet.solana.com',
@@ -289,11 +243,20 @@ def main():
             TOKEN_DECIMALS = int(
                 input("\nEnter the number of token decimals:\n> "))
 
+    if args.url:
+        RPC_URL = args.url
+    try:
+        RPC = RpcPool(RPC_URL)
+    except ValueError as e:
+        sys.exit(f'Error reading the RPC URL: {e}')
+    ATA_CACHE = AtaCache(TOKEN_MINT)
+
     if mode == 'check-before':
         input_file = args.file_name
         address_type = args.address_type
         drop = args.drop
-        before(input_file, drop, address_type)
+        exclusions = read_exclusions(args.excluded, args.exclude_off_curve)
+        before(input_file, drop, address_type, exclusions)
     elif mode == 'check-after':
         before_file = args.before_file_name
         addr_type = args.address_type
@@ -305,62 +268,101 @@ def main():
         fund_recipient = args.fund_recipient
         allow_unfunded_recipient = args.allow_unfunded_recipient
         RETRY_ON_429 = args.retry_on_429
+        RATE = RateController(max_rate=args.max_rate, retry_budget=args.retry_budget)
+        RPC.rate = RATE
+        backend = args.backend
+        batch_size = args.batch_size
+        concurrency = args.concurrency
+        pipeline = args.pipeline
+        resume_dir = args.resume_dir
+        exclusions = read_exclusions(args.excluded, args.exclude_off_curve)
         transfer(input_path, interactive,drop_amount, 
-            fund_recipient, allow_unfunded_recipient
+            fund_recipient, allow_unfunded_recipient, backend, batch_size, concurrency, pipeline, resume_dir,
+            exclusions
         )
 
 
-def before(input_file, drop, addr_type):  
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL
+def read_exclusions(excluded_paths, exclude_off_curve):
+    try:
+        return Exclusions(excluded_paths, off_curve=exclude_off_curve)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Error reading the exclusion files: {e}')
+
+
+def remove_excluded(addresses, exclusions):
+    # Excluded recipients are removed before anything else is done with the list
+    if not exclusions:
+        return addresses
+    kept = exclusions.filter(addresses)
+    print(f'Excluded {len(addresses) - len(kept)} of {len(addresses)} addresses.')
+    return kept
+
+
+def before(input_file, drop, addr_type, exclusions):  
+    global TOKEN_DECIMALS
     output_file = './before.csv'
     print('recipient,current-balance,expected-balance')
 
-    lines = []
-    with open(input_file, 'r') as f:
-        lines = f.readlines()
+    try:
+        drop = to_base_units(drop, TOKEN_DECIMALS)
+    except ValueError as e:
+        sys.exit(f'Exiting, {e}')
+    try:
+        addresses = read_addresses(input_file)
+    except (OSError, ValueError) as e:
+        sys.exit('Error reading input file: ' + str(e))
+    addresses = remove_excluded(addresses, exclusions)
+    balances = fetch_balances(addresses, addr_type)
 
     with open(output_file, 'w') as fw:
-        for line in lines:
-            try:
-                addr = line.strip()
-                ok, balance = get_balance(addr, addr_type, TOKEN_MINT, RPC_URL)
-            except (IndexError, ValueError) as e:
-                sys.exit('Error when reading input file: ' + str(e))
+        for addr, (ok, balance) in zip(addresses, balances):
             if ok:
-                expected = float(balance) + drop
-                print(f'{addr} - {balance:.3f} - {expected:.3f}')
-                fw.write(f'{addr},{balance:.{TOKEN_DECIMALS}f},{expected:.{TOKEN_DECIMALS}f}\n')
+                expected = balance + drop
+                print(f'{addr} - {ui(balance)} - {ui(expected)}')
+                fw.write(f'{addr},{ui(balance)},{ui(expected)}\n')
             else:
                 print(f'{addr} - No token account - No token account')
                 fw.write(f'{addr},No token account,No token account\n')
 
 
+def fetch_balances(addresses, addr_type):
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC, ATA_CACHE
+    try:
+        return get_token_balances(RPC, addresses, addr_type, TOKEN_MINT, ata_cache=ATA_CACHE)
+    except (RpcError, HttpError, OSError, ValueError) as e:
+        sys.exit(f'Error fetching token balances: {e}')
+
+
 def after(input_file, addr_type):
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL
+    global TOKEN_DECIMALS
     lines = []
     output_file = './after.csv'
     print('recipient,expected-balance,actual-balance,difference')
     with open(input_file, 'r') as f:
         lines = f.readlines()
 
+    # Read before.csv
+    rows = []
+    for line in lines:
+        try:
+            addr, _, expected = [x.strip() for x in line.split(',')]
+        except (IndexError, ValueError) as e:
+            sys.exit('Error reading input file: ' + str(e))
+        rows.append((addr, expected))
+    balances = fetch_balances([addr for addr, _ in rows], addr_type)
+
     with open(output_file, 'w') as f:
-        # Read before.csv
-        for line in lines:
-            output_line = ''
-            try:
-                addr, _, expected = [x.strip() for x in line.split(',')]
-                output_line += f'{addr},'
-            except IndexError as e:
-                sys.exit('Error reading input file: ' + str(e))
+        for (addr, expected), (ok, actual) in zip(rows, balances):
+            output_line = f'{addr},'
+            startc = endc = ''
 
             try:
-                expected = float(expected)
-                output_line += f'{expected:.{TOKEN_DECIMALS}f},'
+                expected = to_base_units(expected, TOKEN_DECIMALS)
+                output_line += f'{ui(expected)},'
             except ValueError:
                 # Not a number, expecting a No token account message
                 output_line += f'{expected},'
 
-            ok, actual = get_balance(addr, addr_type, TOKEN_MINT, RPC_URL)
             if ok:
                 endc = '\033[0m'
                 startc = ''
@@ -370,7 +372,7 @@ def after(input_file, addr_type):
                         startc = '\033[92m'
                     else:
                         startc = '\033[91m'
-                    output_line += f'{actual:.{TOKEN_DECIMALS}f},{diff:.{TOKEN_DECIMALS}f}'
+                    output_line += f'{ui(actual)},{ui(diff)}'
                 except TypeError:
                     # Assuming actual was not a number
                     diff = 'NaN'
@@ -383,124 +385,178 @@ def after(input_file, addr_type):
 
 
 def transfer(input_path, interactive, drop_amount, 
-            fund_recipient, allow_unfunded_recipient):
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS
+            fund_recipient, allow_unfunded_recipient, backend, batch_size, concurrency, pipeline, resume_dir,
+            exclusions):
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, JOURNAL_LOGS, RETRY_ON_429, RATE
     SEPARATOR = "-" * 50
-    LOG_SEPARATOR = "-" * 30 + "\n"
-    TOO_MANY_REQUESTS = "429 Too Many Requests"
-    UNCONFIRMED = "unable to confirm transaction"
-    RPC_ERROR = "RPC response error -32005"
 
     signal.signal(signal.SIGINT, signal.default_int_handler)
-    supply_code, current_supply, _ = run(['solana', 'address'])
+    if batch_size < 1:
+        sys.exit('Exiting, the batch size must be at least 1.')
+    if concurrency < 1:
+        sys.exit('Exiting, the concurrency must be at least 1.')
+    if batch_size > 1 and backend != 'native':
+        sys.exit('Exiting, batched transfers are only supported by the native backend.')
+    if pipeline and backend != 'native':
+        sys.exit('Exiting, pipelined transfers are only supported by the native backend.')
+
+    engine = None
+    if backend == 'native':
+        keypair_path = get_cli_keypair_path()
+        ok, keypair = load_keypair(keypair_path)
+        if not ok:
+            sys.exit(f'Exiting, failed to read the keypair at {keypair_path}: {keypair}')
+        wallet_address = keypair.pubkey + '\n'
+        engine = TransferEngine(RPC, keypair, TOKEN_MINT, TOKEN_DECIMALS, ata_cache=ATA_CACHE)
+    else:
+        supply_code, current_supply, _ = run(['solana', 'address'])
 
-    if supply_code != 0:
-        sys.exit('Exiting, failed to read the current supply account address. Try checking the output of \'solana address\'.')
+        if supply_code != 0:
+            sys.exit('Exiting, failed to read the current supply account address. Try checking the output of \'solana address\'.')
+        wallet_address = current_supply.decode('utf-8')
 
-    print(f"{bcolors.DANGER}WARNING: MAKE SURE YOU ARE USING THE CORRECT WALLET/SUPPLY/ TO DISTRIBUTE.\nYOUR CURRENT WALLET ADDRESS IS: {current_supply.decode('utf-8')}{bcolors.ENDC}")
+    print(f"{bcolors.DANGER}WARNING: MAKE SURE YOU ARE USING THE CORRECT WALLET/SUPPLY/ TO DISTRIBUTE.\nYOUR CURRENT WALLET ADDRESS IS: {wallet_address}{bcolors.ENDC}")
     print(
         f"Running airdrop for the Token Mint: {bcolors.OKGREEN}{TOKEN_MINT}{bcolors.ENDC}")
-    drop = amount_prompt(drop_amount)
+    try:
+        drop = to_base_units(amount_prompt(drop_amount), TOKEN_DECIMALS)
+    except ValueError as e:
+        sys.exit(f'Exiting, {e}')
     print(
-        f"Airdrop amount: {bcolors.OKGREEN}{drop:,.{TOKEN_DECIMALS}f}{bcolors.ENDC}")
+        f"Airdrop amount: {bcolors.OKGREEN}{format_amount(drop, TOKEN_DECIMALS, grouping=True)}{bcolors.ENDC}")
 
     try:
-        with open(input_path) as f:
-            address_list = f.read().splitlines()
+        address_list = remove_excluded(read_addresses(input_path), exclusions)
         print(f'Airdropping to {bcolors.OKGREEN}{len(address_list)} users{bcolors.ENDC}')
-        print(f'Estimated total tokens to be distributed: {bcolors.OKGREEN}{(len(address_list) * drop):,f}{bcolors.ENDC}\n')
-    except (OSError, IOError) as e:
-        sys.exit(f"Error opening address list files.\n{e.strerror}")
+        print(f'Estimated total tokens to be distributed: {bcolors.OKGREEN}{format_amount(len(address_list) * drop, TOKEN_DECIMALS, grouping=True)}{bcolors.ENDC}\n')
+    except (OSError, IOError, ValueError) as e:
+        sys.exit(f"Error opening address list files.\n{e}")
 
     # region Create log files, print locations, write headers
-    timestamp = get_current_utc_time_str()
-    log_success = gen_logfile(SUCCESS_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_canceled = gen_logfile(CANCELED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_failed = gen_logfile(FAILED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_unconfirmed = gen_logfile(UNCONFIRMED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_full = gen_logfile(FULL_LOGS, timestamp, LOG_FOLDER_PREFIX)
+    if resume_dir:
+        # Keep appending to the logs of the run that is being resumed
+        log_success = os.path.join(resume_dir, SUCCESS_LOGS)
+        log_canceled = os.path.join(resume_dir, CANCELED_LOGS)
+        log_failed = os.path.join(resume_dir, FAILED_LOGS)
+        log_unconfirmed = os.path.join(resume_dir, UNCONFIRMED_LOGS)
+        log_full = os.path.join(resume_dir, FULL_LOGS)
+        log_journal = os.path.join(resume_dir, JOURNAL_LOGS)
+        if not os.path.isfile(log_journal):
+            sys.exit(f'Exiting, no journal found at {log_journal}.')
+    else:
+        timestamp = get_current_utc_time_str()
+        log_success = gen_logfile(SUCCESS_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_canceled = gen_logfile(CANCELED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_failed = gen_logfile(FAILED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_unconfirmed = gen_logfile(UNCONFIRMED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_full = gen_logfile(FULL_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_journal = gen_logfile(JOURNAL_LOGS, timestamp, LOG_FOLDER_PREFIX)
 
     print(f"  Successful logs: (tail -f {log_success})")
     print(f"  Canceled logs: (tail -f {log_canceled})")
     print(f"  Failed logs: (tail -f {log_failed})")
     print(f"  Unconfirmed logs: (tail -f {log_unconfirmed})")
     print(f"  Detailed logs: (tail -f {log_full})")
-
-    with open(log_success, "a") as ls:
-        ls.write('recipient,amount,signature\n')
-    with open(log_canceled, "a") as lc:
-        lc.write('recipient,amount\n')
-    with open(log_failed, "a") as lfa:
-        lfa.write('recipient,amount,error\n')
-    with open(log_unconfirmed, "a") as lu:
-        lu.write('recipient,amount,error\n')
+    print(f"  Journal: {log_journal}")
+
+    if not resume_dir:
+        with OUTPUT_LOCK, open(log_success, "a") as ls:
+            ls.write('recipient,amount,signature\n')
+        with OUTPUT_LOCK, open(log_canceled, "a") as lc:
+            lc.write('recipient,amount\n')
+        with OUTPUT_LOCK, open(log_failed, "a") as lfa:
+            lfa.write('recipient,amount,error\n')
+        with OUTPUT_LOCK, open(log_unconfirmed, "a") as lu:
+            lu.write('recipient,amount,error\n')
     # endregion
 
     print()
+    journal = Journal(log_journal)
+    if engine is not None:
+        engine.journal = journal
+    airdrop = Airdrop(RPC, RATE, TOKEN_DECIMALS, journal, log_success, log_unconfirmed, log_failed,
+                      log_canceled, log_full, retry_on_429=RETRY_ON_429)
+    # Recipients are numbered by their position in the address list, which stays the
+    # same when a run is resumed
+    drops = [(i + 1, addr.strip(), drop) for i, addr in enumerate(address_list)]
+    skip, resumed = set(), []
+    if resume_dir:
+        skip, resumed = airdrop.resume(log_journal, drops)
+
     try:
         continue_airdrop_prompt(interactive, SEPARATOR)
-
-        i = 0
-        while i < len(address_list):
-            addr = (address_list[i]).strip()
+        airdrop.log_resumed(resumed)
+        drops = [(index, addr, drop) for index, addr, drop in drops if (index, addr) not in skip]
+
+        if pipeline and not interactive:
+            airdrop.pipelined_transfer(
+                engine, drops, batch_size, pipeline, fund_recipient, allow_unfunded_recipient)
+        elif batch_size > 1 and not interactive:
+            airdrop.batch_transfer(
+                engine, drops, batch_size, concurrency, fund_recipient, allow_unfunded_recipient)
+        elif concurrency > 1 and not interactive:
             options = []
             if fund_recipient:
                 options.append('--fund-recipient')
             if allow_unfunded_recipient:
                 options.append('--allow-unfunded-recipient')
-            cmd = TransferCmd("spl-token", "transfer",
-                TOKEN_MINT, TOKEN_DECIMALS, drop, addr, RPC_URL, options)
-            if not interactive:
-                log_detail_entry = ''
-                print(f"{i+1}. Airdrop to {addr}: ", end="", flush=True)
-                log_detail_entry += f"{i+1}. Cmdline: {cmd.to_str()}\n"
-                log_detail_entry += try_transfer(
-                    cmd, addr, drop, 
-                    log_success, log_unconfirmed, log_failed, 
-                    TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED)
-
-                with open(log_full, "a") as lf:
-                    lf.write(log_detail_entry + LOG_SEPARATOR)
-                del cmd
-                i += 1
-
-            elif interactive:
-                log_detail_entry = ""
-                print(f"{i+1}. ", end="", flush=True)
-                log_detail_entry += f"{i+1}. Cmdline: {cmd.to_str()}\n"
-
-                confirm, switch_mode = single_transaction_prompt(
-                    cmd.to_str(), drop, addr, TOKEN_DECIMALS)
-                if switch_mode:
-                    print("Switching to non-interactive mode.")
-                    interactive = False
-                    continue
-
-                if confirm:
-                    log_detail_entry += try_transfer(
-                        cmd, addr, drop, 
-                        log_success, log_unconfirmed, log_failed, 
-                        TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED)
+            airdrop.concurrent_transfer(
+                lambda index, addr, drop: transfer_cmd(engine, index, addr, drop, options, detached=True),
+                drops, concurrency)
+        else:
+            i = 0
+            while i < len(drops):
+                index, addr, drop = drops[i]
+                options = []
+                if fund_recipient:
+                    options.append('--fund-recipient')
+                if allow_unfunded_recipient:
+                    options.append('--allow-unfunded-recipient')
+                cmd = transfer_cmd(engine, index, addr, drop, options)
+                if not interactive:
+                    log_detail_entry = ''
+                    print(f"{index}. Airdrop to {addr}: ", end="", flush=True)
+                    log_detail_entry += f"{index}. Cmdline: {cmd.to_str()}\n"
+                    log_detail_entry += airdrop.try_transfer(cmd, index, addr, drop)
+
+                    airdrop.write_detail(log_detail_entry)
+                    del cmd
+                    i += 1
+
+                elif interactive:
+                    log_detail_entry = ""
+                    print(f"{index}. ", end="", flush=True)
+                    log_detail_entry += f"{index}. Cmdline: {cmd.to_str()}\n"
+
+                    confirm, switch_mode = single_transaction_prompt(
+                        cmd.to_str(), drop, addr, TOKEN_DECIMALS)
+                    if switch_mode:
+                        print("Switching to non-interactive mode.")
+                        interactive = False
+                        continue
+
+                    if confirm:
+                        log_detail_entry += airdrop.try_transfer(cmd, index, addr, drop)
                         
-                    with open(log_full, "a") as lf:
-                        lf.write(log_detail_entry + LOG_SEPARATOR)
-                elif not confirm:
-                    print(
-                        f"{bcolors.DANGER}CANCELED{bcolors.ENDC}", flush=True)
-                    cancel = f"{addr},{drop:f}"
-                    with open(log_canceled, "a") as lc:
-                        lc.write(cancel + "\n")
-                    log_detail_entry += f"Cancel: {cancel}\n"
-                    with open(log_full, "a") as lf:
-                        lf.write(log_detail_entry + LOG_SEPARATOR)
-
-                print(f"{bcolors.WARNING}{SEPARATOR}{bcolors.ENDC}")
-                del cmd
-                i += 1
+                        airdrop.write_detail(log_detail_entry)
+                    elif not confirm:
+                        print(
+                            f"{bcolors.DANGER}CANCELED{bcolors.ENDC}", flush=True)
+                        cancel = f"{addr},{ui(drop)}"
+                        airdrop.record('canceled', [(index, addr, drop)])
+                        with OUTPUT_LOCK, open(log_canceled, "a") as lc:
+                            lc.write(cancel + "\n")
+                        log_detail_entry += f"Cancel: {cancel}\n"
+                        airdrop.write_detail(log_detail_entry)
+
+                    print(f"{bcolors.WARNING}{SEPARATOR}{bcolors.ENDC}")
+                    del cmd
+                    i += 1
 
     except KeyboardInterrupt:
         sys.exit("Interrupted, exiting.")
     finally:
+        journal.close()
         print("Log file handlers closed.")
 
     print("Done!")
@@ -514,6 +570,16 @@ parser = argparse.ArgumentParser(
         received the expected amount of tokens. The application is dependent on Solana CLI \
         tools being available on the PATH (\'solana\' and \'spl-token\').'
 )
+parser.add_argument(
+    '-u',
+    '--url',
+    dest='url',
+    default='',
+    required=False,
+    help='One or more Solana RPC endpoints, separated by commas. Overrides RPC_URL from \
+        the config file. Requests are spread over the endpoints based on their latency \
+        and error rate, and failing endpoints are skipped until they recover.'
+)
 
 subparsers = parser.add_subparsers(
     help='Select usage mode: check before a distribution, check after or run a distribution (transfer).',
@@ -543,7 +609,7 @@ parser_b.add_argument(
     '--drop',
     metavar='DROP_AMOUNT',
     dest='drop',
-    type=float,
+    type=str,
     required=True,
     help='The amount of tokens that will be distributed to each recipient.'
 )
@@ -575,7 +641,7 @@ parser_t.add_argument(
     '-d',
     '--drop',
     dest="drop_amount",
-    type=float,
+    type=str,
     required=False,
     help='The amount of tokens that will be distributed to each recipient.'
 )
@@ -615,6 +681,103 @@ parser_t.add_argument(
     required=False,
     help='Retry when a HTTP 429 error code is encountered. Use this at your own risk.'
 )
+parser_t.add_argument(
+    '--max-rate',
+    dest='max_rate',
+    type=float,
+    default=100.0,
+    required=False,
+    help='Upper limit for the request rate, in requests per second (transfers per second with \
+        the spl-token backend). The rate starts low, grows while requests succeed and is \
+        halved when the RPC throttles (HTTP 429 or error -32005).'
+)
+parser_t.add_argument(
+    '--retry-budget',
+    dest='retry_budget',
+    type=int,
+    default=100,
+    required=False,
+    help='Number of throttled requests that are retried (with exponential backoff) before \
+        giving up on them. Every successful request adds a tenth of a retry back.'
+)
+parser_t.add_argument(
+    '--backend',
+    dest='backend',
+    choices={'native', 'spl-token'},
+    default='spl-token',
+    required=False,
+    help='Select how transfers are sent: build and sign them in-process over JSON-RPC (native), \
+        or run a \'spl-token transfer\' command for each recipient (spl-token). Both use the \
+        keypair configured in the Solana CLI. Defaults to spl-token; --batch-size and \
+        --pipeline need the native backend.'
+)
+parser_t.add_argument(
+    '--batch-size',
+    dest='batch_size',
+    type=int,
+    default=1,
+    required=False,
+    help='Maximum number of recipients per transaction (native backend, non-interactive mode). \
+        Each transaction is filled with as many transfers as fit, up to this value. If a batch \
+        fails, it is split and retried until the failing recipients are isolated.'
+)
+parser_t.add_argument(
+    '--concurrency',
+    dest='concurrency',
+    type=int,
+    default=1,
+    required=False,
+    help='Number of transfers (or batches) that are sent and confirmed at the same time \
+        in non-interactive mode. SIGINT stops starting new transfers and waits for the \
+        ones already in flight.'
+)
+parser_t.add_argument(
+    '--pipeline',
+    dest='pipeline',
+    metavar='MAX_PENDING',
+    type=int,
+    nargs='?',
+    const=256,
+    default=0,
+    required=False,
+    help='Send transactions without waiting for each confirmation (native backend, \
+        non-interactive mode). Confirmations are polled in batches, and transactions whose \
+        blockhash expired are re-sent. At most MAX_PENDING transactions (default 256) \
+        are unconfirmed at any time. Can be combined with --batch-size.'
+)
+parser_t.add_argument(
+    '--resume',
+    dest='resume_dir',
+    metavar='LOG_DIR',
+    default=None,
+    required=False,
+    help='Resume an interrupted distribution from its log folder, using the journal in it. \
+        Recipients that already received their tokens are skipped, and transactions with an \
+        unknown outcome are checked on-chain before anything is sent again. Use the same \
+        address list and drop amount as in the interrupted run.'
+)
+for subparser in (parser_b, parser_t):
+    subparser.add_argument(
+        '-e',
+        '--excluded',
+        dest='excluded',
+        metavar='EXCLUDED',
+        action='append',
+        default=[],
+        required=False,
+        help='Path to a file of addresses that are removed from the address list, one per \
+            line or first on a CSV line (e.g. the success log of an earlier distribution), \
+            or a binary address list. Can be repeated.'
+    )
+    subparser.add_argument(
+        '--exclude-off-curve',
+        dest='exclude_off_curve',
+        action='store_true',
+        default=False,
+        required=False,
+        help='Remove recipients that are off-curve addresses (program derived addresses, \
+            e.g. pools and vaults). Only for lists of owner addresses.'
+    )
 #endregion
 
 if __name__ == '__main__':
@@ -627,5 +790,9 @@ if __name__ == '__main__':
     FAILED_LOGS = 'failed.log'
     CANCELED_LOGS = 'canceled.log'
     UNCONFIRMED_LOGS = 'unconfirmed.log'
+    JOURNAL_LOGS = 'journal.log'
     RETRY_ON_429 = False
+    RATE = None
+    RPC = None
+    ATA_CACHE = None
     main()
@@ -7,7 +7,21 @@ import signal
 import os
 import subprocess
 import re
-from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.addresslist import load_balances
+from common.airdrop import Airdrop, NativeTransferCmd, OUTPUT_LOCK
+from common.allocation import allocate, read_allocation, write_allocation
+from common.amounts import format_amount, to_base_units
+from common.ata_cache import AtaCache
+from common.balances import get_token_balances
+from common.exclusions import Exclusions
+from common.journal import Journal
+from common.keys import get_cli_keypair_path, load_keypair
+from common.ratelimit import RateController
+from common.rpc import RpcPool, RpcError, HttpError
+from common.transfer import TransferEngine
 
 
 def get_env():
@@ -58,13 +72,13 @@ def amount_prompt(amount):
             try:
                 str = input(
                     "No airdrop amount was specified. Please enter the amount. \n> ")
-                value = float(str.strip())
-                if value > 0:
+                value = str.strip()
+                if Decimal(value) > 0:
                     break
                 else:
                     print("Airdrop amount must be greater than 0.")
-            except ValueError:
-                print("Not a float.")
+            except InvalidOperation:
+                print("Not a number.")
         return value
     else:
         return amount
@@ -83,7 +97,7 @@ def continue_airdrop_prompt(interactive, separator):
 
 
 def single_transaction_prompt(full_cmd, amount, recipient, decimals):
-    msg = f"Sending {bcolors.OKBLUE}{amount:,.{decimals}f}{bcolors.ENDC} tokens to recipient at: {bcolors.OKCYAN}{recipient}{bcolors.ENDC}.\n"
+    msg = f"Sending {bcolors.OKBLUE}{format_amount(amount, decimals, grouping=True)}{bcolors.ENDC} tokens to recipient at: {bcolors.OKCYAN}{recipient}{bcolors.ENDC}.\n"
     msg += "Cmd to be ran: \n"
     msg += f"    {bcolors.BOLD}" + full_cmd + f"{bcolors.ENDC}"
     print(msg, flush=True)
@@ -106,23 +120,8 @@ def gen_logfile(name, current_time, folder_prefix):
     return filename
 
 
-def parse_sig(log):
-    # Find the last line that has some text in it.
-    # That line should have the signature.
-    outlines = re.split('\n', log)
-    idx = len(outlines) - 1
-    while outlines[idx] == '':
-        idx = idx - 1
-    out = outlines[idx]
-    sig = re.match(r"Signature: ([a-zA-Z0-9]+)", out)
-    if sig:
-        return sig.group(1)
-    else:
-        return 'Error parsing signature - check the detailed logs.'
-
-
 class TransferCmd:
-    def __init__(self, cmd, instruction, mint_address, decimals, drop_amount, recipient, url, options=None):
+    def __init__(self, cmd, instruction, mint_address, decimals, drop_amount, recipient, url, options=None, detached=False):
         self.cmd = cmd
         self.instruction = instruction
         self.mint_address = mint_address
@@ -130,115 +129,68 @@ class TransferCmd:
         self.drop_amount = drop_amount
         self.recipient = recipient
         self.url = url
+        self.detached = detached
         if options is None:
             self.options = []
         else:
             self.options = options
 
     def to_str(self):
-        return f"{self.cmd} {self.instruction} {self.mint_address} {self.drop_amount:.{self.decimals}f} {self.recipient} {' '.join(self.options)}"
+        return f"{self.cmd} {self.instruction} {self.mint_address} {format_amount(self.drop_amount, self.decimals)} {self.recipient} {' '.join(self.options)}"
 
-    def to_list(self):
+    def to_list(self, url=None):
         #obj = [self.cmd, self.instruction, self.mint_address, str(self.drop_amount), self.recipient]
         obj = [self.cmd, self.instruction, self.mint_address,
-               f"{self.drop_amount:.{self.decimals}f}", self.recipient, '--url', self.url]
+               format_amount(self.drop_amount, self.decimals), self.recipient, '--url', url or self.url]
         if self.options:
             obj.extend(self.options)
         return obj
 
+    def execute(self):
+        return run_on_endpoint(self.to_list, self.detached)
 
-def run(cmd):
+
+# spl-token errors that are the endpoint's fault rather than the request's
+ENDPOINT_ERRORS = ('429 Too Many Requests', 'RPC response error -32005', 'error sending request')
+
+
+def run(cmd, detached=False):
+    # Detached processes don't receive the terminal's SIGINT, so a transfer that
+    # is already running is allowed to finish and be logged.
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
+                            stderr=subprocess.PIPE,
+                            start_new_session=detached
                             )
     stdout, stderr = proc.communicate()
     return proc.returncode, stdout, stderr
 
 
-def try_transfer(cmd, addr, drop, log_success, log_unconfirmed, log_failed,
-                 TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED):
-    global RETRY_ON_429
-    log_detail_entry = ''
-    while True:
-        code, out, err = run(cmd.to_list())
-        if code == 0:
-            output = out.decode('utf-8')
-            print(
-                f'{bcolors.OKGREEN}SUCCESS{bcolors.ENDC}', flush=True)
-            sig = parse_sig(output)
-            with open(log_success, 'a') as ls:
-                ls.write(f'{addr},{drop:f},{sig}\n')
-            log_detail_entry += output + '\n'
-            break
-        else:
-            err_msg = err.decode('utf-8')
-            if RPC_ERROR in err_msg:
-                print('-32005 RPC Error, waiting 5... ',
-                        end='', flush=True)
-                log_detail_entry += err_msg + '\n'
-                time.sleep(5)
-                continue
-            if RETRY_ON_429 and (TOO_MANY_REQUESTS in err_msg):
-                print('429, waiting 5... ', end='', flush=True)
-                time.sleep(5)
-                log_detail_entry += err_msg + '\n'
-                continue
-            if UNCONFIRMED in err_msg or TOO_MANY_REQUESTS in err_msg:
-                print(
-                    f'{bcolors.DANGER}UNCONFIRMED{bcolors.ENDC}', flush=True)
-                with open(log_unconfirmed, "a") as lu:
-                    lu.write(f'{addr},{drop:f},{err_msg}')
-                log_detail_entry += err_msg + '\n'
-                break
-
-            print(f'{bcolors.FAIL}FAILED{bcolors.ENDC}', flush=True)
-            try:
-                err_short = err_msg.split('\n', 1)[0] + '\n'
-                err_short = re.sub(r"[,]", ' ', err_short)
-            except (IndexError, Exception):
-                err_short = 'Error parsing error description - read the full logs.\n'
-            finally:
-                with open(log_failed, 'a') as lfa:
-                    lfa.write(f'{addr},{drop:f},{err_short}')
-            log_detail_entry += err_msg + '\n'
-            break
-    return log_detail_entry
-
-
-def get_assoc_addr(addr, mint, url):
-    cmd = ['spl-token', 'address', '--token', mint, '--owner', addr,
-           '--url', url, '--verbose']
-    code, output, _ = run(cmd)
-    if code == 0:
-        decoded = output.decode('utf-8')
-        out = (re.split('\n', decoded))[1]
-        assoc = re.match(r"Associated token address: ([a-zA-Z0-9]+)", out)
-        return True, assoc.group(1)
-    else:
-        return False, None
+def run_on_endpoint(build_cmd, detached=False):
+    # Run a Solana CLI command against one endpoint of the RPC pool, built with
+    # build_cmd(url), and record how the endpoint did
+    global RPC
+    endpoint = RPC.pick()
+    start = time.monotonic()
+    code, stdout, stderr = run(build_cmd(endpoint.url), detached)
+    failed = code != 0 and any(e in stderr.decode('utf-8', 'replace') for e in ENDPOINT_ERRORS)
+    RPC.record(endpoint, not failed, time.monotonic() - start)
+    return code, stdout, stderr
 
 
-def get_balance(addr, addr_type, mint, url):
-    if addr_type == 'token':
-        cmd = ['spl-token', 'balance', '--address', addr, '--url', url]
-        code, output, _ = run(cmd)
-        if code == 0 and output.decode('utf-8') != '':
-            return True, float(output.decode('utf-8'))
-        else:
-            return False, 'Could not find token account'
-    else:
-        ok, assoc_addr = get_assoc_addr(addr, mint, url)
-        if ok:
-            cmd = ['spl-token', 'balance',
-                   '--address', assoc_addr, '--url', url]
-            code, output, _ = run(cmd)
-            if code == 0 and output.decode('utf-8') != '':
-                return True, float(output.decode('utf-8'))
-            else:
-                return False, 'Could not find token account'
-        else:
-            return False, 'Could not find token account'
+def ui(amount):
+    # Amounts are carried in base units, and formatted for logs and commands
+    global TOKEN_DECIMALS
+    return format_amount(amount, TOKEN_DECIMALS)
+
+
+def transfer_cmd(engine, index, addr, drop, options, detached=False):
+    # The command that sends one recipient's drop with the selected backend
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL
+    if engine is not None:
+        return NativeTransferCmd(engine, TOKEN_DECIMALS, drop, addr, options, index=index)
+    return TransferCmd("spl-token", "transfer",
+        TOKEN_MINT, TOKEN_DECIMALS, drop, addr, RPC_URL, options, detached=detached)
 
 
 class bcolors:
@@ -257,7 +209,7 @@ class bcolors:
 def main():
     args = parser.parse_args()
     mode = args.mode
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, RETRY_ON_429
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, JOURNAL_LOGS, RETRY_ON_429, RATE, RPC, ATA_CACHE
     if not mode:
         sys.exit('Select a subcommand (-h)')
 
@@ -273,10 +225,11 @@ def main():
             FAILED_LOGS = env["FAILED_LOGS"]
             CANCELED_LOGS = env["CANCELED_LOGS"]
             UNCONFIRMED_LOGS = env["UNCONFIRMED_LOGS"]
+            JOURNAL_LOGS = env.get("JOURNAL_LOGS", JOURNAL_LOGS)
         except KeyError as e:
             sys.exit('Error reading config file: ' + str(e))
     else:
-        if RPC_URL == "":
+        if RPC_URL == "" and not args.url:
             rpc_endpoints = {
                 'mainnet': 'https://api.mainnet-beta.solana.com',
                 'testnet': 'https://api.testnet.solana.com',
@@ -291,11 +244,31 @@ def main():
             TOKEN_DECIMALS = int(
                 input("\nEnter the number of token decimals:\n> "))
 
-    if mode == 'check-before':
+    if args.url:
+        RPC_URL = args.url
+    try:
+        RPC = RpcPool(RPC_URL)
+    except ValueError as e:
+        sys.exit(f'Error reading the RPC URL: {e}')
+    ATA_CACHE = AtaCache(TOKEN_MINT)
+
+    if mode == 'check-before' and args.file_name and not args.drop:
+        parser.error('-d/--drop is required with -a/--address-list')
+    if mode in ('check-before', 'transfer') and args.allocation_file:
+        drop = args.drop if mode == 'check-before' else args.drop_amount
+        if drop or args.min_share or args.cap:
+            parser.error('-d/--drop, --min-share and --cap can\'t be used with --allocation, '
+                         'the shares are in the allocation file')
+
+    if mode == 'allocate':
+        exclusions = read_exclusions(args.excluded, args.exclude_off_curve)
+        allocate_drop(args.file_name, args.drop, args.min_share, args.cap, args.output_file, exclusions)
+    elif mode == 'check-before':
         input_file = args.file_name
         address_type = args.address_type
         drop = args.drop
-        before(input_file, drop, address_type)
+        exclusions = read_exclusions(args.excluded, args.exclude_off_curve)
+        before(input_file, drop, address_type, args.allocation_file, args.min_share, args.cap, exclusions)
     elif mode == 'check-after':
         before_file = args.before_file_name
         addr_type = args.address_type
@@ -307,212 +280,333 @@ def main():
         fund_recipient = args.fund_recipient
         allow_unfunded_recipient = args.allow_unfunded_recipient
         RETRY_ON_429 = args.retry_on_429
+        RATE = RateController(max_rate=args.max_rate, retry_budget=args.retry_budget)
+        RPC.rate = RATE
+        backend = args.backend
+        batch_size = args.batch_size
+        concurrency = args.concurrency
+        pipeline = args.pipeline
+        resume_dir = args.resume_dir
+        allocation_path = args.allocation_file
+        min_share = args.min_share
+        cap = args.cap
+        exclusions = read_exclusions(args.excluded, args.exclude_off_curve)
         transfer(input_path, interactive, drop_amount, 
-            fund_recipient, allow_unfunded_recipient
+            fund_recipient, allow_unfunded_recipient, backend, batch_size, concurrency, pipeline, resume_dir,
+            allocation_path, min_share, cap, exclusions
         )
 
 
-def before(input_file, drop, addr_type):
+def read_exclusions(excluded_paths, exclude_off_curve):
+    try:
+        return Exclusions(excluded_paths, off_curve=exclude_off_curve)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Error reading the exclusion files: {e}')
+
+
+def remove_excluded(exclusions, addresses, *columns):
+    # Excluded recipients are removed before anything else is done with the list
+    if not exclusions:
+        return (addresses, *columns)
+    kept = exclusions.remove(addresses, *columns)
+    print(f'Excluded {len(addresses) - len(kept[0])} of {len(addresses)} addresses.')
+    return kept
+
+
+def read_allocation_file(allocation_file, exclusions):
+    # An allocation file, without the excluded recipients. The shares of the others
+    # are not changed, the allocation is not computed again.
+    return remove_excluded(exclusions, *read_allocation(allocation_file, TOKEN_DECIMALS))
+
+
+def compute_allocation(input_file, total_drop, min_share, cap, exclusions):
+    # Addresses, balances and shares (base units) of a balance list (text or binary), with
+    # the total drop split by largest remainder over the holders that are not excluded;
+    # min_share and cap are token amounts, or None
+    global TOKEN_MINT, TOKEN_DECIMALS
+    addresses, balances = remove_excluded(
+        exclusions, *load_balances(input_file, TOKEN_MINT, TOKEN_DECIMALS))
+    min_share = to_base_units(min_share, TOKEN_DECIMALS) if min_share else 0
+    cap = to_base_units(cap, TOKEN_DECIMALS) if cap else None
+    return addresses, balances, allocate(balances, total_drop, min_share, cap)
+
+
+def allocate_drop(input_file, drop, min_share, cap, output_file, exclusions):
+    # Compute the shares once, for check-before and transfer (--allocation)
+    global TOKEN_DECIMALS
+    try:
+        total_drop = to_base_units(drop, TOKEN_DECIMALS)
+        addresses, balances, shares = compute_allocation(input_file, total_drop, min_share, cap,
+                                                         exclusions)
+        write_allocation(output_file, addresses, balances, shares, TOKEN_DECIMALS)
+    except (OSError, ValueError) as e:
+        sys.exit('Error computing the allocation: ' + str(e))
+
+    recipients = len(shares) - shares.count(0)
+    print(f'Allocated {format_amount(sum(shares), TOKEN_DECIMALS, grouping=True)} tokens to '
+          f'{recipients} recipients, {len(shares) - recipients} addresses get nothing.')
+    if cap:
+        print(f'{shares.count(to_base_units(cap, TOKEN_DECIMALS))} recipients are capped at {cap}.')
+    print(f'Allocation written to {output_file}')
+
+
+def before(input_file, drop, addr_type, allocation_file, min_share, cap, exclusions):
     global TOKEN_DECIMALS
     output_file = './before.csv'
     print('recipient,current-balance,expected-balance')
 
-    accounts = {}
-    with open(input_file, 'r') as f:
-        for line in f:
-            try:
-                addr, balance = line.split(',')
-                accounts[addr.strip()] = float(balance.strip())
-            except (IndexError, ValueError) as e:
-                sys.exit('Error reading input file: ' + str(e))
+    try:
+        if allocation_file:
+            addresses, balances, shares = read_allocation_file(allocation_file, exclusions)
+        else:
+            total_drop = to_base_units(drop, TOKEN_DECIMALS)
+            addresses, balances, shares = compute_allocation(input_file, total_drop, min_share, cap,
+                                                             exclusions)
+    except (OSError, ValueError) as e:
+        sys.exit('Error reading input file: ' + str(e))
 
     with open(output_file, 'w') as fw:
-        sum_of_balances = sum(accounts.values())
-        factor = float(drop) / sum_of_balances
+        for addr, balance, share in zip(addresses, balances, shares):
+            expected = balance + share
+            print(f'{addr} - {ui(balance)} - {ui(expected)}')
+            fw.write(f'{addr},{ui(balance)},{ui(expected)}\n')
 
-        for addr in accounts:
-            balance = accounts[addr]
-            expected = balance + balance * factor
-            print(f'{addr} - {balance:.3f} - {expected:.3f}')
-            fw.write(f'{addr},{balance:.{TOKEN_DECIMALS}f},{expected:.{TOKEN_DECIMALS}f}\n')
+
+def fetch_balances(addresses, addr_type):
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC, ATA_CACHE
+    try:
+        return get_token_balances(RPC, addresses, addr_type, TOKEN_MINT, ata_cache=ATA_CACHE)
+    except (RpcError, HttpError, OSError, ValueError) as e:
+        sys.exit(f'Error fetching token balances: {e}')
 
 
 def after(input_file, addr_type):
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL
+    global TOKEN_DECIMALS
     lines = []
     output_file = './after.csv'
     print('recipient,expected-balance,actual-balance,difference')
     with open(input_file, 'r') as f:
         lines = f.readlines()
 
+    # Read before.csv
+    rows = []
+    for line in lines:
+        try:
+            addr, _, expected = [x.strip() for x in line.split(',')]
+        except (IndexError, ValueError) as e:
+            sys.exit('Error reading input file: ' + str(e))
+        rows.append((addr, expected))
+    balances = fetch_balances([addr for addr, _ in rows], addr_type)
+
     with open(output_file, 'w') as f:
-            # Read before.csv
-            for line in lines:
-                output_line = ''
-                try:
-                    addr, _, expected = [x.strip() for x in line.split(',')]
-                    output_line += f'{addr},'
-                except IndexError as e:
-                    sys.exit('Error reading input file: ' + str(e))
+        for (addr, expected), (ok, actual) in zip(rows, balances):
+            output_line = f'{addr},'
+            startc = endc = ''
 
+            try:
+                expected = to_base_units(expected, TOKEN_DECIMALS)
+                output_line += f'{ui(expected)},'
+            except ValueError:
+                # Not a number, expecting a No token account message
+                output_line += f'{expected},'
+
+            if ok:
+                endc = '\033[0m'
+                startc = ''
                 try:
-                    expected = float(expected)
-                    output_line += f'{expected:.{TOKEN_DECIMALS}f},'
-                except ValueError:
-                    # Not a number, expecting a No token account message
-                    output_line += f'{expected},'
-
-                ok, actual = get_balance(addr, addr_type, TOKEN_MINT, RPC_URL)
-                if ok:
-                    endc = '\033[0m'
-                    startc = ''
-                    try:
-                        diff = actual - expected
-                        if diff >= 0:
-                            startc = '\033[92m'
-                        else:
-                            startc = '\033[91m'
-                        output_line += f'{actual:.{TOKEN_DECIMALS}f},{diff:.{TOKEN_DECIMALS}f}'
-                    except TypeError:
-                        # Assuming actual was not a number
-                        diff = 'NaN'
-                        output_line += f'{actual},{diff}'          
-                else:
-                    output_line += f'{actual},NaN'
+                    diff = actual - expected
+                    if diff >= 0:
+                        startc = '\033[92m'
+                    else:
+                        startc = '\033[91m'
+                    output_line += f'{ui(actual)},{ui(diff)}'
+                except TypeError:
+                    # Assuming actual was not a number
+                    diff = 'NaN'
+                    output_line += f'{actual},{diff}'          
+            else:
+                output_line += f'{actual},NaN'
 
-                print(startc + output_line + endc)
-                f.write(output_line + '\n')
+            print(startc + output_line + endc)
+            f.write(output_line + '\n')
 
 
 def transfer(input_path, interactive, drop_amount, 
-            fund_recipient, allow_unfunded_recipient):
-    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS
+            fund_recipient, allow_unfunded_recipient, backend, batch_size, concurrency, pipeline, resume_dir,
+            allocation_path, min_share, cap, exclusions):
+    global TOKEN_MINT, TOKEN_DECIMALS, RPC_URL, LOG_FOLDER_PREFIX, FULL_LOGS, SUCCESS_LOGS, FAILED_LOGS, CANCELED_LOGS, UNCONFIRMED_LOGS, JOURNAL_LOGS, RETRY_ON_429, RATE
     SEPARATOR = "-" * 50
-    LOG_SEPARATOR = "-" * 30 + "\n"
-    TOO_MANY_REQUESTS = "429 Too Many Requests"
-    UNCONFIRMED = "unable to confirm transaction"
-    RPC_ERROR = "RPC response error -32005"
 
     signal.signal(signal.SIGINT, signal.default_int_handler)
-    supply_code, current_supply, _ = run(['solana', 'address'])
+    if batch_size < 1:
+        sys.exit('Exiting, the batch size must be at least 1.')
+    if concurrency < 1:
+        sys.exit('Exiting, the concurrency must be at least 1.')
+    if batch_size > 1 and backend != 'native':
+        sys.exit('Exiting, batched transfers are only supported by the native backend.')
+    if pipeline and backend != 'native':
+        sys.exit('Exiting, pipelined transfers are only supported by the native backend.')
+
+    engine = None
+    if backend == 'native':
+        keypair_path = get_cli_keypair_path()
+        ok, keypair = load_keypair(keypair_path)
+        if not ok:
+            sys.exit(f'Exiting, failed to read the keypair at {keypair_path}: {keypair}')
+        wallet_address = keypair.pubkey + '\n'
+        engine = TransferEngine(RPC, keypair, TOKEN_MINT, TOKEN_DECIMALS, ata_cache=ATA_CACHE)
+    else:
+        supply_code, current_supply, _ = run(['solana', 'address'])
 
-    if supply_code != 0:
-        sys.exit('Exiting, failed to read the current wallet account address. Try checking the output of \'solana address\'.')
+        if supply_code != 0:
+            sys.exit('Exiting, failed to read the current wallet account address. Try checking the output of \'solana address\'.')
+        wallet_address = current_supply.decode('utf-8')
 
     print(f"{bcolors.DANGER}WARNING: MAKE SURE YOU ARE USING THE CORRECT WALLET TO DISTRIBUTE.\
-        \nYour current wallet address is: {current_supply.decode('utf-8')}{bcolors.ENDC}")
+        \nYour current wallet address is: {wallet_address}{bcolors.ENDC}")
     print(
         f"Running airdrop for the Token Mint: {bcolors.OKGREEN}{TOKEN_MINT}{bcolors.ENDC}")
-    total_drop = amount_prompt(drop_amount)
+    if allocation_path:
+        try:
+            addresses, _, shares = read_allocation_file(allocation_path, exclusions)
+        except (OSError, ValueError) as e:
+            sys.exit(f"Error opening or reading the allocation file: {str(e)}")
+        total_drop = sum(shares)
+    else:
+        try:
+            total_drop = to_base_units(amount_prompt(drop_amount), TOKEN_DECIMALS)
+        except ValueError as e:
+            sys.exit(f'Exiting, {e}')
+        try:
+            addresses, _, shares = compute_allocation(input_path, total_drop, min_share, cap, exclusions)
+        except (OSError, IOError, IndexError, ValueError) as e:
+            sys.exit(f"Error opening or reading address/exclusion files: {str(e)}")
     print(
-        f"Total airdrop amount: {bcolors.OKGREEN}{total_drop:,.{TOKEN_DECIMALS}f}{bcolors.ENDC}")
-
-    accounts = OrderedDict()
-    try:
-        with open(input_path) as f:
-            for line in f:
-                address, balance = line.split(',')
-                accounts[address.strip()] = float(balance.strip())
-        print(f'Airdropping to {bcolors.OKGREEN}{len(accounts)}{bcolors.ENDC} users\n')
-
-    except (OSError, IOError, IndexError, ValueError) as e:
-        sys.exit(f"Error opening or reading address/exclusion files: {str(e)}")
+        f"Total airdrop amount: {bcolors.OKGREEN}{format_amount(total_drop, TOKEN_DECIMALS, grouping=True)}{bcolors.ENDC}")
+    print(f'Airdropping to {bcolors.OKGREEN}{len(shares) - shares.count(0)}{bcolors.ENDC} users\n')
 
     # region Create log files, print locations, write headers
-    timestamp = get_current_utc_time_str()
-    log_success = gen_logfile(SUCCESS_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_canceled = gen_logfile(CANCELED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_failed = gen_logfile(FAILED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_unconfirmed = gen_logfile(UNCONFIRMED_LOGS, timestamp, LOG_FOLDER_PREFIX)
-    log_full = gen_logfile(FULL_LOGS, timestamp, LOG_FOLDER_PREFIX)
+    if resume_dir:
+        # Keep appending to the logs of the run that is being resumed
+        log_success = os.path.join(resume_dir, SUCCESS_LOGS)
+        log_canceled = os.path.join(resume_dir, CANCELED_LOGS)
+        log_failed = os.path.join(resume_dir, FAILED_LOGS)
+        log_unconfirmed = os.path.join(resume_dir, UNCONFIRMED_LOGS)
+        log_full = os.path.join(resume_dir, FULL_LOGS)
+        log_journal = os.path.join(resume_dir, JOURNAL_LOGS)
+        if not os.path.isfile(log_journal):
+            sys.exit(f'Exiting, no journal found at {log_journal}.')
+    else:
+        timestamp = get_current_utc_time_str()
+        log_success = gen_logfile(SUCCESS_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_canceled = gen_logfile(CANCELED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_failed = gen_logfile(FAILED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_unconfirmed = gen_logfile(UNCONFIRMED_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_full = gen_logfile(FULL_LOGS, timestamp, LOG_FOLDER_PREFIX)
+        log_journal = gen_logfile(JOURNAL_LOGS, timestamp, LOG_FOLDER_PREFIX)
 
     print(f"  Successful logs: (tail -f {log_success})")
     print(f"  Canceled logs: (tail -f {log_canceled})")
     print(f"  Failed logs: (tail -f {log_failed})")
     print(f"  Unconfirmed logs: (tail -f {log_unconfirmed})")
     print(f"  Detailed logs: (tail -f {log_full})")
-
-    with open(log_success, "a") as ls:
-        ls.write('recipient,amount,signature\n')
-    with open(log_canceled, "a") as lc:
-        lc.write('recipient,amount\n')
-    with open(log_failed, "a") as lfa:
-        lfa.write('recipient,amount,error\n')
-    with open(log_unconfirmed, "a") as lu:
-        lu.write('recipient,amount,error\n')
+    print(f"  Journal: {log_journal}")
+
+    if not resume_dir:
+        with OUTPUT_LOCK, open(log_success, "a") as ls:
+            ls.write('recipient,amount,signature\n')
+        with OUTPUT_LOCK, open(log_canceled, "a") as lc:
+            lc.write('recipient,amount\n')
+        with OUTPUT_LOCK, open(log_failed, "a") as lfa:
+            lfa.write('recipient,amount,error\n')
+        with OUTPUT_LOCK, open(log_unconfirmed, "a") as lu:
+            lu.write('recipient,amount,error\n')
     # endregion
 
     print()
+    journal = Journal(log_journal)
+    if engine is not None:
+        engine.journal = journal
+    airdrop = Airdrop(RPC, RATE, TOKEN_DECIMALS, journal, log_success, log_unconfirmed, log_failed,
+                      log_canceled, log_full, retry_on_429=RETRY_ON_429)
+    # Shares are computed over the whole list, and recipients are numbered by their
+    # position in it, which stays the same when a run is resumed
+    drops = [(i + 1, addr, share) for i, (addr, share) in enumerate(zip(addresses, shares)) if share]
+    skip, resumed = set(), []
+    if resume_dir:
+        skip, resumed = airdrop.resume(log_journal, drops)
+
     try:
         continue_airdrop_prompt(interactive, SEPARATOR)
-        # Determine factor for proportional drop.
-        proportional_factor = total_drop / sum(accounts.values())
-
-        i = 0
-        for addr in accounts:
-            # Calculate proportional drop 
-            current_balance = accounts[addr]
-            drop = current_balance * proportional_factor
+        airdrop.log_resumed(resumed)
+        # Finished recipients are dropped
+        drops = [(index, addr, share) for index, addr, share in drops if (index, addr) not in skip]
+
+        if pipeline and not interactive:
+            airdrop.pipelined_transfer(
+                engine, drops, batch_size, pipeline, fund_recipient, allow_unfunded_recipient)
+        elif batch_size > 1 and not interactive:
+            airdrop.batch_transfer(
+                engine, drops, batch_size, concurrency, fund_recipient, allow_unfunded_recipient)
+        elif concurrency > 1 and not interactive:
             options = []
             if fund_recipient:
                 options.append('--fund-recipient')
             if allow_unfunded_recipient:
                 options.append('--allow-unfunded-recipient')
-            cmd = TransferCmd("spl-token", "transfer",
-                TOKEN_MINT, TOKEN_DECIMALS, drop, addr, RPC_URL, options)
-
-            if not interactive:
-                log_detail_entry = ""
-                print(f"{i+1}. Airdrop to {addr}: ", end="", flush=True)
-                log_detail_entry += f"{i+1}. Cmdline: {cmd.to_str()}\n"
-                log_detail_entry += try_transfer(
-                    cmd, addr, drop,
-                    log_success, log_unconfirmed, log_failed,
-                    TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED
-                )
-
-                with open(log_full, "a") as lf:
-                    lf.write(log_detail_entry + LOG_SEPARATOR)
-                del cmd
-                i += 1
-            elif interactive:
-                log_detail_entry = ""
-                print(f"{i+1}. ", end="", flush=True)
-                log_detail_entry += f"{i+1}. Cmdline: {cmd.to_str()}\n"
-
-                confirm, switch_mode = single_transaction_prompt(
-                    cmd.to_str(), drop, addr, TOKEN_DECIMALS)
-                if switch_mode:
-                    print("Switching to non-interactive mode on next address.")
-                    interactive = False
-                    confirm = True
-
-                if confirm:
-                    log_detail_entry += try_transfer(
-                        cmd, addr, drop,
-                        log_success, log_unconfirmed, log_failed,
-                        TOO_MANY_REQUESTS, RPC_ERROR, UNCONFIRMED
-                    )
-
-                    with open(log_full, "a") as lf:
-                        lf.write(log_detail_entry + LOG_SEPARATOR)
-                elif not confirm:
-                    print(
-                        f"{bcolors.DANGER}CANCELED{bcolors.ENDC}", flush=True)
-                    cancel = f"{addr},{drop:f}"
-                    with open(log_canceled, "a") as lc:
-                        lc.write(cancel + "\n")
-                    log_detail_entry += f"Cancel: {cancel}\n"
-                    with open(log_full, "a") as lf:
-                        lf.write(log_detail_entry + LOG_SEPARATOR)
-
-                print(f"{bcolors.WARNING}{SEPARATOR}{bcolors.ENDC}")
-                del cmd
-                i += 1
+            airdrop.concurrent_transfer(
+                lambda index, addr, drop: transfer_cmd(engine, index, addr, drop, options, detached=True),
+                drops, concurrency)
+        else:
+            for index, addr, drop in drops:
+                options = []
+                if fund_recipient:
+                    options.append('--fund-recipient')
+                if allow_unfunded_recipient:
+                    options.append('--allow-unfunded-recipient')
+                cmd = transfer_cmd(engine, index, addr, drop, options)
+
+                if not interactive:
+                    log_detail_entry = ""
+                    print(f"{index}. Airdrop to {addr}: ", end="", flush=True)
+                    log_detail_entry += f"{index}. Cmdline: {cmd.to_str()}\n"
+                    log_detail_entry += airdrop.try_transfer(cmd, index, addr, drop)
+
+                    airdrop.write_detail(log_detail_entry)
+                    del cmd
+                elif interactive:
+                    log_detail_entry = ""
+                    print(f"{index}. ", end="", flush=True)
+                    log_detail_entry += f"{index}. Cmdline: {cmd.to_str()}\n"
+
+                    confirm, switch_mode = single_transaction_prompt(
+                        cmd.to_str(), drop, addr, TOKEN_DECIMALS)
+                    if switch_mode:
+                        print("Switching to non-interactive mode on next address.")
+                        interactive = False
+                        confirm = True
+
+                    if confirm:
+                        log_detail_entry += airdrop.try_transfer(cmd, index, addr, drop)
+
+                        airdrop.write_detail(log_detail_entry)
+                    elif not confirm:
+                        print(
+                            f"{bcolors.DANGER}CANCELED{bcolors.ENDC}", flush=True)
+                        cancel = f"{addr},{ui(drop)}"
+                        airdrop.record('canceled', [(index, addr, drop)])
+                        with OUTPUT_LOCK, open(log_canceled, "a") as lc:
+                            lc.write(cancel + "\n")
+                        log_detail_entry += f"Cancel: {cancel}\n"
+                        airdrop.write_detail(log_detail_entry)
+
+                    print(f"{bcolors.WARNING}{SEPARATOR}{bcolors.ENDC}")
+                    del cmd
 
     except KeyboardInterrupt:
         sys.exit("Interrupted, exiting.")
     finally:
+        journal.close()
         print("Log file handlers closed.")
 
     print("Done!")
@@ -529,21 +623,66 @@ parser = argparse.ArgumentParser(
            The application also includes checking tools that can be ran before and after 
            a distribution, to check if all users received the expected amount of tokens.'''
 )
+parser.add_argument(
+    '-u',
+    '--url',
+    dest='url',
+    default='',
+    required=False,
+    help='One or more Solana RPC endpoints, separated by commas. Overrides RPC_URL from \
+        the config file. Requests are spread over the endpoints based on their latency \
+        and error rate, and failing endpoints are skipped until they recover.'
+)
 
 subparsers = parser.add_subparsers(
-    help='Select usage mode: check-before a distribution, check-after or run a distribution (transfer).',
+    help='Select usage mode: allocate the shares, check-before a distribution, check-after or run a distribution (transfer).',
     dest='mode')
 
+parser_l = subparsers.add_parser(
+    'allocate', help='Compute the share of every recipient once, and write it to an allocation file that check-before and transfer can use.')
+parser_l.add_argument(
+    '-a',
+    '--address-list',
+    dest='file_name',
+    metavar='ADDRESS_LIST_FILE',
+    required=True,
+    help='Path to the file containing a list of addresses and balances, seperated by a comma, and with each pair in a seperate line.'
+)
+parser_l.add_argument(
+    '-d',
+    '--drop',
+    metavar='TOTAL_DROP_AMOUNT',
+    dest='drop',
+    type=str,
+    required=True,
+    help='Total amount of tokens that will be proportionally distributed to each recipient.'
+)
+parser_l.add_argument(
+    '-o',
+    '--output',
+    metavar='ALLOCATION_FILE',
+    dest='output_file',
+    default='./allocation.csv',
+    required=False,
+    help='Path of the allocation file, with an address, balance and share per line (default: ./allocation.csv).'
+)
+
 parser_b = subparsers.add_parser(
     'check-before', help='Checker before a distribution, generates a CSV file with a snapshot of current balances of all accounts, and the expected balance after the distribution.')
-parser_b.add_argument(
+input_b = parser_b.add_mutually_exclusive_group(required=True)
+input_b.add_argument(
     '-a',
     '--address-list',
     dest='file_name',
     metavar='ADDRESS_LIST_FILE',
-    required=True,
     help='Path to the file containing a list of addresses and balances, seperated by a comma, and with each pair in a seperate line.'
 )
+input_b.add_argument(
+    '--allocation',
+    dest='allocation_file',
+    metavar='ALLOCATION_FILE',
+    help='Path to an allocation file written by the allocate command, instead of an address list and drop amount.'
+)
 parser_b.add_argument(
     '-t',
     '--address-type',
@@ -558,9 +697,9 @@ parser_b.add_argument(
     '--drop',
     metavar='TOTAL_DROP_AMOUNT',
     dest='drop',
-    type=float,
-    required=True,
-    help='Total amount of tokens that will be proportionally distributed to each recipient.'
+    type=str,
+    required=False,
+    help='Total amount of tokens that will be proportionally distributed to each recipient. Required with -a.'
 )
 
 parser_a = subparsers.add_parser(
@@ -590,7 +729,7 @@ parser_t.add_argument(
     '-d',
     '--drop',
     dest="drop_amount",
-    type=float,
+    type=str,
     required=False,
     help='Total amount of tokens used in the distribution, each recipient will receive a proportion of this value.'
 )
@@ -602,14 +741,21 @@ parser_t.add_argument(
     required=False,
     help='Run in non-interactive mode (no confirmation prompts).'
 )
-parser_t.add_argument(
+input_t = parser_t.add_mutually_exclusive_group(required=True)
+input_t.add_argument(
     '-a',
     '--address-list',
     dest="address_list",
-    required=True,
     help='Path to the file containing a list of addresses and balances, \
         seperated by a comma, and with each pair in a separate line.'
 )
+input_t.add_argument(
+    '--allocation',
+    dest='allocation_file',
+    metavar='ALLOCATION_FILE',
+    help='Path to an allocation file written by the allocate command. Every recipient \
+        receives the share in the file, so no drop amount is needed.'
+)
 parser_t.add_argument(
     '--fund-recipient',
     action='store_true',
@@ -630,6 +776,124 @@ parser_t.add_argument(
     required=False,
     help='Retry when a HTTP 429 error code is encountered. Use this at your own risk.'
 )
+parser_t.add_argument(
+    '--max-rate',
+    dest='max_rate',
+    type=float,
+    default=100.0,
+    required=False,
+    help='Upper limit for the request rate, in requests per second (transfers per second with \
+        the spl-token backend). The rate starts low, grows while requests succeed and is \
+        halved when the RPC throttles (HTTP 429 or error -32005).'
+)
+parser_t.add_argument(
+    '--retry-budget',
+    dest='retry_budget',
+    type=int,
+    default=100,
+    required=False,
+    help='Number of throttled requests that are retried (with exponential backoff) before \
+        giving up on them. Every successful request adds a tenth of a retry back.'
+)
+parser_t.add_argument(
+    '--backend',
+    dest='backend',
+    choices={'native', 'spl-token'},
+    default='spl-token',
+    required=False,
+    help='Select how transfers are sent: build and sign them in-process over JSON-RPC (native), \
+        or run a \'spl-token transfer\' command for each recipient (spl-token). Both use the \
+        keypair configured in the Solana CLI. Defaults to spl-token; --batch-size and \
+        --pipeline need the native backend.'
+)
+parser_t.add_argument(
+    '--batch-size',
+    dest='batch_size',
+    type=int,
+    default=1,
+    required=False,
+    help='Maximum number of recipients per transaction (native backend, non-interactive mode). \
+        Each transaction is filled with as many transfers as fit, up to this value. If a batch \
+        fails, it is split and retried until the failing recipients are isolated.'
+)
+parser_t.add_argument(
+    '--concurrency',
+    dest='concurrency',
+    type=int,
+    default=1,
+    required=False,
+    help='Number of transfers (or batches) that are sent and confirmed at the same time \
+        in non-interactive mode. SIGINT stops starting new transfers and waits for the \
+        ones already in flight.'
+)
+parser_t.add_argument(
+    '--pipeline',
+    dest='pipeline',
+    metavar='MAX_PENDING',
+    type=int,
+    nargs='?',
+    const=256,
+    default=0,
+    required=False,
+    help='Send transactions without waiting for each confirmation (native backend, \
+        non-interactive mode). Confirmations are polled in batches, and transactions whose \
+        blockhash expired are re-sent. At most MAX_PENDING transactions (default 256) \
+        are unconfirmed at any time. Can be combined with --batch-size.'
+)
+parser_t.add_argument(
+    '--resume',
+    dest='resume_dir',
+    metavar='LOG_DIR',
+    default=None,
+    required=False,
+    help='Resume an interrupted distribution from its log folder, using the journal in it. \
+        Recipients that already received their tokens are skipped, and transactions with an \
+        unknown outcome are checked on-chain before anything is sent again. Use the same \
+        address list and drop amount as in the interrupted run.'
+)
+for subparser in (parser_l, parser_b, parser_t):
+    subparser.add_argument(
+        '--min-share',
+        dest='min_share',
+        metavar='AMOUNT',
+        type=str,
+        default=None,
+        required=False,
+        help='Recipients whose share would be smaller than AMOUNT tokens get nothing, and \
+            their share goes to the other recipients.'
+    )
+    subparser.add_argument(
+        '--cap',
+        dest='cap',
+        metavar='AMOUNT',
+        type=str,
+        default=None,
+        required=False,
+        help='No recipient gets more than AMOUNT tokens, the rest of their share goes to \
+            the other recipients.'
+    )
+    subparser.add_argument(
+        '-e',
+        '--excluded',
+        dest='excluded',
+        metavar='EXCLUDED',
+        action='append',
+        default=[],
+        required=False,
+        help='Path to a file of addresses that get nothing, one per line or first on a CSV \
+            line (e.g. the success log of an earlier distribution), or a binary address \
+            list. Can be repeated. They are removed before the shares are computed; from an \
+            allocation file, they are removed without changing the other shares.'
+    )
+    subparser.add_argument(
+        '--exclude-off-curve',
+        dest='exclude_off_curve',
+        action='store_true',
+        default=False,
+        required=False,
+        help='Exclude recipients that are off-curve addresses (program derived addresses, \
+            e.g. pools and vaults). Only for lists of owner addresses.'
+    )
 #endregion
 
 if __name__ == '__main__':
@@ -642,5 +906,9 @@ if __name__ == '__main__':
     FAILED_LOGS = 'failed.log'
     CANCELED_LOGS = 'canceled.log'
     UNCONFIRMED_LOGS = 'unconfirmed.log'
+    JOURNAL_LOGS = 'journal.log'
     RETRY_ON_429 = False
+    RATE = None
+    RPC = None
+    ATA_CACHE = None
     main()
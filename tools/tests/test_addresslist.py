@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.addresslist import (AddressList, HEADER_SIZE, export_text, is_address_list,
+                                load_balances, read_addresses, write_address_list)
+from common.base58 import b58encode
+
+MINT = b58encode(bytes([5]) * 32)
+ADDRESSES = [b58encode(bytes([n]) * 32) for n in range(1, 6)] + ['11111111111111111111111111111111']
+AMOUNTS = [0, 1, 1500000, 2 ** 64 - 1, 42, 7]
+
+
+class AddressListTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'address-list.bin')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        write_address_list(self.path, ADDRESSES, AMOUNTS, MINT, 6, slot=123)
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE + 40 * len(ADDRESSES))
+        self.assertTrue(is_address_list(self.path))
+        address_list = AddressList(self.path)
+        try:
+            self.assertEqual((address_list.mint, address_list.decimals, address_list.slot),
+                             (MINT, 6, 123))
+            self.assertEqual(len(address_list), len(ADDRESSES))
+            self.assertEqual(list(address_list), ADDRESSES)
+            self.assertEqual(list(address_list.amounts), AMOUNTS)
+            self.assertEqual(address_list[2], ADDRESSES[2])
+            self.assertEqual(address_list[-1], ADDRESSES[-1])
+            with self.assertRaises(IndexError):
+                address_list[len(ADDRESSES)]
+            self.assertEqual(list(address_list.shard(1, 3)), [2, 3])
+        finally:
+            address_list.close()
+
+    def test_empty_list(self):
+        write_address_list(self.path, [], [], MINT, 9)
+        address_list = AddressList(self.path)
+        self.assertEqual((len(address_list), list(address_list.amounts)), (0, []))
+        address_list.close()
+
+    def test_rejects_bad_files(self):
+        write_address_list(self.path, ADDRESSES, AMOUNTS, MINT, 6)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 8)
+        with self.assertRaises(ValueError):
+            AddressList(self.path)
+        text = os.path.join(self.tmp.name, 'address-list.txt')
+        with open(text, 'w') as f:
+            f.write(ADDRESSES[0] + '\n')
+        self.assertFalse(is_address_list(text))
+        with self.assertRaises(ValueError):
+            AddressList(text)
+        with self.assertRaises(ValueError):
+            write_address_list(self.path, ADDRESSES, AMOUNTS[:-1], MINT, 6)
+
+    def test_load_balances_checks_the_mint(self):
+        write_address_list(self.path, ADDRESSES, AMOUNTS, MINT, 6)
+        addresses, balances = load_balances(self.path, MINT, 6)
+        self.assertEqual((list(addresses), list(balances)), (ADDRESSES, AMOUNTS))
+        addresses.close()
+        with self.assertRaises(ValueError):
+            load_balances(self.path, MINT, 9)
+        with self.assertRaises(ValueError):
+            load_balances(self.path, ADDRESSES[0], 6)
+
+    def test_text_export(self):
+        write_address_list(self.path, ADDRESSES[:3], AMOUNTS[:3], MINT, 6)
+        text = os.path.join(self.tmp.name, 'address-list.txt')
+        balances = os.path.join(self.tmp.name, 'address-list-balance.txt')
+        address_list = AddressList(self.path)
+        export_text(address_list, text, balances)
+        address_list.close()
+        self.assertEqual(read_addresses(text), ADDRESSES[:3])
+        addresses, amounts = load_balances(balances, MINT, 6)
+        self.assertEqual((addresses, list(amounts)), (ADDRESSES[:3], AMOUNTS[:3]))
@@ -0,0 +1,71 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+from array import array
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.allocation import allocate, largest_remainder, read_allocation, write_allocation
+
+
+class AllocationTest(unittest.TestCase):
+    def test_largest_remainder(self):
+        # 10 / 3 each: 3 + 3 + 3, and the unit left goes to the first of the ties
+        self.assertEqual(list(largest_remainder(array('Q', [1, 1, 1]), 10)), [4, 3, 3])
+        # Remainders 0.4, 0.6 -> the second one gets the unit
+        self.assertEqual(list(largest_remainder(array('Q', [2, 3]), 1)), [0, 1])
+        with self.assertRaises(ValueError):
+            largest_remainder(array('Q', [0, 0]), 10)
+
+    def test_sums_to_total(self):
+        rng = random.Random(7)
+        balances = array('Q', (rng.randrange(1, 10 ** 12) for _ in range(1000)))
+        for total in (1, 999, 10 ** 9 + 7, 2 ** 63):
+            self.assertEqual(sum(allocate(balances, total)), total)
+
+    def test_zero_balances_get_nothing(self):
+        shares = allocate(array('Q', [0, 5, 0, 5]), 11)
+        self.assertEqual(list(shares), [0, 6, 0, 5])
+
+    def test_min_share(self):
+        balances = array('Q', [1, 2, 1000, 2000, 3000])
+        shares = allocate(balances, 6003, min_share=10)
+        self.assertEqual(sum(shares), 6003)
+        self.assertEqual(list(shares[:2]), [0, 0])
+        self.assertTrue(all(share >= 10 for share in shares[2:]))
+        self.assertEqual(list(shares[2:]), [1001, 2001, 3001])
+
+    def test_cap(self):
+        balances = array('Q', [100, 1, 1, 2])
+        shares = allocate(balances, 1000, cap=400)
+        self.assertEqual(sum(shares), 1000)
+        self.assertEqual(shares[0], 400)
+        # What the capped holder doesn't get is spread over the others by balance
+        self.assertEqual(list(shares[1:]), [150, 150, 300])
+
+    def test_cap_and_min_share(self):
+        rng = random.Random(3)
+        balances = array('Q', (rng.choice([1, 10, 100, 10 ** 6]) for _ in range(500)))
+        total = 10 ** 7 + 13
+        shares = allocate(balances, total, min_share=1000, cap=100000)
+        self.assertEqual(sum(shares), total)
+        self.assertTrue(all(share == 0 or 1000 <= share <= 100000 for share in shares))
+
+    def test_impossible_limits(self):
+        with self.assertRaises(ValueError):
+            allocate(array('Q', [1, 1]), 1000, cap=100)
+        with self.assertRaises(ValueError):
+            allocate(array('Q', [1, 1]), 10, min_share=100)
+
+    def test_file_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'allocation.csv')
+            write_allocation(path, ['A', 'B', 'C'], array('Q', [5, 0, 7]),
+                             array('Q', [1500000, 0, 2]), 6)
+            addresses, balances, shares = read_allocation(path, 6)
+        # Recipients without a share are left out
+        self.assertEqual(addresses, ['A', 'C'])
+        self.assertEqual(list(balances), [5, 7])
+        self.assertEqual(list(shares), [1500000, 2])
@@ -0,0 +1,131 @@
+import base64
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common import transaction
+from common.airdrop import Airdrop
+from common.base58 import b58encode
+from common.keys import Keypair, SYSTEM_PROGRAM_ID, TOKEN_PROGRAM_ID, pubkey_bytes
+from common.rpc import RpcError
+from common.transfer import TransferEngine
+
+DECIMALS = 6
+MINT = b58encode(bytes([200]) * 32)
+SEED = bytes.fromhex('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60')
+PUBLIC = bytes.fromhex('d75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a')
+
+
+def recipient(n):
+    return b58encode(bytes([n]) * 31 + bytes([n]))
+
+
+class FakeClient:
+    # Funded recipients whose token accounts exist (unless missing_atas), and a node
+    # that rejects every transaction that pays one of the rejected token accounts
+    def __init__(self, missing_atas=False, rejected=()):
+        self.missing_atas = missing_atas
+        self.rejected = {pubkey_bytes(address) for address in rejected}
+        self.sent = []
+
+    def get_multiple_accounts(self, addresses, commitment='confirmed', data_slice=None):
+        infos = []
+        for i, address in enumerate(addresses):
+            if i % 2 == 0:
+                infos.append({'owner': SYSTEM_PROGRAM_ID, 'lamports': 1000000, 'data': ['', 'base64']})
+            elif self.missing_atas:
+                infos.append(None)
+            else:
+                infos.append({'owner': TOKEN_PROGRAM_ID, 'lamports': 2039280,
+                              'data': [base64.b64encode(bytes(165)).decode(), 'base64']})
+        return infos
+
+    def get_latest_blockhash(self, commitment='confirmed'):
+        return b58encode(bytes([9]) * 32), 1000
+
+    def get_block_height(self, commitment='confirmed'):
+        return 900
+
+    def send_transaction(self, tx_base64, skip_preflight=False, commitment='confirmed'):
+        tx = base64.b64decode(tx_base64)
+        if any(key in tx for key in self.rejected):
+            raise RpcError(-32002, 'Transaction simulation failed: custom program error: 0x1')
+        self.sent.append(tx)
+
+    def get_signature_statuses(self, signatures, search_history=False):
+        return [{'err': None, 'confirmationStatus': 'confirmed'} for _ in signatures]
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def engine(self, client):
+        return TransferEngine(client, Keypair(SEED + PUBLIC), MINT, DECIMALS)
+
+    def prepared(self, engine, count, **options):
+        transfers = [(recipient(n), 1000000 * n) for n in range(1, count + 1)]
+        results = engine.prepare(transfers, **options)
+        self.assertTrue(all(ok for ok, _ in results))
+        prepared = [p for _, p in results]
+        for n, p in enumerate(prepared, 1):
+            p.index = n
+        return prepared
+
+    def test_pack_respects_batch_size(self):
+        engine = self.engine(FakeClient())
+        batches = engine.pack(self.prepared(engine, 10), 4)
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertEqual([p.index for batch in batches for p in batch], list(range(1, 11)))
+
+    def test_pack_fills_packets(self):
+        engine = self.engine(FakeClient())
+        prepared = self.prepared(engine, 60)
+        batches = engine.pack(prepared, 100)
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([p.index for batch in batches for p in batch], list(range(1, 61)))
+        for batch in batches:
+            tx, _, _ = engine.build([ix for p in batch for ix in p.instructions])
+            self.assertLessEqual(len(tx), transaction.PACKET_DATA_SIZE)
+        # Every batch but the last is full: one more transfer wouldn't fit
+        for batch, following in zip(batches, batches[1:]):
+            self.assertFalse(engine.fits(batch + following[:1]))
+
+    def test_funded_recipients_take_more_room(self):
+        engine = self.engine(FakeClient())
+        plain = engine.pack(self.prepared(engine, 60), 100)
+        engine = self.engine(FakeClient(missing_atas=True))
+        funded = engine.pack(self.prepared(engine, 60, fund_recipient=True), 100)
+        self.assertTrue(all(p.funding for batch in funded for p in batch))
+        self.assertGreater(len(funded), len(plain))
+
+    def test_failed_batch_is_split(self):
+        # Recipient 6 makes every transaction it is in fail
+        engine = self.engine(FakeClient())
+        prepared = self.prepared(engine, 8)
+        engine.client.rejected = {pubkey_bytes(prepared[5].destination)}
+        logs = [os.path.join(self.tmp.name, name) for name in
+                ('success.log', 'unconfirmed.log', 'failed.log', 'canceled.log', 'full.log')]
+        airdrop = Airdrop(engine.client, None, DECIMALS, None, *logs)
+
+        with redirect_stdout(io.StringIO()) as out:
+            airdrop.try_transfer_batch(engine, prepared)
+        self.assertIn('1-8. Airdrop to 8 recipients: ', out.getvalue())
+        self.assertIn('FAILED', out.getvalue())
+        # Only the half with recipient 6 is split again: 1-4, 7-8 and 5 land
+        self.assertEqual(len(engine.client.sent), 3)
+        with open(airdrop.log_success) as f:
+            succeeded = [line.split(',')[0] for line in f]
+        self.assertEqual(sorted(succeeded), sorted(recipient(n) for n in (1, 2, 3, 4, 5, 7, 8)))
+        with open(airdrop.log_failed) as f:
+            failed = f.read().splitlines()
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].startswith(f'{recipient(6)},6.000000,'))
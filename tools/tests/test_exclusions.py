@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+import unittest
+from array import array
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.exclusions import Exclusions
+
+
+class ExclusionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'excluded.txt')
+        # A plain address, a success log line, and the header of a log
+        with open(self.path, 'w') as f:
+            f.write('B\nrecipient,amount,signature\nD,1.000000,sig\n\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_filter(self):
+        exclusions = Exclusions([self.path])
+        self.assertEqual(exclusions.filter(['A', 'B', 'C', 'D']), ['A', 'C'])
+        addresses = ['A', 'B']
+        self.assertIs(Exclusions().filter(addresses), addresses)
+
+    def test_remove_with_columns(self):
+        exclusions = Exclusions([self.path])
+        addresses, balances, shares = exclusions.remove(
+            ['A', 'B', 'C', 'D'], array('Q', [1, 2, 3, 4]), array('Q', [5, 6, 7, 8]))
+        self.assertEqual((addresses, list(balances), list(shares)), (['A', 'C'], [1, 3], [5, 7]))
@@ -0,0 +1,65 @@
+import operator
+import os
+import sys
+import unittest
+from array import array
+from decimal import Decimal
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.filters import bottom, by_balance, in_base_units, parse_filter, sample, select, top
+
+BALANCES = array('Q', [50, 0, 700, 50, 3, 900, 0, 50])
+
+
+class FilterTest(unittest.TestCase):
+    def test_select(self):
+        self.assertEqual(select(BALANCES, [(operator.gt, 0)]),
+                         ([0, 2, 3, 4, 5, 7], [50, 700, 50, 3, 900, 50]))
+        self.assertEqual(select(BALANCES, [(operator.ge, 50), (operator.lt, 900)]),
+                         ([0, 2, 3, 7], [50, 700, 50, 50]))
+        self.assertEqual(select(BALANCES, [(operator.eq, 0)]), ([1, 6], [0, 0]))
+        # No filter keeps everyone
+        self.assertEqual(select(BALANCES, [])[0], list(range(len(BALANCES))))
+
+    def test_top_and_bottom(self):
+        indices, column = select(BALANCES, [(operator.gt, 0)])
+        self.assertEqual(sorted(top(indices, column, 2)), [2, 5])
+        self.assertEqual(bottom(indices, column, 1), [4])
+        # Ties at the cut go to the earlier holders
+        self.assertEqual(sorted(top(indices, column, 3)), [0, 2, 5])
+        self.assertEqual(sorted(bottom(indices, column, 3)), [0, 3, 4])
+        self.assertEqual(sorted(top(indices, column, 100)), indices)
+        self.assertEqual(top(indices, column, 0), [])
+
+    def test_top_with_sort(self):
+        # A large n ranks with a sort instead of a heap, with the same result
+        balances = array('Q', [i * 7919 % 1000 for i in range(2000)])
+        indices = list(range(len(balances)))
+        expected = sorted(indices, key=lambda i: (-balances[i], i))[:1500]
+        self.assertEqual(sorted(top(indices, list(balances), 1500)), sorted(expected))
+
+    def test_sample(self):
+        indices = list(range(100))
+        picked = sample(indices, 10, seed=1)
+        self.assertEqual(len(set(picked)), 10)
+        self.assertTrue(set(picked) <= set(indices))
+        self.assertEqual(picked, sample(indices, 10, seed=1))
+        with self.assertRaises(ValueError):
+            sample(indices, 101)
+
+    def test_by_balance(self):
+        self.assertEqual(by_balance(BALANCES, [0, 1, 2, 3, 7]), [2, 0, 3, 7, 1])
+
+    def test_parse_filter(self):
+        self.assertEqual(parse_filter('balance>100'), (operator.gt, Decimal('100')))
+        self.assertEqual(parse_filter(' balance <= 0.5 '), (operator.le, Decimal('0.5')))
+        for expr in ('balance=>1', 'amount>1', 'balance>abc'):
+            with self.assertRaises(ValueError):
+                parse_filter(expr)
+
+    def test_in_base_units(self):
+        self.assertEqual(in_base_units(Decimal('1.5'), 6), 1500000)
+        # Between two base units, so balance>1.0000005 doesn't round
+        threshold = in_base_units(Decimal('1.0000005'), 6)
+        self.assertTrue(1000000 < threshold < 1000001)
@@ -0,0 +1,94 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common.airdrop import Airdrop
+from common.journal import Journal, load_journal
+
+DECIMALS = 6
+
+
+class FakeRpc:
+    # Signature statuses for verify_signatures(), everything else is unknown
+    def __init__(self, statuses, height=1000):
+        self.statuses = statuses
+        self.height = height
+
+    def get_signature_statuses(self, signatures, search_history=False):
+        return [self.statuses.get(sig) for sig in signatures]
+
+    def get_block_height(self, commitment):
+        return self.height
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'journal.csv')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def airdrop(self, rpc=None):
+        logs = [os.path.join(self.tmp.name, name) for name in
+                ('success.log', 'unconfirmed.log', 'failed.log', 'canceled.log', 'full.log')]
+        return Airdrop(rpc, None, DECIMALS, None, *logs)
+
+    def test_reload_keeps_the_latest_entry(self):
+        journal = Journal(self.path)
+        journal.write_many('intent', [(1, 'A', '1.000000'), (2, 'B', '2.000000')])
+        journal.write_many('sent', [(1, 'A', '1.000000')], 'sigA', 500)
+        journal.write_many('unconfirmed', [(1, 'A', '1.000000')])
+        journal.write_many('success', [(2, 'B', '2.000000')], 'sigB')
+        journal.close()
+
+        entries = load_journal(self.path)
+        self.assertEqual(list(entries), [(1, 'A'), (2, 'B')])
+        a = entries[(1, 'A')]
+        self.assertEqual(a.state, 'unconfirmed')
+        # An unconfirmed entry keeps the signature of the 'sent' entry before it
+        self.assertEqual((a.signature, a.last_valid_height), ('sigA', 500))
+        self.assertEqual((entries[(2, 'B')].state, entries[(2, 'B')].signature), ('success', 'sigB'))
+
+    def test_torn_line_is_ignored(self):
+        journal = Journal(self.path)
+        journal.write_many('success', [(1, 'A', '1.000000')], 'sigA')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('success,2,B,2.000000,sigB')
+
+        entries = load_journal(self.path)
+        self.assertEqual(list(entries), [(1, 'A')])
+
+    def test_resume_by_index_and_address(self):
+        # The same address at positions 1 and 3, only the first one was sent
+        journal = Journal(self.path)
+        journal.write_many('success', [(1, 'A', '1.000000')], 'sig1')
+        journal.write_many('sent', [(2, 'B', '1.000000')], 'sig2', 900)
+        journal.write_many('sent', [(4, 'C', '1.000000')], 'sig4', 900)
+        journal.write_many('spawned', [(5, 'D', '1.000000')])
+        journal.close()
+        drops = [(1, 'A', 1000000), (2, 'B', 1000000), (3, 'A', 1000000),
+                 (4, 'C', 1000000), (5, 'D', 1000000), (6, 'E', 1000000)]
+        rpc = FakeRpc({'sig2': {'err': None, 'confirmationStatus': 'finalized'}})
+        airdrop = self.airdrop(rpc)
+
+        with redirect_stdout(io.StringIO()):
+            skip, resumed = airdrop.resume(self.path, drops)
+        # 4 expired without landing and is sent again, 5 can't be verified
+        self.assertEqual(skip, {(1, 'A'), (2, 'B'), (5, 'D')})
+        self.assertEqual(sorted((state, entry.index) for state, entry in resumed),
+                         [('success', 2), ('unconfirmed', 5)])
+        # Nothing is written before log_resumed()
+        self.assertFalse(os.path.exists(airdrop.log_success))
+
+        airdrop.log_resumed(resumed)
+        with open(airdrop.log_success) as f:
+            self.assertEqual(f.read(), 'B,1.000000,sig2\n')
+        with open(airdrop.log_unconfirmed) as f:
+            self.assertTrue(f.read().startswith('D,1.000000,'))
@@ -0,0 +1,80 @@
+import os
+import struct
+import sys
+import unittest
+
+# Run from the repository root with: python -m unittest discover -s tools/tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from common import ed25519, transaction
+from common.base58 import b58encode
+from common.keys import Keypair, TOKEN_PROGRAM_ID, pubkey_bytes
+
+# RFC 8032, section 7.1, tests 1 and 2
+SEED_1 = bytes.fromhex('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60')
+PUBLIC_1 = bytes.fromhex('d75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a')
+SIGNATURE_1 = bytes.fromhex(
+    'e5564300c360ac729086e2cc806e828a84877f1eb8e5d974d873e065224901555'
+    'fb8821590a33bacc61e39701cf9b46bd25bf5f0595bbe24655141438e7a100b')
+SEED_2 = bytes.fromhex('4ccd089b28ff96da9db6c346ec114e0f5b8a319f35aba624da8cf6ed4fb8a6fb')
+PUBLIC_2 = bytes.fromhex('3d4017c3e843895a92b70aa74d1b7ebc9c982ccf2ec4968cc0cd55f12af4660c')
+SIGNATURE_2 = bytes.fromhex(
+    '92a009a9f0d4cab8720e820b5f642540a2b27b5416503f8fb3762223ebdb69da0'
+    '85ac1e43e15996e458f3613d0f11d8c387b2eaeb4302aeeb00d291612bb0c00')
+
+SOURCE = bytes([1]) * 32
+MINT = bytes([2]) * 32
+DESTINATION = bytes([3]) * 32
+BLOCKHASH = bytes([4]) * 32
+
+
+class Ed25519Test(unittest.TestCase):
+    def test_rfc8032_vectors(self):
+        self.assertEqual(ed25519.public_key(SEED_1), PUBLIC_1)
+        self.assertEqual(ed25519.sign(SEED_1, b''), SIGNATURE_1)
+        self.assertEqual(ed25519.public_key(SEED_2), PUBLIC_2)
+        self.assertEqual(ed25519.sign(SEED_2, bytes([0x72])), SIGNATURE_2)
+
+
+class TransferCheckedTest(unittest.TestCase):
+    def setUp(self):
+        self.keypair = Keypair(SEED_1 + PUBLIC_1)
+
+    def instruction(self):
+        return transaction.transfer_checked(
+            b58encode(SOURCE), b58encode(MINT), b58encode(DESTINATION), self.keypair.public,
+            1500000, 6)
+
+    def test_instruction(self):
+        ix = self.instruction()
+        self.assertEqual(ix.program_id, pubkey_bytes(TOKEN_PROGRAM_ID))
+        # Tag 12, u64 amount, u8 decimals
+        self.assertEqual(ix.data, bytes([12]) + struct.pack('<Q', 1500000) + bytes([6]))
+        self.assertEqual([(m.pubkey, m.is_signer, m.is_writable) for m in ix.accounts], [
+            (SOURCE, False, True),
+            (MINT, False, False),
+            (DESTINATION, False, True),
+            (PUBLIC_1, True, False),
+        ])
+
+    def test_signed_transaction(self):
+        tx, signature = transaction.build_transaction([self.keypair], [self.instruction()],
+                                                      b58encode(BLOCKHASH))
+        # The owner pays the fee, then the writable accounts, then the readonly ones
+        message = (bytes([1, 0, 2]) + bytes([5])
+                   + PUBLIC_1 + SOURCE + DESTINATION + MINT + pubkey_bytes(TOKEN_PROGRAM_ID)
+                   + BLOCKHASH
+                   # One instruction: program, source, mint, destination and owner by
+                   # index, then the data
+                   + bytes([1])
+                   + bytes([4]) + bytes([4, 1, 3, 2, 0])
+                   + bytes([10]) + bytes([12]) + struct.pack('<Q', 1500000) + bytes([6]))
+        self.assertEqual(signature, ed25519.sign(SEED_1, message))
+        self.assertEqual(tx, bytes([1]) + signature + message)
+        self.assertLessEqual(len(tx), transaction.PACKET_DATA_SIZE)
+
+    def test_shortvec(self):
+        self.assertEqual(transaction.encode_length(0), b'\x00')
+        self.assertEqual(transaction.encode_length(127), b'\x7f')
+        self.assertEqual(transaction.encode_length(128), b'\x80\x01')
+        self.assertEqual(transaction.encode_length(16383), b'\xff\x7f')
+        self.assertEqual(transaction.encode_length(16384), b'\x80\x80\x01')
@@ -0,0 +1,145 @@
+import base64
+import importlib.util
+import io
+import operator
+import os
+import queue
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+
+# Drives the address-fetcher watch mode against a local websocket replay server.
+# Run from the repository root with: python -m unittest discover -s tools/tests
+TOOLS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, TOOLS)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from common.base58 import b58encode
+from common.holder_index import HolderIndex
+from common.snapshots import SnapshotStore
+from ws_replay import ReplayServer
+
+spec = importlib.util.spec_from_file_location(
+    'address_fetcher', os.path.join(TOOLS, 'address-fetcher', 'address-fetcher.py'))
+fetcher = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetcher)
+
+MINT = b58encode(bytes([7]) * 32)
+DECIMALS = 6
+
+
+def address(n):
+    return b58encode(bytes([n]) * 32)
+
+
+def notification(slot, token_account, owner, amount, lamports=2039280):
+    # A base64 programNotification result with the owner/amount dataSlice
+    data = bytes([owner]) * 32 + amount.to_bytes(8, 'little')
+    return {'context': {'slot': slot},
+            'value': {'pubkey': token_account,
+                      'account': {'data': [base64.b64encode(data).decode(), 'base64'],
+                                  'executable': False, 'lamports': lamports,
+                                  'owner': 'TokenkegQfeZyiNwAJbNbGKPFXCWuWvf9Ss623VQ5DA',
+                                  'rentEpoch': 0}}}
+
+
+def closed(slot, token_account):
+    # A closed account has no lamports and no data left
+    return {'context': {'slot': slot},
+            'value': {'pubkey': token_account,
+                      'account': {'data': ['', 'base64'], 'executable': False,
+                                  'lamports': 0, 'owner': '11111111111111111111111111111111',
+                                  'rentEpoch': 0}}}
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        fetcher.TOKEN_MINT = MINT
+        fetcher.ENCODING = 'base64'
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore(os.path.join(self.tmp.name, 'snapshots.sqlite'))
+        # The bootstrap fetch: four holders at slot 100
+        self.index = HolderIndex()
+        writer = self.store.writer(MINT, DECIMALS)
+        for n in range(1, 5):
+            fields = (address(10 + n), address(n), n * 1000)
+            writer.add(*fields)
+            self.index.add(*fields)
+        self.snapshot = writer.close(100)
+        self.index.set_base(100)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def follow(self, notifications):
+        server = ReplayServer(notifications)
+        try:
+            events = queue.Queue()
+            ws = fetcher.subscribe(server.url, events)
+            with redirect_stdout(io.StringIO()):
+                fetcher.follow(ws, events, threading.Event(), self.index, self.snapshot,
+                               self.store, DECIMALS)
+        finally:
+            server.close()
+        self.assertEqual(server.requests[0]['method'], 'programSubscribe')
+        self.assertEqual(server.requests[0]['params'][1]['filters'][1]['memcmp']['bytes'], MINT)
+
+    def stored(self):
+        return {ta: (owner, amount) for ta, owner, amount in self.store.accounts(self.snapshot)}
+
+    def test_updates_reach_index_and_snapshot(self):
+        self.follow([
+            notification(101, address(11), 1, 1500),
+            notification(102, address(15), 5, 5000),
+            # Older than the bootstrap, ignored
+            notification(99, address(12), 2, 1),
+        ])
+        expected = {address(11): 1500, address(12): 2000, address(13): 3000,
+                    address(14): 4000, address(15): 5000}
+        self.assertEqual(self.index.holdings('token'), expected)
+        self.assertEqual({ta: amount for ta, (_, amount) in self.stored().items()}, expected)
+        self.assertEqual(self.stored()[address(15)][0], address(5))
+        self.assertEqual(self.snapshot.slot, 102)
+        self.assertEqual(self.store.find(MINT, 'latest').slot, 102)
+
+    def test_closed_accounts_leave(self):
+        self.follow([
+            closed(101, address(11)),
+            # Or with 0 lamports and the last data
+            notification(102, address(12), 2, 0, lamports=0),
+            # Older than the close, must not bring the account back
+            notification(101, address(12), 2, 700),
+            notification(103, address(13), 3, 3500),
+        ])
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.holdings('owner'), {address(3): 3500, address(4): 4000})
+        self.assertEqual(sorted(self.stored()), sorted([address(13), address(14)]))
+        self.assertEqual(self.snapshot.slot, 103)
+
+    def test_emptied_accounts_stay(self):
+        self.follow([
+            notification(101, address(11), 1, 0),
+            notification(102, address(13), 3, 0),
+        ])
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.stored()[address(11)], (address(1), 0))
+        self.assertEqual(self.stored()[address(13)], (address(3), 0))
+        # "Get all users with 0 tokens"
+        fetcher.ADDRESS_TYPE = 'token'
+        data, _ = fetcher.select_holders(self.index.holdings('token'),
+                                         ([(operator.eq, 0)], None, None, None))
+        self.assertEqual(sorted(data), [(address(11), 0), (address(13), 0)])
+
+    def test_reopened_account_comes_back(self):
+        self.follow([
+            closed(101, address(11)),
+            notification(102, address(11), 1, 250),
+        ])
+        self.assertEqual(self.index.holdings('token')[address(11)], 250)
+        self.assertEqual(self.stored()[address(11)], (address(1), 250))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+
+# Local websocket server that replays recorded pubsub notifications, so the watch mode
+# can be driven without a validator. It accepts one connection, answers the first
+# request (e.g. programSubscribe) with a subscription id, sends every notification and
+# closes the connection, which is what a dropped connection looks like to the client.
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+SUBSCRIPTION = 42
+
+
+def _frame(opcode, payload):
+    # Server frames are never masked
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 1 << 16:
+        header += bytes([126]) + struct.pack('!H', length)
+    else:
+        header += bytes([127]) + struct.pack('!Q', length)
+    return header + payload
+
+
+def _read_frame(f):
+    first, second = f.read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', f.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', f.read(8))[0]
+    mask = f.read(4) if second & 0x80 else bytes(4)
+    payload = f.read(length)
+    return first & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class ReplayServer:
+    # notifications are the `result` objects of programNotification messages
+    def __init__(self, notifications, method='programNotification'):
+        self.notifications = notifications
+        self.method = method
+        self.requests = []
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(1)
+        self.url = f'ws://127.0.0.1:{self._sock.getsockname()[1]}'
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._sock.close()
+        self._thread.join(5)
+
+    def _serve(self):
+        try:
+            conn, _ = self._sock.accept()
+        except OSError:
+            return
+        with conn:
+            f = conn.makefile('rb')
+            key = None
+            while True:
+                line = f.readline().decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'sec-websocket-key':
+                    key = value.strip()
+            accept = base64.b64encode(hashlib.sha1((key + _GUID).encode()).digest()).decode()
+            conn.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+
+            _, payload = _read_frame(f)
+            request = json.loads(payload)
+            self.requests.append(request)
+            reply = {'jsonrpc': '2.0', 'result': SUBSCRIPTION, 'id': request['id']}
+            conn.sendall(_frame(0x1, json.dumps(reply).encode()))
+            for result in self.notifications:
+                message = {'jsonrpc': '2.0', 'method': self.method,
+                           'params': {'result': result, 'subscription': SUBSCRIPTION}}
+                conn.sendall(_frame(0x1, json.dumps(message).encode()))
+            conn.sendall(_frame(0x8, struct.pack('!H', 1000)))